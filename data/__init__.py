@@ -1,6 +1,11 @@
 from .voc0712 import VOCDetection, VOCAnnotationTransform, VOC_CLASSES
 from .vocxlab import XLDetection, XLAnnotationTransform, XL_CLASSES
 from .weishi import WeishiDetection, WeishiAnnotationTransform, WEISHI_CLASSES
+from .anno_index import AnnotationIndex
+from .image_store import ImageStore
+from .image_cache import ImageCache
+from .image_meta import ImageMeta
+from .bucket_sampler import BucketBatchSampler
 from .coco import COCODetection, COCOAnnotationTransform, COCO_CLASSES, get_label_map
 from .config import *
 import torch
@@ -33,6 +38,29 @@ def detection_collate(batch):
     return torch.stack(imgs, 0), targets
 
 
+def padded_detection_collate(batch):
+    """Collate fn returning the annotations of the batch as one zero padded tensor,
+    which the losses match for the whole batch at once.
+
+    Arguments:
+        batch: (tuple) A tuple of tensor images and lists of annotations
+
+    Return:
+        A tuple containing:
+            1) (tensor) batch of images stacked on their 0 dim
+            2) (tuple) annotations of the batch: (tensor) padded annotations,
+                       Shape: [batch,max_objs,5], rows past the count of an
+                       image are 0, and (tensor) count of every image, Shape: [batch]
+    """
+    counts = [len(sample[1]) for sample in batch]
+    padded = np.zeros((len(batch), max(counts + [1]), 5), dtype=np.float32)
+    for idx, sample in enumerate(batch):
+        if counts[idx] > 0:
+            padded[idx, :counts[idx]] = sample[1]
+    imgs = torch.stack([sample[0] for sample in batch], 0)
+    return imgs, (torch.from_numpy(padded), torch.LongTensor(counts))
+
+
 def base_transform(image, size, mean):
     x = cv2.resize(image, (size, size),
                     interpolation=cv2.INTER_LINEAR).astype(np.float32)
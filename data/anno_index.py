@@ -0,0 +1,130 @@
+"""Pre-parsed annotation index for the VOC-style datasets
+
+Parsing the XML annotation of an image in every pull_item is slow and keeps
+python objects alive in every DataLoader worker. AnnotationIndex parses all
+annotations of an image set once and saves them next to the dataset as flat
+numpy arrays, which every worker then memory-maps:
+    boxes:     int32 [num_objs, 4], pixel coords minus 1 as in the annotation transforms
+    labels:    int32 [num_objs], class index
+    difficult: bool  [num_objs]
+    offsets:   int64 [num_images + 1], objects of image i are offsets[i]:offsets[i+1]
+"""
+import os
+import os.path as osp
+import sys
+import hashlib
+import numpy as np
+
+if sys.version_info[0] == 2:
+    import xml.etree.cElementTree as ET
+else:
+    import xml.etree.ElementTree as ET
+
+
+class AnnotationIndex(object):
+    """Memory-mapped annotations of an image set, built once by load_or_build()
+
+    Arguments:
+        prefix (string): path prefix of the saved .npy files
+    """
+    FIELDS = ('boxes', 'labels', 'difficult', 'offsets')
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._arrays = None
+
+    @staticmethod
+    def index_prefix(cache_dir, name, anno_paths, class_to_ind):
+        """The index file prefix, which changes with the image set, any annotation
+        (path, size and modification time) or the class mapping
+        """
+        h = hashlib.sha1()
+        for path in anno_paths:
+            st = os.stat(path)
+            h.update('{} {} {}\n'.format(path, st.st_size, st.st_mtime).encode('utf-8'))
+        h.update(repr(sorted(class_to_ind.items())).encode('utf-8'))
+        return osp.join(cache_dir, '{}_annots_{}'.format(name, h.hexdigest()[:12]))
+
+    @classmethod
+    def load_or_build(cls, cache_dir, name, anno_paths, class_to_ind):
+        """Load the index of anno_paths from cache_dir, parse the XMLs and save it first if needed
+        Arguments:
+            cache_dir (string): directory next to the dataset storing the index
+            name (string): dataset name, used in the file name
+            anno_paths (list of string): annotation XML of every image, in dataset order
+            class_to_ind (dict): class name -> label index, same as the annotation transform
+        """
+        prefix = cls.index_prefix(cache_dir, name, anno_paths, class_to_ind)
+        # offsets are saved last, so they mark a complete index
+        if not osp.exists(prefix + '_offsets.npy'):
+            if not osp.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            print('Building annotation index {} for {} images...'.format(prefix, len(anno_paths)))
+            cls._save(prefix, cls.parse(anno_paths, class_to_ind))
+        return cls(prefix)
+
+    @staticmethod
+    def parse(anno_paths, class_to_ind):
+        """Parse every XML into the flat arrays of the index"""
+        boxes = []
+        labels = []
+        difficult = []
+        offsets = [0]
+        pts = ['xmin', 'ymin', 'xmax', 'ymax']
+        for path in anno_paths:
+            target = ET.parse(path).getroot()
+            for obj in target.iter('object'):
+                diff = obj.find('difficult')
+                difficult.append(diff is not None and int(diff.text) == 1)
+                name = obj.find('name').text.lower().strip()
+                bbox = obj.find('bndbox')
+                boxes.append([int(bbox.find(pt).text) - 1 for pt in pts])
+                labels.append(class_to_ind[name])
+            offsets.append(len(labels))
+        return {
+            'boxes': np.array(boxes, dtype=np.int32).reshape(-1, 4),
+            'labels': np.array(labels, dtype=np.int32),
+            'difficult': np.array(difficult, dtype=np.bool_),
+            'offsets': np.array(offsets, dtype=np.int64),
+        }
+
+    @classmethod
+    def _save(cls, prefix, arrays):
+        for field in cls.FIELDS:
+            tmp_file = '{}_{}.tmp.npy'.format(prefix, field)
+            np.save(tmp_file, arrays[field])
+            os.rename(tmp_file, '{}_{}.npy'.format(prefix, field))
+
+    def _load(self):
+        if self._arrays is None:
+            self._arrays = dict((field, np.load('{}_{}.npy'.format(self.prefix, field), mmap_mode='r'))
+                                for field in self.FIELDS)
+        return self._arrays
+
+    def __getstate__(self):
+        # DataLoader workers map the files themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self):
+        return len(self._load()['offsets']) - 1
+
+    def objects(self, index, keep_difficult=True):
+        """Return boxes (pixel coords minus 1), labels and difficult flags of image index"""
+        arrays = self._load()
+        start, end = arrays['offsets'][index], arrays['offsets'][index + 1]
+        boxes = np.array(arrays['boxes'][start:end])
+        labels = np.array(arrays['labels'][start:end])
+        difficult = np.array(arrays['difficult'][start:end])
+        if not keep_difficult:
+            boxes, labels, difficult = boxes[~difficult], labels[~difficult], difficult[~difficult]
+        return boxes, labels, difficult
+
+    def target(self, index, width, height, keep_difficult=False):
+        """Same as the annotation transforms: [[xmin, ymin, xmax, ymax, label_ind], ... ]
+        with coords scaled by width and height, as a numpy array of shape [num_objs, 5]
+        """
+        boxes, labels, _ = self.objects(index, keep_difficult)
+        scale = np.array([width, height, width, height], dtype=np.float64)
+        return np.hstack((boxes / scale, labels[:, np.newaxis].astype(np.float64)))
@@ -14,6 +14,9 @@ cv2.setNumThreads(0) # pytorch issue 1355: possible deadlock in DataLoader
 # disable it because it because it's not thread safe and causes unwanted GPU memory allocations
 cv2.ocl.setUseOpenCL(False)
 import numpy as np
+from .image_store import ImageStore
+from .image_cache import ImageCache
+from .pycocotools.cocoarrays import COCOArrays
 
 
 #from utils.pycocotools.coco import COCO
@@ -55,17 +58,28 @@ class COCOAnnotationTransform(object):
     """
     def __init__(self):
         self.label_map = get_label_map(osp.join(COCO_ROOT, 'coco_labels.txt'))
+        # label idx of every category id, for array targets
+        self.label_lookup = np.zeros(max(self.label_map) + 1, dtype=np.int64)
+        for category_id, label in self.label_map.items():
+            self.label_lookup[category_id] = label - 1
 
     def __call__(self, target, width, height):
         """
         Args:
             target (dict): COCO target json annotation as a python dict #"target" include info. about bounding box!!
+                or numpy array of [x, y, w, h, category_id] rows, as sliced from COCOArrays
             height (int): height
             width (int): width
         Returns:
             a list containing lists of bounding boxes  [bbox coords, class idx]
+            (a numpy array of shape [num_objs, 5] for array targets)
         """
         scale = np.array([width, height, width, height])
+        if isinstance(target, np.ndarray):
+            boxes = target[:, :4].astype(np.float64) # a copy, the annotations are left untouched
+            boxes[:, 2:] += boxes[:, :2] # [xmin, ymin, xmax, ymax]
+            labels = self.label_lookup[target[:, 4].astype(np.int64)]
+            return np.hstack((boxes / scale, labels[:, np.newaxis]))
         res = []
         for obj in target:# in COCO, target is in JSON
             if 'bbox' in obj:
@@ -92,20 +106,44 @@ class COCODetection(data.Dataset):
                                         raw images`
         target_transform (callable, optional): A function/transform that takes
         in the target (bbox) and transforms it.
+        image_store (string, optional): prefix of an ImageStore packed in dataset
+            order, read images from its shards instead of the individual files
+        image_cache (int, optional): byte budget of an ImageCache keeping decoded
+            images across epochs and evaluations, 0 disables it
+    The annotations are read from COCOArrays, parsed from the json once and then
+    memory-mapped from root/annotations_cache; the COCO api (self.coco) is only
+    loaded when used. evaluate_detections() needs the mask extension of
+    data/pycocotools built.
     """
 
 #    def __init__(self, root, image_set='trainval35k', transform=None,
     def __init__(self, root, image_set='train2014', transform=None,
-                 target_transform=COCOAnnotationTransform(), dataset_name='MS COCO'):
+                 target_transform=COCOAnnotationTransform(), dataset_name='MS COCO', image_store=None, image_cache=0):
         sys.path.append(osp.join(root, COCO_API))
-        from pycocotools.coco import COCO
         self.root = osp.join(root, IMAGES, image_set)# get images
-        self.coco = COCO(osp.join(root, ANNOTATIONS,
-                                  INSTANCES_SET.format(image_set)))# get annotations
-        self.ids = list(self.coco.imgToAnns.keys())
+        self.annotation_file = osp.join(root, ANNOTATIONS, INSTANCES_SET.format(image_set))
+        self.arrays = COCOArrays.loadOrBuild(self.annotation_file, osp.join(root, 'annotations_cache'))# get annotations
+        self.ids = self.arrays.annImgIds.tolist() # images having annotations, as coco.imgToAnns
+        self.file_names = self.arrays.fileNames[self.arrays.imgInds(self.arrays.annImgIds)]
+        self._coco = None
         self.transform = transform
         self.target_transform = target_transform
         self.name = dataset_name
+        self.image_store = None
+        if image_store is not None:
+            self.image_store = ImageStore(image_store)
+            assert len(self.image_store) == len(self.ids), 'ImageStore does not match the image set'
+        self.image_cache = None
+        if image_cache > 0:
+            self.image_cache = ImageCache(len(self.ids), image_cache)
+
+    @property
+    def coco(self):
+        # the COCO api of the annotation file, e.g. for pull_anno()
+        if self._coco is None:
+            from pycocotools.coco import COCO
+            self._coco = COCO(self.annotation_file)
+        return self._coco
 
     def __getitem__(self, index):
         """
@@ -113,7 +151,7 @@ class COCODetection(data.Dataset):
             index (int): Index
         Returns:
             tuple: Tuple (image, target).
-                   target is the object returned by ``coco.loadAnns``.
+                   target is the [x, y, w, h, category_id] rows of the image, after target_transform.
         """
         im, gt, h, w = self.pull_item(index)
         return im, gt
@@ -128,17 +166,17 @@ class COCODetection(data.Dataset):
             index (int): Index
         Returns:
             tuple: Tuple (image, target, height, width).
-                   target is the object returned by ``coco.loadAnns``.
+                   target is the [x, y, w, h, category_id] rows of the image, after target_transform.
         """
-        img_id = self.ids[index]
-        target = self.coco.imgToAnns[img_id]
-        ann_ids = self.coco.getAnnIds(imgIds=img_id)
-
-        target = self.coco.loadAnns(ann_ids)
-        path = osp.join(self.root, self.coco.loadImgs(img_id)[0]['file_name'])
-        assert osp.exists(path), 'Image path does not exist: {}'.format(path)
-        img = cv2.imread(osp.join(self.root, path))
-        height, width, _ = img.shape
+        # annotations of the image, a slice of the columnar arrays
+        start, end = self.arrays.offsets[index], self.arrays.offsets[index + 1]
+        target = np.hstack((self.arrays.bbox[start:end],
+                            self.arrays.categoryIds[start:end, np.newaxis])) # [x, y, w, h, category_id]
+        img = self._read_image(index)
+        if self.image_store is not None:
+            height, width, _ = self.image_store.shape(index) # size of the original image
+        else:
+            height, width, _ = img.shape
         if self.target_transform is not None:
             target = self.target_transform(target, width, height)
         if self.transform is not None:
@@ -162,9 +200,23 @@ class COCODetection(data.Dataset):
         Return:
             cv2 img
         '''
-        img_id = self.ids[index]
-        path = self.coco.loadImgs(img_id)[0]['file_name']
-        return cv2.imread(osp.join(self.root, path), cv2.IMREAD_COLOR)
+        return self._read_image(index)
+
+    def _read_image(self, index):
+        # the decoded-image cache first, then the packed store or the image file
+        if self.image_cache is not None:
+            img = self.image_cache.get(index)
+            if img is not None:
+                return img
+        if self.image_store is not None:
+            img = self.image_store.read(index)
+        else:
+            path = osp.join(self.root, self.file_names[index])
+            assert osp.exists(path), 'Image path does not exist: {}'.format(path)
+            img = cv2.imread(path)
+        if self.image_cache is not None and img is not None:
+            self.image_cache.put(index, img)
+        return img
 
     def pull_anno(self, index):
         '''Returns the original annotation of image at index
@@ -182,6 +234,67 @@ class COCODetection(data.Dataset):
         ann_ids = self.coco.getAnnIds(imgIds=img_id)
         return self.coco.loadAnns(ann_ids)
 
+    def evaluate_detections(self, all_boxes, output_dir=None, write_results=False, num_workers=0):
+        """
+        COCO bbox evaluation of all_boxes with BatchedCOCOeval.
+        all_boxes[class][image] = [] or np.array of shape #dets x 5
+        (x1, y1, x2, y2, score in pixels of the original image, as test_net fills it)
+
+        With write_results the detections are also written down as a COCO results
+        json in output_dir. num_workers is unused, the evaluation is batched over
+        the classes already.
+        Return:
+            APs: AP@[.5:.95] of every class, in label order
+            mAP: the COCO AP (stats[0])
+        """
+        from .pycocotools.coco import COCO
+        from .pycocotools.cocoeval import BatchedCOCOeval
+
+        dets = self._coco_results(all_boxes)
+        if write_results:
+            self._write_coco_results_file(dets, output_dir)
+        coco_gt = COCO(self.annotation_file)
+        coco_dt = coco_gt.loadRes(dets) # kept as arrays
+        coco_eval = BatchedCOCOeval(coco_gt, coco_dt, 'bbox')
+        coco_eval.params.imgIds = self.ids
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+        # precision [T, R, K, A, M]: area range 'all', maxDets 100
+        precision = coco_eval.eval['precision'][:, :, :, 0, -1]
+        aps = []
+        for k in range(precision.shape[2]):
+            p = precision[:, :, k]
+            p = p[p > -1]
+            aps.append(float(np.mean(p)) if p.size else -1.)
+        return aps, float(coco_eval.stats[0])
+
+    def _coco_results(self, all_boxes):
+        # detections as loadRes rows {imageID, x1, y1, w, h, score, class}
+        label_map = get_label_map(osp.join(COCO_ROOT, 'coco_labels.txt'))
+        category_ids = dict((label, category_id) for category_id, label in label_map.items())
+        rows = []
+        for cls_ind in range(1, len(all_boxes)): # skip the background class
+            for im_ind, dets in enumerate(all_boxes[cls_ind]):
+                if len(dets) == 0:
+                    continue
+                rows.append(np.column_stack((np.full(len(dets), self.ids[im_ind]),
+                                             dets[:, 0], dets[:, 1],
+                                             dets[:, 2] - dets[:, 0], dets[:, 3] - dets[:, 1],
+                                             dets[:, 4], np.full(len(dets), category_ids[cls_ind]))))
+        if not rows:
+            return np.zeros((0, 7))
+        return np.vstack(rows).astype(np.float64)
+
+    def _write_coco_results_file(self, dets, output_dir):
+        results = [{'image_id': int(d[0]), 'category_id': int(d[6]),
+                    'bbox': [float(v) for v in d[1:5]], 'score': float(d[5])} for d in dets]
+        filename = osp.join(output_dir if output_dir is not None else self.root,
+                            'detections_{}_results.json'.format(
+                                osp.splitext(osp.basename(self.annotation_file))[0]))
+        with open(filename, 'w') as f:
+            json.dump(results, f)
+
     def __repr__(self):
         fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
         fmt_str += '    Number of datapoints: {}\n'.format(self.__len__())
@@ -0,0 +1,131 @@
+"""Decoded-image cache shared by the dataset and its DataLoader workers
+
+Every evaluation in the prune and finetune scripts decodes the whole test set
+again. ImageCache keeps decoded images in a memory-mapped arena (in /dev/shm
+when available) with a byte budget, so that after the first pass pull_image()
+and pull_item() only copy pixels. All processes map the same files:
+    {cache_file}_arena.bin: uint8 [budget], the pixels
+    {cache_file}_table.npy: int64 [num_images, 5], one row per image
+        offset, nbytes, height, width, last_used (0 if not cached)
+    {cache_file}_clock.npy: int64 [1], the LRU clock
+Updates are serialized with a lock file; when the arena has no gap large
+enough for a new image, the least recently used images are evicted.
+The process that created the cache removes the files at exit.
+"""
+import os
+import os.path as osp
+import atexit
+import fcntl
+import tempfile
+import numpy as np
+
+
+class ImageCache(object):
+    """LRU cache of decoded images keyed by dataset index
+
+    Arguments:
+        num_images (int): size of the dataset
+        budget (int): bytes of pixels to keep
+        cache_file (string, optional): path prefix of the shared files,
+            a temporary file in /dev/shm (or the temp dir) if None
+    """
+
+    def __init__(self, num_images, budget, cache_file=None):
+        if cache_file is None:
+            shm = '/dev/shm' if osp.isdir('/dev/shm') else None
+            fd, cache_file = tempfile.mkstemp(prefix='image_cache_', dir=shm)
+            os.close(fd)
+            os.remove(cache_file)
+        self.cache_file = cache_file
+        self.num_images = num_images
+        self.budget = budget
+        open_memmap = np.lib.format.open_memmap
+        self.arena = np.memmap(cache_file + '_arena.bin', dtype=np.uint8, mode='w+', shape=(budget,))
+        self.table = open_memmap(cache_file + '_table.npy', mode='w+', dtype=np.int64, shape=(num_images, 5))
+        self.clock = open_memmap(cache_file + '_clock.npy', mode='w+', dtype=np.int64, shape=(1,))
+        self._lock_fd = None
+        self._pid = None
+        atexit.register(self._remove, os.getpid())
+
+    def _remove(self, owner):
+        if os.getpid() != owner:
+            return
+        for suffix in ('_arena.bin', '_table.npy', '_clock.npy', '.lock'):
+            if osp.exists(self.cache_file + suffix):
+                os.remove(self.cache_file + suffix)
+
+    def __getstate__(self):
+        # workers started by pickling map the files themselves
+        state = self.__dict__.copy()
+        for name in ('arena', 'table', 'clock'):
+            state[name] = None
+        state['_lock_fd'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        open_memmap = np.lib.format.open_memmap
+        self.arena = np.memmap(self.cache_file + '_arena.bin', dtype=np.uint8, mode='r+')
+        self.table = open_memmap(self.cache_file + '_table.npy', mode='r+')
+        self.clock = open_memmap(self.cache_file + '_clock.npy', mode='r+')
+
+    def _lock(self):
+        # flock is per open file, so every process (forked workers included) opens its own
+        if self._lock_fd is None or self._pid != os.getpid():
+            self._lock_fd = os.open(self.cache_file + '.lock', os.O_RDWR | os.O_CREAT)
+            self._pid = os.getpid()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _tick(self):
+        self.clock[0] += 1
+        return self.clock[0]
+
+    def _find_gap(self, nbytes):
+        # first fit between the cached images, sorted by offset
+        cached = np.nonzero(self.table[:, 4] > 0)[0]
+        starts = self.table[cached, 0]
+        order = np.argsort(starts)
+        starts = starts[order]
+        ends = starts + self.table[cached, 1][order]
+        gap_starts = np.concatenate(([0], ends))
+        gap_ends = np.concatenate((starts, [self.budget]))
+        fits = np.nonzero(gap_ends - gap_starts >= nbytes)[0]
+        if len(fits) == 0:
+            return None
+        return int(gap_starts[fits[0]])
+
+    def get(self, index):
+        """Return a copy of the cached image index, None if it is not cached"""
+        self._lock()
+        try:
+            offset, nbytes, height, width, last_used = self.table[index]
+            if last_used == 0:
+                return None
+            self.table[index, 4] = self._tick()
+            return np.array(self.arena[offset:offset + nbytes]).reshape(height, width, -1)
+        finally:
+            self._unlock()
+
+    def put(self, index, img):
+        """Cache image index, evicting the least recently used images if needed"""
+        nbytes = img.nbytes
+        if nbytes > self.budget:
+            return
+        self._lock()
+        try:
+            if self.table[index, 4] > 0:
+                return
+            offset = self._find_gap(nbytes)
+            while offset is None:
+                cached = np.nonzero(self.table[:, 4] > 0)[0]
+                self.table[cached[np.argmin(self.table[cached, 4])], 4] = 0
+                offset = self._find_gap(nbytes)
+            self.arena[offset:offset + nbytes] = np.ascontiguousarray(img).reshape(-1)
+            self.table[index, :4] = [offset, nbytes, img.shape[0], img.shape[1]]
+            # mark as cached only once the pixels are written
+            self.table[index, 4] = self._tick()
+        finally:
+            self._unlock()
@@ -0,0 +1,118 @@
+"""Image size index and reduced-resolution decoding for the detection datasets
+
+Training resizes every image to 300 or 320, yet each JPEG is decoded at its
+full resolution first, which dominates the worker time for large images.
+OpenCV decodes a JPEG directly at 1/2, 1/4 or 1/8 of its size
+(IMREAD_REDUCED_COLOR_*) for a fraction of the cost, but the reduction has to
+be chosen before decoding, and the annotations are still scaled by the size of
+the original image. ImageMeta keeps the size of every image of a dataset,
+read once from the image headers and saved next to the dataset:
+    {name}_sizes_{hash}.npy: int32 [num_images, 2], height and width of the
+        original image as cv2.imread returns it, 0 for unreadable images
+The hash covers the path, size and modification time of every image, so a
+replaced image rebuilds the index.
+The sizes also define the buckets of BucketBatchSampler.
+"""
+import os
+import os.path as osp
+import hashlib
+import numpy as np
+import cv2
+try:
+    from PIL import Image
+except ImportError: # the sizes are then read by decoding the images
+    Image = None
+
+# EXIF orientations transposing the image, which cv2.imread applies to JPEGs
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# reduction factors of the decoder, largest first
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def reduced_flag(height, width, min_size):
+    """cv2.imread flag decoding at the lowest resolution whose sides stay >= min_size"""
+    for factor, flag in REDUCED_FLAGS:
+        if min(height, width) >= factor * min_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def read_size(path):
+    """(height, width) of the image at path as cv2.imread returns it, (0, 0) if unreadable
+    Only the header is read when PIL is available.
+    """
+    if Image is not None:
+        try:
+            with Image.open(path) as img:
+                width, height = img.size
+                orientation = 1
+                if img.format == 'JPEG':
+                    exif = img.getexif() if hasattr(img, 'getexif') else (img._getexif() or {})
+                    orientation = exif.get(0x0112, 1)
+            if orientation in TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return height, width
+        except (IOError, SyntaxError, ValueError): # not readable by PIL, let cv2 decide
+            pass
+    img = cv2.imread(path)
+    if img is None:
+        return 0, 0
+    return img.shape[:2]
+
+
+class ImageMeta(object):
+    """Size of the original image of every dataset index, built once by load_or_build()
+
+    Arguments:
+        sizes (numpy array): int32 [num_images, 2], height and width
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    @classmethod
+    def load_or_build(cls, cache_dir, name, image_paths):
+        """Load the sizes of image_paths from cache_dir, read and save them first if needed
+        Arguments:
+            cache_dir (string): directory next to the dataset storing the index
+            name (string): dataset name, used in the file name
+            image_paths (list of string): image of every dataset index, in dataset order
+        """
+        h = hashlib.sha1()
+        for path in image_paths:
+            if osp.exists(path):
+                st = os.stat(path)
+                h.update('{} {} {}\n'.format(path, st.st_size, st.st_mtime).encode('utf-8'))
+            else: # unreadable, size 0
+                h.update('{}\n'.format(path).encode('utf-8'))
+        index_file = osp.join(cache_dir, '{}_sizes_{}.npy'.format(name, h.hexdigest()[:12]))
+        if not osp.exists(index_file):
+            if not osp.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            print('Building image size index {} for {} images...'.format(index_file, len(image_paths)))
+            sizes = np.zeros((len(image_paths), 2), dtype=np.int32)
+            for i, path in enumerate(image_paths):
+                sizes[i] = read_size(path)
+            tmp_file = index_file[:-len('.npy')] + '.tmp.npy'
+            np.save(tmp_file, sizes)
+            os.rename(tmp_file, index_file)
+        return cls(np.load(index_file))
+
+    @classmethod
+    def from_store(cls, image_store):
+        """The sizes recorded by an ImageStore, nothing is decoded"""
+        return cls(image_store.index[:, 3:5].astype(np.int32))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def shape(self, index):
+        """Return (height, width, channels) of the original image"""
+        return int(self.sizes[index, 0]), int(self.sizes[index, 1]), 3
+
+    def imread_flag(self, index, min_size):
+        """cv2.imread flag decoding image index at the lowest resolution whose sides stay >= min_size"""
+        return reduced_flag(self.sizes[index, 0], self.sizes[index, 1], min_size)
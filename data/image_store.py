@@ -0,0 +1,133 @@
+"""Packed image store for the detection datasets
+
+Reading every JPEG with cv2.imread costs one file open per sample, which on a
+network filesystem dominates the data loading time. ImageStore.pack() writes
+the images of a dataset, in dataset order, into a few large shard files plus
+one index; the datasets then read image i from the memory-mapped shards:
+    {prefix}_{shard:03d}.bin: concatenated image records
+    {prefix}_index.npy:       int64 [num_images, 7], one row per image
+        shard, offset, nbytes, height, width, raw_height, raw_width
+    height and width are the size of the original image, used to scale the
+    annotations; raw_height and raw_width are 0 for encoded records (the original
+    file bytes) and the stored size for raw uint8 BGR records.
+
+Pack once, e.g. for VOC:
+    ImageStore.pack(prefix, [dataset._imgpath % img_id for img_id in dataset.ids])
+or from the command line with a list of image paths (first column of each line):
+    python -m data.image_store --image_list trainval.txt --prefix /ssd/voc0712
+"""
+import os
+import os.path as osp
+import argparse
+import numpy as np
+import cv2
+
+
+class ImageStore(object):
+    """Read-only access to the images packed by ImageStore.pack()
+
+    Arguments:
+        prefix (string): path prefix of the shard and index files
+    """
+    SHARD = '{}_{:03d}.bin'
+    INDEX = '{}_index.npy'
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = np.load(self.INDEX.format(prefix))
+        self._shards = {}
+
+    @classmethod
+    def pack(cls, prefix, image_paths, raw=False, max_size=None, shard_size=1 << 30):
+        """Write image_paths into shards of about shard_size bytes
+        Arguments:
+            prefix (string): path prefix of the shard and index files
+            image_paths (list of string): image of every dataset index, in dataset order
+            raw (bool): store decoded uint8 arrays instead of the encoded file bytes,
+                which skips decoding at training time at the cost of disk space
+            max_size (int, optional): with raw, shrink images so that the longer side
+                is at most max_size; pull_image() then returns the shrunk image while
+                shape(), pull_item() and the evaluation (TestItems) use the original
+                height and width
+            shard_size (int): bytes per shard file
+        """
+        dirname = osp.dirname(prefix)
+        if dirname and not osp.isdir(dirname):
+            os.makedirs(dirname)
+        index = np.zeros((len(image_paths), 7), dtype=np.int64)
+        shard, offset = 0, 0
+        fout = open(cls.SHARD.format(prefix, shard), 'wb')
+        for i, path in enumerate(image_paths):
+            with open(path, 'rb') as f:
+                buf = f.read()
+            img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None: # unreadable image, read() returns None like cv2.imread
+                index[i] = [shard, offset, 0, 0, 0, 0, 0]
+                continue
+            height, width = img.shape[:2]
+            raw_height, raw_width = 0, 0
+            if raw:
+                if max_size is not None and max(height, width) > max_size:
+                    scale = float(max_size) / max(height, width)
+                    img = cv2.resize(img, (int(round(width * scale)), int(round(height * scale))),
+                                     interpolation=cv2.INTER_AREA)
+                raw_height, raw_width = img.shape[:2]
+                buf = np.ascontiguousarray(img).tobytes()
+            if offset > 0 and offset + len(buf) > shard_size:
+                fout.close()
+                shard, offset = shard + 1, 0
+                fout = open(cls.SHARD.format(prefix, shard), 'wb')
+            fout.write(buf)
+            index[i] = [shard, offset, len(buf), height, width, raw_height, raw_width]
+            offset += len(buf)
+        fout.close()
+        # the index is saved last, so it marks a complete store
+        np.save(cls.INDEX.format(prefix), index)
+        return cls(prefix)
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(self.SHARD.format(self.prefix, shard), dtype=np.uint8, mode='r')
+        return self._shards[shard]
+
+    def __getstate__(self):
+        # DataLoader workers map the shards themselves
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def shape(self, index):
+        """Return (height, width, channels) of the original image"""
+        return int(self.index[index, 3]), int(self.index[index, 4]), 3
+
+    def read(self, index, flag=cv2.IMREAD_COLOR):
+        """Return image index as a BGR uint8 array, same as cv2.imread, None if unreadable
+        flag is the cv2.imdecode flag of encoded records, e.g. a reduced decode of ImageMeta
+        """
+        shard, offset, nbytes, _, _, raw_height, raw_width = self.index[index]
+        if nbytes == 0:
+            return None
+        buf = self._shard(shard)[offset:offset + nbytes] # a view, nothing is copied
+        if raw_height > 0:
+            # copy so that the in-place augmentations never touch the mapped shard
+            return np.array(buf).reshape(raw_height, raw_width, 3)
+        return cv2.imdecode(buf, flag)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the images of a dataset into an ImageStore')
+    parser.add_argument('--image_list', required=True, type=str,
+                        help='text file with one image path per line, extra columns are ignored')
+    parser.add_argument('--prefix', required=True, type=str, help='path prefix of the packed files')
+    parser.add_argument('--raw', action='store_true', help='store decoded images')
+    parser.add_argument('--max_size', default=None, type=int, help='longer side of the raw images')
+    parser.add_argument('--shard_size', default=1024, type=int, help='MB per shard')
+    args = parser.parse_args()
+
+    with open(args.image_list) as fin:
+        paths = [line.strip().split(' ')[0] for line in fin if line.strip()]
+    store = ImageStore.pack(args.prefix, paths, args.raw, args.max_size, args.shard_size << 20)
+    print('Packed {} images into {}'.format(len(store), args.prefix))
@@ -53,6 +53,7 @@ import numpy as np
 import copy
 import itertools
 from . import mask as maskUtils
+from .cocoarrays import COCOArrays
 import os
 from collections import defaultdict
 import sys
@@ -73,6 +74,7 @@ class COCO:
         # load dataset
         self.dataset,self.anns,self.cats,self.imgs = dict(),dict(),dict(),dict()
         self.imgToAnns, self.catToImgs = defaultdict(list), defaultdict(list)
+        self.arrays = None  # COCOArrays of results loaded from an array
         if not annotation_file == None:
             print('loading annotations into memory...')
             tic = time.time()
@@ -87,32 +89,51 @@ class COCO:
         print('creating index...')
         anns, cats, imgs = {}, {}, {}
         imgToAnns,catToImgs = defaultdict(list),defaultdict(list)
-        if 'annotations' in self.dataset:
-            for ann in self.dataset['annotations']:
-                imgToAnns[ann['image_id']].append(ann)
-                anns[ann['id']] = ann
+        if self.arrays is not None and not 'annotations' in self.dataset:
+            # results loaded from an array: the annotation dicts are built on first use
+            for name in ('anns', 'imgToAnns', 'catToImgs'):
+                self.__dict__.pop(name, None)
+        else:
+            if 'annotations' in self.dataset:
+                # one pass over the annotations for all the indexes
+                hasCats = 'categories' in self.dataset
+                for ann in self.dataset['annotations']:
+                    imgToAnns[ann['image_id']].append(ann)
+                    anns[ann['id']] = ann
+                    if hasCats:
+                        catToImgs[ann['category_id']].append(ann['image_id'])
+            self.anns = anns
+            self.imgToAnns = imgToAnns
+            self.catToImgs = catToImgs
 
         if 'images' in self.dataset:
-            for img in self.dataset['images']:
-                imgs[img['id']] = img
+            imgs = dict((img['id'], img) for img in self.dataset['images'])
 
         if 'categories' in self.dataset:
-            for cat in self.dataset['categories']:
-                cats[cat['id']] = cat
-
-        if 'annotations' in self.dataset and 'categories' in self.dataset:
-            for ann in self.dataset['annotations']:
-                catToImgs[ann['category_id']].append(ann['image_id'])
+            cats = dict((cat['id'], cat) for cat in self.dataset['categories'])
 
         print('index created!')
 
         # create class members
-        self.anns = anns
-        self.imgToAnns = imgToAnns
-        self.catToImgs = catToImgs
         self.imgs = imgs
         self.cats = cats
 
+    def __getattr__(self, name):
+        # only called for missing attributes: the annotation dicts of array results
+        if name in ('anns', 'imgToAnns', 'catToImgs') and self.__dict__.get('arrays') is not None:
+            self._loadArrayAnns()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _loadArrayAnns(self):
+        """
+        Build the annotation dicts and indexes of results loaded from an array
+        :return:
+        """
+        if not 'annotations' in self.dataset:
+            self.dataset['annotations'] = self.arrays.toAnns()
+            self.createIndex()
+
     def info(self):
         """
         Print information about the annotation file.
@@ -132,6 +153,8 @@ class COCO:
         """
         imgIds = imgIds if type(imgIds) == list else [imgIds]
         catIds = catIds if type(catIds) == list else [catIds]
+        if self.arrays is not None:
+            self._loadArrayAnns()
 
         if len(imgIds) == len(catIds) == len(areaRng) == 0:
             anns = self.dataset['annotations']
@@ -293,6 +316,8 @@ class COCO:
         """
         Load result file and return a result api object.
         :param   resFile (str)     : file name of result file
+                 or numpy.ndarray [Nx7] of {imageID,x1,y1,w,h,score,class}, kept as
+                 res.arrays (COCOArrays) without building one dict per detection
         :return: res (obj)         : result api object
         """
         res = COCO()
@@ -300,10 +325,16 @@ class COCO:
 
         print('Loading and preparing results...')
         tic = time.time()
-        if type(resFile) == str or type(resFile) == unicode:
+        if type(resFile) == np.ndarray:
+            res.arrays = COCOArrays.fromResults(resFile, res.dataset['images'])
+            assert set(np.unique(res.arrays.imageIds).tolist()) <= set(self.getImgIds()), \
+                   'Results do not correspond to current coco set'
+            res.dataset['categories'] = copy.deepcopy(self.dataset['categories'])
+            print('DONE (t={:0.2f}s)'.format(time.time()- tic))
+            res.createIndex()
+            return res
+        if PYTHON_VERSION == 2 and type(resFile) == unicode or type(resFile) == str:
             anns = json.load(open(resFile))
-        elif type(resFile) == np.ndarray:
-            anns = self.loadNumpyAnnotations(resFile)
         else:
             anns = resFile
         assert type(anns) == list, 'results in not an array of objects'
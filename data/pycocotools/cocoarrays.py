@@ -0,0 +1,182 @@
+# Columnar storage of COCO annotations.
+#
+# The COCO api keeps one python dict per annotation, indexed by dict-of-lists.
+# COCOArrays keeps the same information as numpy arrays, the annotations
+# grouped by image, so that the annotations of an image are a slice:
+#  imgIds      - [I] id of every image, in the order of dataset['images']
+#  fileNames   - [I] file name of every image
+#  heights     - [I] height of every image
+#  widths      - [I] width of every image
+#  annImgIds   - [J] images having annotations, in order of first annotation
+#                (the order of the keys of COCO.imgToAnns)
+#  offsets     - [J+1] annotations of annImgIds[j] are offsets[j]:offsets[j+1]
+#  ids         - [N] annotation id
+#  imageIds    - [N] image id
+#  categoryIds - [N] category id
+#  bbox        - [Nx4] x, y, width, height
+#  area        - [N] area
+#  iscrowd     - [N] crowd flag
+#  scores      - [N] detection score, only for results (None otherwise)
+# Inside an image the annotations keep the order of the annotation file.
+# Needs numpy only, so it is usable without building the mask api.
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+class COCOArrays:
+    FIELDS = ('imgIds', 'fileNames', 'heights', 'widths', 'annImgIds', 'offsets',
+              'ids', 'imageIds', 'categoryIds', 'bbox', 'area', 'iscrowd')
+
+    def __init__(self, arrays, prefix=None):
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+        self.scores = arrays.get('scores')
+        self.prefix = prefix  # of the saved arrays, when memory-mapped
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(dict((field, np.load('{}_{}.npy'.format(prefix, field), mmap_mode='r'))
+                        for field in cls.FIELDS), prefix)
+
+    def __getstate__(self):
+        # DataLoader workers map the saved arrays themselves instead of receiving a copy
+        if self.prefix is None:
+            return self.__dict__
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        if 'imgIds' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(self.load(state['prefix']).__dict__)
+
+    @classmethod
+    def fromDataset(cls, dataset):
+        '''
+        Build the arrays of a COCO annotation file
+        :param dataset (dict): json content of the annotation file
+        :return: arrays (COCOArrays)
+        '''
+        imgs = dataset.get('images', [])
+        anns = dataset.get('annotations', [])
+        arrays = {
+            'imgIds':      np.array([img['id'] for img in imgs], dtype=np.int64),
+            'fileNames':   np.array([img.get('file_name', '') for img in imgs], dtype=np.str_),
+            'heights':     np.array([img.get('height', 0) for img in imgs], dtype=np.int64),
+            'widths':      np.array([img.get('width', 0) for img in imgs], dtype=np.int64),
+            'ids':         np.array([ann['id'] for ann in anns], dtype=np.int64),
+            'imageIds':    np.array([ann['image_id'] for ann in anns], dtype=np.int64),
+            'categoryIds': np.array([ann['category_id'] for ann in anns], dtype=np.int64),
+            'bbox':        np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4),
+            'area':        np.array([ann.get('area', 0) for ann in anns], dtype=np.float64),
+            'iscrowd':     np.array([ann.get('iscrowd', 0) for ann in anns], dtype=bool),
+        }
+        return cls(cls._groupByImage(arrays))
+
+    @classmethod
+    def fromResults(cls, data, imgs=()):
+        '''
+        Build the arrays of detection results, as loadRes does for bbox results
+        :param data (numpy.ndarray): [Nx7] rows of {imageID,x1,y1,w,h,score,class}
+        :param imgs (list): dataset['images'] of the ground truth
+        :return: arrays (COCOArrays)
+        '''
+        assert(type(data) == np.ndarray)
+        assert(data.shape[1] == 7)
+        arrays = {
+            'imgIds':      np.array([img['id'] for img in imgs], dtype=np.int64),
+            'fileNames':   np.array([img.get('file_name', '') for img in imgs], dtype=np.str_),
+            'heights':     np.array([img.get('height', 0) for img in imgs], dtype=np.int64),
+            'widths':      np.array([img.get('width', 0) for img in imgs], dtype=np.int64),
+            'ids':         np.arange(1, len(data)+1, dtype=np.int64),
+            'imageIds':    data[:, 0].astype(np.int64),
+            'categoryIds': data[:, 6].astype(np.int64),
+            'bbox':        data[:, 1:5].astype(np.float64),
+            'area':        (data[:, 3] * data[:, 4]).astype(np.float64),
+            'iscrowd':     np.zeros(len(data), dtype=bool),
+            'scores':      data[:, 5].astype(np.float64),
+        }
+        return cls(cls._groupByImage(arrays))
+
+    @staticmethod
+    def _groupByImage(arrays):
+        # images in order of first annotation, annotations stable inside an image
+        imageIds = arrays['imageIds']
+        annImgIds, first, inverse = np.unique(imageIds, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind='mergesort')] = np.arange(len(first))
+        order = np.argsort(rank[inverse.reshape(-1)], kind='mergesort')
+        for field in ('ids', 'imageIds', 'categoryIds', 'bbox', 'area', 'iscrowd', 'scores'):
+            if field in arrays:
+                arrays[field] = arrays[field][order]
+        counts = np.bincount(rank[inverse.reshape(-1)], minlength=len(first))
+        arrays['annImgIds'] = annImgIds[np.argsort(first, kind='mergesort')]
+        arrays['offsets'] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return arrays
+
+    @classmethod
+    def loadOrBuild(cls, annotation_file, cacheDir):
+        '''
+        Load the arrays of annotation_file from cacheDir, parse the json and save them first if needed
+        :param annotation_file (str): location of annotation file
+        :param cacheDir (str): directory of the saved arrays
+        :return: arrays (COCOArrays), memory-mapped
+        '''
+        st = os.stat(annotation_file)
+        h = hashlib.sha1('{} {} {}'.format(os.path.abspath(annotation_file), st.st_size, st.st_mtime).encode('utf-8'))
+        prefix = os.path.join(cacheDir, '{}_{}'.format(
+            os.path.splitext(os.path.basename(annotation_file))[0], h.hexdigest()[:12]))
+        # offsets are saved last, so they mark complete arrays
+        if os.path.isfile(prefix + '_offsets.npy'):
+            return cls.load(prefix)
+        print('loading annotations into memory...')
+        tic = time.time()
+        with open(annotation_file, 'r') as f:
+            dataset = json.load(f)
+        arrays = cls.fromDataset(dataset)
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        arrays.save(prefix)
+        print('Done (t={:0.2f}s)'.format(time.time()- tic))
+        return cls.load(prefix)
+
+    def save(self, prefix):
+        fields = [f for f in self.FIELDS if f != 'offsets'] + ['offsets']
+        for field in fields:
+            tmpFile = '{}_{}.tmp.npy'.format(prefix, field)
+            np.save(tmpFile, getattr(self, field))
+            os.rename(tmpFile, '{}_{}.npy'.format(prefix, field))
+
+    def imgInds(self, imgIds):
+        '''
+        :param imgIds (int array): image ids
+        :return: inds (int array): position of every image in imgIds, fileNames, heights and widths
+        '''
+        sorter = np.argsort(self.imgIds)
+        return sorter[np.searchsorted(self.imgIds, imgIds, sorter=sorter)]
+
+    def toAnns(self):
+        '''
+        Annotation dicts of results, same as loadRes builds from a list of bbox results
+        :return: anns (list of dict)
+        '''
+        anns = []
+        # back in the order of the results
+        order = np.argsort(self.ids, kind='mergesort')
+        for id, img, cat, bb, area, score in zip(self.ids[order].tolist(), self.imageIds[order].tolist(),
+                                                 self.categoryIds[order].tolist(), self.bbox[order].tolist(),
+                                                 self.area[order].tolist(), self.scores[order].tolist()):
+            x1, x2, y1, y2 = [bb[0], bb[0]+bb[2], bb[1], bb[1]+bb[3]]
+            anns.append({
+                'image_id':     img,
+                'bbox':         bb,
+                'score':        score,
+                'category_id':  cat,
+                'segmentation': [[x1, y1, x1, y2, x2, y2, x2, y1]],
+                'area':         area,
+                'id':           id,
+                'iscrowd':      0,
+            })
+        return anns
@@ -374,8 +374,8 @@ class COCOeval:
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
                     for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
                         tp = np.array(tp)
                         fp = np.array(fp)
@@ -490,6 +490,275 @@ class COCOeval:
     def __str__(self):
         self.summarize()
 
+class BatchedCOCOeval(COCOeval):
+    # COCOeval on flat arrays, for iouType 'bbox' with useCats.
+    #
+    # evaluate() keeps the detections and ground truths of all images in flat
+    # arrays grouped by (category, image), the detections of a group sorted by
+    # score. The IoU of every dt/gt pair is computed at once, and each detection
+    # is matched for all area ranges and IoU thresholds at once. accumulate()
+    # builds precision and recall of a category with cumulative sums over these
+    # arrays instead of re-concatenating per image results.
+    # The results are the same as COCOeval, but evalImgs is not filled.
+    # Other iouTypes and useCats=0 fall back to COCOeval.
+    def __init__(self, cocoGt=None, cocoDt=None, iouType='bbox'):
+        COCOeval.__init__(self, cocoGt, cocoDt, iouType)
+        self._batch = None                  # flat evaluation results of evaluate()
+
+    def evaluate(self):
+        '''
+        Run evaluation of every image on flat arrays and store the results in self._batch
+        :return: None
+        '''
+        p = self.params
+        iouType = p.iouType if p.useSegm is None else ('segm' if p.useSegm == 1 else 'bbox')
+        if iouType != 'bbox' or not p.useCats:
+            self._batch = None
+            return COCOeval.evaluate(self)
+        tic = time.time()
+        print('Running batched per image evaluation...')
+        p.iouType = iouType
+        print('Evaluate annotation type *{}*'.format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+
+        I = len(p.imgIds)
+        K = len(p.catIds)
+        imgIds = np.array(p.imgIds, dtype=np.int64)
+        catIds = np.array(p.catIds, dtype=np.int64)
+        def _flat(coco):
+            # anns of the evaluated images and categories, in getAnnIds order inside
+            # an (image, category), and their group key k * I + i
+            arrays = getattr(coco, 'arrays', None)
+            if arrays is not None:
+                # results loaded from an array
+                keep = np.nonzero(np.isin(arrays.imageIds, imgIds) & np.isin(arrays.categoryIds, catIds))[0]
+                ann = {'image_id':    arrays.imageIds[keep],
+                       'category_id': arrays.categoryIds[keep],
+                       'bbox':        arrays.bbox[keep],
+                       'area':        arrays.area[keep],
+                       'iscrowd':     arrays.iscrowd[keep],
+                       'score':       arrays.scores[keep] if arrays.scores is not None else np.zeros(len(keep))}
+            else:
+                anns = coco.loadAnns(coco.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+                ann = {'image_id':    np.array([a['image_id'] for a in anns], dtype=np.int64),
+                       'category_id': np.array([a['category_id'] for a in anns], dtype=np.int64),
+                       'bbox':        np.array([a['bbox'] for a in anns], dtype=np.float64).reshape(-1, 4),
+                       'area':        np.array([a['area'] for a in anns], dtype=np.float64),
+                       'iscrowd':     np.array([int(a.get('iscrowd', 0)) for a in anns], dtype=bool),
+                       'score':       np.array([a.get('score', 0) for a in anns], dtype=np.float64)}
+                keep = np.isin(ann['image_id'], imgIds)
+                ann = dict((f, v[keep]) for f, v in ann.items())
+            key = np.searchsorted(catIds, ann['category_id']) * I + np.searchsorted(imgIds, ann['image_id'])
+            return key.astype(np.int64), ann
+        gtKey, gt = _flat(self.cocoGt)
+        dtKey, dt = _flat(self.cocoDt)
+        # the crowd gts are ignored
+        gt['ignore'] = gt['iscrowd']
+
+        # sort gt by group and dt by group then score, both stable
+        order = np.argsort(gtKey, kind='mergesort')
+        gtKey = gtKey[order]
+        gt = dict((f, v[order]) for f, v in gt.items())
+        order = np.argsort(-dt['score'], kind='mergesort')
+        order = order[np.argsort(dtKey[order], kind='mergesort')]
+        dtKey = dtKey[order]
+        dt = dict((f, v[order]) for f, v in dt.items())
+        # keep the maxDets[-1] best detections of each group
+        dtOff = np.concatenate(([0], np.cumsum(np.bincount(dtKey, minlength=K * I))))
+        rank = np.arange(len(dtKey)) - dtOff[dtKey]
+        keep = rank < p.maxDets[-1]
+        dtKey, rank = dtKey[keep], rank[keep]
+        dt = dict((f, v[keep]) for f, v in dt.items())
+        dtCount = np.bincount(dtKey, minlength=K * I)
+        gtCount = np.bincount(gtKey, minlength=K * I)
+        dtOff = np.concatenate(([0], np.cumsum(dtCount)))
+        gtOff = np.concatenate(([0], np.cumsum(gtCount)))
+
+        # ignore flags for every area range
+        areaRng = np.array(p.areaRng, dtype=np.float64)
+        def _outside(area):
+            return (area[:, None] < areaRng[None, :, 0]) | (area[:, None] > areaRng[None, :, 1])
+        gtIg = gt['ignore'][:, None] | _outside(gt['area'])      # [G x A]
+        dtOut = _outside(dt['area'])                             # [D x A]
+
+        # iou of every dt/gt pair of the groups having both
+        groups = np.nonzero((dtCount > 0) & (gtCount > 0))[0]
+        nPairs = dtCount[groups] * gtCount[groups]
+        pairOff = np.concatenate(([0], np.cumsum(nPairs)))
+        grp = np.repeat(np.arange(len(groups)), nPairs)
+        local = np.arange(pairOff[-1]) - pairOff[grp]
+        nG = gtCount[groups][grp]
+        ious = bboxIoU(dt['bbox'][dtOff[groups][grp] + local // nG],
+                       gt['bbox'][gtOff[groups][grp] + local % nG],
+                       gt['iscrowd'][gtOff[groups][grp] + local % nG])
+
+        T = len(p.iouThrs)
+        A = len(p.areaRng)
+        dtm = np.zeros((len(dtKey), A, T), dtype=bool)
+        dtIg = np.zeros((len(dtKey), A, T), dtype=bool)
+        thrs = np.minimum(p.iouThrs, 1-1e-10)
+        for j, g in enumerate(groups):
+            d0, d1 = dtOff[g], dtOff[g+1]
+            g0, g1 = gtOff[g], gtOff[g+1]
+            dtm[d0:d1], dtIg[d0:d1] = self.matchGroup(ious[pairOff[j]:pairOff[j+1]].reshape(d1-d0, g1-g0),
+                                                      gtIg[g0:g1].T, gt['iscrowd'][g0:g1], thrs)
+        # set unmatched detections outside of area range to ignore
+        dtIg |= ~dtm & dtOut[:, :, None]
+
+        self._batch = {
+            'dtKey':    dtKey,                  # [D] k * I + i of each dt
+            'dtRank':   rank,                   # [D] rank of the dt in its (image, category)
+            'dtScores': dt['score'],            # [D]
+            'dtMatched': dtm,                   # [DxAxT] dt matched a gt
+            'dtIgnore': dtIg,                   # [DxAxT] ignore flag of each dt
+            'gtKey':    gtKey,                  # [G] k * I + i of each gt
+            'gtIgnore': gtIg,                   # [GxA] ignore flag of each gt
+        }
+        self.evalImgs = []
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    @staticmethod
+    def matchGroup(ious, gtIg, iscrowd, thrs):
+        '''
+        Greedy matching of the detections of one (image, category), same as evaluateImg,
+        for all area ranges and IoU thresholds at once
+        :param ious: [DxG] iou of the detections, highest score first, with the gts
+        :param gtIg: [AxG] ignore flag of each gt for each area range
+        :param iscrowd: [G] crowd flag of each gt
+        :param thrs: [T] IoU thresholds
+        :return: dtm [DxAxT] matched flags, dtIg [DxAxT] ignore flag of the matched gts
+        '''
+        D, G = ious.shape
+        A, T = gtIg.shape[0], len(thrs)
+        gtm = np.zeros((A, T, G), dtype=bool)
+        dtm = np.zeros((D, A, T), dtype=bool)
+        dtIg = np.zeros((D, A, T), dtype=bool)
+        ig = gtIg[:, None, :]
+        # detections below the lowest threshold never match
+        for d in np.nonzero(ious.max(axis=1) >= thrs.min())[0]:
+            # unmatched (or crowd) gts over the threshold, regular gts before ignored ones
+            cand = (ious[d] >= thrs[:, None]) & (~gtm | iscrowd)
+            reg = cand & ~ig
+            cand = np.where(reg.any(axis=-1, keepdims=True), reg, cand & ig)
+            found = cand.any(axis=-1)
+            if not found.any():
+                continue
+            # best iou, the last gt on ties as in evaluateImg
+            m = G - 1 - np.argmax(np.where(cand, ious[d], -1)[..., ::-1], axis=-1)
+            a, t = np.nonzero(found)
+            m = m[a, t]
+            gtm[a, t, m] = True
+            dtm[d, a, t] = True
+            dtIg[d, a, t] = gtIg[a, m]
+        return dtm, dtIg
+
+    def accumulate(self, p = None):
+        '''
+        Accumulate the flat evaluation results and store the result in self.eval
+        :param p: input params for evaluation
+        :return: None
+        '''
+        if self._batch is None:
+            return COCOeval.accumulate(self, p)
+        print('Accumulating evaluation results...')
+        tic = time.time()
+        # allows input customized parameters
+        if p is None:
+            p = self.params
+        p.catIds = p.catIds if p.useCats == 1 else [-1]
+        T           = len(p.iouThrs)
+        R           = len(p.recThrs)
+        K           = len(p.catIds) if p.useCats else 1
+        A           = len(p.areaRng)
+        M           = len(p.maxDets)
+        precision   = -np.ones((T,R,K,A,M)) # -1 for the precision of absent categories
+        recall      = -np.ones((T,K,A,M))
+
+        # create dictionary for future indexing
+        _pe = self._paramsEval
+        setK = set(_pe.catIds)
+        setA = set(map(tuple, _pe.areaRng))
+        setM = set(_pe.maxDets)
+        setI = set(_pe.imgIds)
+        # get inds to evaluate
+        k_list = [n for n, k in enumerate(p.catIds)  if k in setK]
+        m_list = [m for n, m in enumerate(p.maxDets) if m in setM]
+        a_list = [n for n, a in enumerate(map(lambda x: tuple(x), p.areaRng)) if a in setA]
+        i_list = [n for n, i in enumerate(p.imgIds)  if i in setI]
+        I0 = len(_pe.imgIds)
+        K0 = len(_pe.catIds)
+        useImg = np.zeros(I0, dtype=bool)
+        useImg[[i for i in i_list if i < I0]] = True
+
+        b = self._batch
+        dtOff = np.searchsorted(b['dtKey'], np.arange(K0 + 1) * I0)
+        gtOff = np.searchsorted(b['gtKey'], np.arange(K0 + 1) * I0)
+        for k, k0 in enumerate(k_list):
+            d0, d1 = dtOff[k0], dtOff[k0+1]
+            g0, g1 = gtOff[k0], gtOff[k0+1]
+            dtUse = useImg[b['dtKey'][d0:d1] % I0]
+            gtUse = useImg[b['gtKey'][g0:g1] % I0]
+            dtRank = b['dtRank'][d0:d1]
+            dtScores = b['dtScores'][d0:d1]
+            for a, a0 in enumerate(a_list):
+                npig = np.count_nonzero(~b['gtIgnore'][g0:g1, a0][gtUse])
+                if npig == 0:
+                    continue
+                tps = b['dtMatched'][d0:d1, a0] & ~b['dtIgnore'][d0:d1, a0]    # [DxT]
+                fps = ~b['dtMatched'][d0:d1, a0] & ~b['dtIgnore'][d0:d1, a0]
+                for m, maxDet in enumerate(m_list):
+                    sel = np.nonzero(dtUse & (dtRank < maxDet))[0]
+                    # different sorting method generates slightly different results.
+                    # mergesort is used to be consistent as Matlab implementation.
+                    inds = sel[np.argsort(-dtScores[sel], kind='mergesort')]
+                    nd = len(inds)
+                    tp_sum = np.cumsum(tps[inds], axis=0).astype(np.float64).T
+                    fp_sum = np.cumsum(fps[inds], axis=0).astype(np.float64).T
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+                    recall[:,k,a,m] = rc[:, -1] if nd else 0
+                    # precision envelope, the max precision at any higher recall
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        rinds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        q = np.zeros((R,))
+                        valid = rinds < nd
+                        q[valid] = pr[t, rinds[valid]]
+                        precision[t,:,k,a,m] = q
+        self.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'precision': precision,
+            'recall':   recall,
+        }
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format( toc-tic))
+
+def bboxIoU(dt, gt, iscrowd):
+    '''
+    IoU of each pair of boxes, same as maskUtils.iou on [x,y,w,h] boxes
+    :param dt: [Nx4] detected boxes
+    :param gt: [Nx4] ground truth boxes
+    :param iscrowd: [N] crowd flag of gt, whose iou is then the fraction of dt inside gt
+    :return: [N] ious
+    '''
+    w = np.minimum(dt[:, 2]+dt[:, 0], gt[:, 2]+gt[:, 0]) - np.maximum(dt[:, 0], gt[:, 0])
+    h = np.minimum(dt[:, 3]+dt[:, 1], gt[:, 3]+gt[:, 1]) - np.maximum(dt[:, 1], gt[:, 1])
+    inter = w * h
+    da = dt[:, 2] * dt[:, 3]
+    ga = gt[:, 2] * gt[:, 3]
+    union = np.where(iscrowd, da, da + ga - inter)
+    overlap = (w > 0) & (h > 0)
+    ious = np.zeros(len(dt))
+    ious[overlap] = inter[overlap] / union[overlap]
+    return ious
+
 class Params:
     '''
     Params for coco evaluation api
@@ -498,8 +767,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [1, 10, 100]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'small', 'medium', 'large']
@@ -509,8 +778,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [20]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'medium', 'large']
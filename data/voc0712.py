@@ -18,7 +18,10 @@ cv2.setNumThreads(0) # pytorch issue 1355: possible deadlock in DataLoader
 # disable it because it because it's not thread safe and causes unwanted GPU memory allocations
 cv2.ocl.setUseOpenCL(False)
 import numpy as np
-from .voc_eval import voc_eval
+from .voc_eval import GTIndex, voc_eval_dets, map_classes
+from .anno_index import AnnotationIndex
+from .image_store import ImageStore
+from .image_cache import ImageCache
 
 if sys.version_info[0] == 2:
     import xml.etree.cElementTree as ET
@@ -101,12 +104,18 @@ class VOCDetection(data.Dataset):
             (eg: take in caption string, return tensor of word indices)
         dataset_name (string, optional): which dataset to load
             (default: 'VOC2007')
+        use_anno_index (bool, optional): read annotations from a pre-parsed
+            AnnotationIndex saved under root/annotations_cache instead of parsing the XMLs
+        image_store (string, optional): prefix of an ImageStore packed in dataset
+            order, read images from its shards instead of the individual files
+        image_cache (int, optional): byte budget of an ImageCache keeping decoded
+            images across epochs and evaluations, 0 disables it
     """
 
     def __init__(self, root,
                  image_sets=[('2007', 'trainval'), ('2012', 'trainval')],
                  transform=None, target_transform=VOCAnnotationTransform(),
-                 dataset_name='VOC0712'):
+                 dataset_name='VOC0712', use_anno_index=False, image_store=None, image_cache=0):
         self.root = root
         self.image_set = image_sets
         self.transform = transform
@@ -120,6 +129,18 @@ class VOCDetection(data.Dataset):
             rootpath = osp.join(self.root, 'VOC' + year)
             for line in open(osp.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
                 self.ids.append((rootpath, line.strip()))
+        self.image_store = None
+        if image_store is not None:
+            self.image_store = ImageStore(image_store)
+            assert len(self.image_store) == len(self.ids), 'ImageStore does not match the image set'
+        self.image_cache = None
+        if image_cache > 0:
+            self.image_cache = ImageCache(len(self.ids), image_cache)
+        self.anno_index = None
+        if use_anno_index:
+            self.anno_index = AnnotationIndex.load_or_build(
+                osp.join(self.root, 'annotations_cache'), self.name,
+                [self._annopath % img_id for img_id in self.ids], self.target_transform.class_to_ind)
 
     def __getitem__(self, index):
         im, gt, h, w = self.pull_item(index)
@@ -132,11 +153,18 @@ class VOCDetection(data.Dataset):
     def pull_item(self, index):
         img_id = self.ids[index]
 
-        target = ET.parse(self._annopath % img_id).getroot()
-        img = cv2.imread(self._imgpath % img_id)
-        height, width, channels = img.shape
-
-        if self.target_transform is not None:
+        if self.anno_index is None:
+            target = ET.parse(self._annopath % img_id).getroot()
+        img = self._read_image(index)
+        if self.image_store is not None:
+            height, width, channels = self.image_store.shape(index) # size of the original image
+        else:
+            height, width, channels = img.shape
+
+        if self.anno_index is not None:
+            # pre-parsed, scaled the same way as target_transform
+            target = self.anno_index.target(index, width, height, self.target_transform.keep_difficult)
+        elif self.target_transform is not None:
             target = self.target_transform(target, width, height)
 
         if self.transform is not None:
@@ -159,8 +187,21 @@ class VOCDetection(data.Dataset):
         Return:
             PIL img
         '''
-        img_id = self.ids[index]
-        return cv2.imread(self._imgpath % img_id, cv2.IMREAD_COLOR)
+        return self._read_image(index)
+
+    def _read_image(self, index):
+        # the decoded-image cache first, then the packed store or the image file
+        if self.image_cache is not None:
+            img = self.image_cache.get(index)
+            if img is not None:
+                return img
+        if self.image_store is not None:
+            img = self.image_store.read(index)
+        else:
+            img = cv2.imread(self._imgpath % self.ids[index])
+        if self.image_cache is not None and img is not None:
+            self.image_cache.put(index, img)
+        return img
 
     def pull_anno(self, index):
         '''Returns the original annotation of image at index
@@ -175,6 +216,10 @@ class VOCDetection(data.Dataset):
                 eg: ('001718', [('dog', (96, 13, 438, 332))])
         '''
         img_id = self.ids[index]
+        if self.anno_index is not None:
+            gt = self.anno_index.target(index, 1, 1, self.target_transform.keep_difficult).tolist()
+            gt = [bndbox[:4] + [int(bndbox[4])] for bndbox in gt]
+            return img_id[1], gt
         anno = ET.parse(self._annopath % img_id).getroot()
         #target_transfrom will transform a target "anno" to [(label, bbox coords)
         gt = self.target_transform(anno, 1, 1)
@@ -194,7 +239,7 @@ class VOCDetection(data.Dataset):
         #returns a new tensor with a dimension of size 1 inserted at the specified position
         return torch.Tensor(self.pull_image(index)).unsqueeze_(0)
 
-    def evaluate_detections(self, all_boxes, output_dir=None):
+    def evaluate_detections(self, all_boxes, output_dir=None, write_results=False, num_workers=0):
         """
         all_boxes is a list of length number-of-classes.
         Each list element is a list of length number-of-images.
@@ -202,11 +247,16 @@ class VOCDetection(data.Dataset):
         or a numpy array of detection.
 
         all_boxes[class][image] = [] or np.array of shape #dets x 5
+
+        The APs are computed from all_boxes directly; with write_results the
+        detections are also written down as results files (e.g. for the devkit).
+        num_workers processes evaluate the classes in parallel.
         """
-        # write down the detection results
-        self._write_voc_results_file(all_boxes)
-        # after getting the result file, do evaluation and store in output_dir
-        aps, map = self._do_python_eval(output_dir)
+        if write_results:
+            # write down the detection results
+            self._write_voc_results_file(all_boxes)
+        # do evaluation and store in output_dir
+        aps, map = self._do_python_eval(all_boxes, output_dir, num_workers)
         return aps, map
 
     def _get_voc_results_file_template(self):
@@ -229,7 +279,7 @@ class VOCDetection(data.Dataset):
                 for im_ind, index in enumerate(self.ids):
                     index = index[1]
                     dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
+                    if len(dets) == 0:
                         continue
                     for k in range(dets.shape[0]):
                         # for a class in an image: {image_id} {score} {xcor} {xcor} {ycor} {ycor}
@@ -238,7 +288,7 @@ class VOCDetection(data.Dataset):
                                        dets[k, 0] + 1, dets[k, 1] + 1,
                                        dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def _do_python_eval(self, output_dir='output'):
+    def _do_python_eval(self, all_boxes, output_dir='output', num_workers=0):
         rootpath = os.path.join(self.root, 'VOC' + self._year)
         name = self.image_set[0][1]
         annopath = os.path.join(
@@ -257,15 +307,16 @@ class VOCDetection(data.Dataset):
         print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if output_dir is not None and not os.path.isdir(output_dir):
             os.mkdir(output_dir)
-        for i, cls in enumerate(VOC_CLASSES):
-
-            if cls == '__background__':
-                continue
-
-            filename = self._get_voc_results_file_template().format(cls)
-            rec, prec, ap = voc_eval(
-                filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-                use_07_metric=use_07_metric)
+        # annotations are loaded once for all the classes
+        with open(imagesetfile, 'r') as f:
+            imagenames = [x.strip() for x in f.readlines()]
+        gt_index = GTIndex.load_or_build(cachedir, imagenames, [annopath % x for x in imagenames])
+        det_imagenames = [x[1] for x in self.ids]
+        classes = [(i, cls) for i, cls in enumerate(VOC_CLASSES) if cls != '__background__']
+        # the classes are evaluated in parallel by num_workers processes
+        tasks = [(all_boxes[i], gt_index, cls, 0.5, use_07_metric, det_imagenames) for i, cls in classes]
+        results = map_classes(voc_eval_dets, tasks, num_workers)
+        for (i, cls), (rec, prec, ap) in zip(classes, results):
             # AP = AVG(Precision for each of 11 Recalls's precision)
             aps += [ap]
             print('AP for {} = {:.4f}'.format(cls, ap))
@@ -2,11 +2,13 @@
 # eval tools for VOC dataset or other VOC-like dataset
 # --------------------------------
 
-import pickle
+import hashlib
 import xml.etree.ElementTree as ET
 
 import numpy as np
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 def parse_rec(filename):
     """ Parse a PASCAL VOC xml file """
@@ -60,6 +62,228 @@ def voc_ap(rec, prec, use_07_metric=True):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+def match_detections(image_inds, BB, gt_bbox, gt_difficult, gt_offsets, ovthresh=0.5):
+    """
+    tp, fp = match_detections(...)
+    Greedy PASCAL VOC assignment of the detections of a class, sorted by
+    decreasing confidence: every detection goes to the gt it overlaps most.
+    It is a true positive if the overlap > ovthresh and the gt is neither
+    difficult nor taken by a higher scoring detection, it is ignored if the
+    gt is difficult, and a false positive otherwise.
+    image_inds: image of every detection, index into gt_offsets
+    BB: detected boxes, shape [nd, 4]
+    gt_bbox: gt boxes of the class grouped by image, shape [ngt, 4]
+    gt_difficult: difficult flag of every gt box
+    gt_offsets: gts of image i are gt_bbox[gt_offsets[i]:gt_offsets[i + 1]]
+    """
+    nd = len(image_inds)
+    jmax = np.full(nd, -1, dtype=np.int64) # matched gt, -1 if no overlap > ovthresh
+    # group detections by image, keeping the confidence order inside every group
+    order = np.argsort(image_inds, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(image_inds[order])) + 1
+    for group in np.split(order, bounds):
+        if len(group) == 0:
+            continue
+        start, end = gt_offsets[image_inds[group[0]]], gt_offsets[image_inds[group[0]] + 1]
+        if end == start:
+            continue
+        BBGT = gt_bbox[start:end]
+        bb = BB[group]
+        # overlaps of every detection of the image with every gt, shape [len(group), end - start]
+        ixmin = np.maximum(BBGT[np.newaxis, :, 0], bb[:, np.newaxis, 0])
+        iymin = np.maximum(BBGT[np.newaxis, :, 1], bb[:, np.newaxis, 1])
+        ixmax = np.minimum(BBGT[np.newaxis, :, 2], bb[:, np.newaxis, 2])
+        iymax = np.minimum(BBGT[np.newaxis, :, 3], bb[:, np.newaxis, 3])
+        iw = np.maximum(ixmax - ixmin, 0.)
+        ih = np.maximum(iymax - iymin, 0.)
+        inters = iw * ih
+        uni = (((bb[:, 2] - bb[:, 0]) * (bb[:, 3] - bb[:, 1]))[:, np.newaxis] +
+               (BBGT[:, 2] - BBGT[:, 0]) *
+               (BBGT[:, 3] - BBGT[:, 1]) - inters)
+        overlaps = inters / uni
+        best = np.argmax(overlaps, axis=1)
+        ovmax = overlaps[np.arange(len(group)), best]
+        hit = ovmax > ovthresh
+        jmax[group[hit]] = start + best[hit]
+
+    matched = jmax >= 0
+    difficult = np.zeros(nd, dtype=bool)
+    difficult[matched] = gt_difficult[jmax[matched]] # ignore difficult
+    candidates = np.flatnonzero(matched & ~difficult)
+    # only the highest scoring detection of every gt is a true positive
+    _, first = np.unique(jmax[candidates], return_index=True)
+    tp = np.zeros(nd)
+    tp[candidates[first]] = 1.
+    fp = 1. - tp # false positive
+    fp[matched & difficult] = 0.
+    return tp, fp
+
+class GTIndex(object):
+    """
+    gt_index = GTIndex.load_or_build(...)
+    Gt objects of every class of an image set, parsed once per evaluation and
+    shared by all the classes. The objects are sorted by class, then image, in
+    contiguous arrays:
+        bbox:      float [num_objs, 4]
+        difficult: bool  [num_objs]
+        offsets:   int64 [num_classes * num_images + 1], objects of class c in
+                   image i are offsets[c * num_images + i]:offsets[c * num_images + i + 1]
+    class_gt(classname) slices them without copying.
+    """
+    FIELDS = ('names', 'classes', 'bbox', 'difficult', 'offsets')
+
+    def __init__(self, arrays):
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+        self.image_index = dict((name, i) for i, name in enumerate(self.names))
+        self.class_index = dict((name, c) for c, name in enumerate(self.classes))
+
+    @staticmethod
+    def signature(imagenames, anno_paths):
+        """
+        Hash of the image set and of every annotation file, from its path, size
+        and modification time, so that a changed dataset never reads a stale cache
+        """
+        h = hashlib.sha1()
+        for imagename, path in zip(imagenames, anno_paths):
+            st = os.stat(path)
+            h.update('{} {} {} {}\n'.format(imagename, path, st.st_size, st.st_mtime).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    @classmethod
+    def load_or_build(cls, cachedir, imagenames, anno_paths, parse=parse_rec):
+        """
+        Load the index from cachedir/gt_{signature}_*.npy, parse the annotations
+        and save it first if the image set or any annotation changed
+        imagenames: name of every image
+        anno_paths: xml annotation of every image
+        parse: parse_rec() of the dataset
+        """
+        prefix = os.path.join(cachedir, 'gt_' + cls.signature(imagenames, anno_paths))
+        # offsets are saved last, so they mark a complete index
+        if os.path.isfile(prefix + '_offsets.npy'):
+            return cls(dict((field, np.load('{}_{}.npy'.format(prefix, field), mmap_mode='r'))
+                            for field in cls.FIELDS))
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        arrays = cls.parse(imagenames, anno_paths, parse)
+        print('Saving cached annotations to {:s}_*.npy'.format(prefix))
+        for field in cls.FIELDS:
+            tmp_file = '{}_{}.tmp.npy'.format(prefix, field)
+            np.save(tmp_file, arrays[field])
+            os.rename(tmp_file, '{}_{}.npy'.format(prefix, field))
+        return cls(arrays)
+
+    @staticmethod
+    def parse(imagenames, anno_paths, parse=parse_rec):
+        """Parse every annotation into the arrays of the index"""
+        names = []
+        image_ids = []
+        bbox = []
+        difficult = []
+        for i, path in enumerate(anno_paths):
+            for obj in parse(path):
+                names.append(obj['name'])
+                image_ids.append(i)
+                bbox.append(obj['bbox'])
+                difficult.append(obj['difficult'])
+            if i % 100 == 0:
+                print('Reading annotation for {:d}/{:d}'.format(
+                   i + 1, len(anno_paths)))
+        classes, class_ids = np.unique(np.array(names, dtype=np.str_), return_inverse=True)
+        num_images = len(imagenames)
+        key = class_ids.reshape(-1) * num_images + np.array(image_ids, dtype=np.int64)
+        # stable, objects keep their order inside an image
+        order = np.argsort(key, kind='mergesort')
+        counts = np.bincount(key, minlength=len(classes) * num_images)
+        return {
+            'names': np.array(imagenames, dtype=np.str_),
+            'classes': classes.astype(np.str_),
+            'bbox': np.array(bbox, dtype=float).reshape(-1, 4)[order],
+            'difficult': np.array(difficult, dtype=bool)[order],
+            'offsets': np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+        }
+
+    def class_gt(self, classname):
+        """
+        image_index, gt_bbox, gt_difficult, gt_offsets, npos = gt_index.class_gt(classname)
+        Gt objects of a class as flat arrays grouped by image, see match_detections()
+        image_index maps an image name to its group
+        """
+        num_images = len(self.names)
+        if classname not in self.class_index:
+            return (self.image_index, np.zeros((0, 4)), np.zeros(0, dtype=bool),
+                    np.zeros(num_images + 1, dtype=np.int64), 0)
+        c = self.class_index[classname]
+        gt_offsets = np.asarray(self.offsets[c * num_images:(c + 1) * num_images + 1])
+        start, end = gt_offsets[0], gt_offsets[-1]
+        gt_bbox = self.bbox[start:end]
+        gt_difficult = self.difficult[start:end]
+        npos = np.sum(~gt_difficult)
+        return self.image_index, gt_bbox, gt_difficult, gt_offsets - start, npos
+
+def eval_class(image_inds, confidence, BB, gt, ovthresh=0.5, use_07_metric=True):
+    """
+    rec, prec, ap = eval_class(...)
+    image_inds: group in gt of every detection
+    confidence: score of every detection
+    BB: detected boxes, shape [nd, 4]
+    gt: output of GTIndex.class_gt()
+    """
+    image_index, gt_bbox, gt_difficult, gt_offsets, npos = gt
+    if len(confidence) == 0:
+        print("Exception: line == 1!")
+        return -1., -1., -1.
+
+    # sort by confidence
+    sorted_ind = np.argsort(-confidence)
+    BB = BB[sorted_ind, :]
+    image_inds = image_inds[sorted_ind]
+
+    # go down dets and mark TPs and FPs
+    tp, fp = match_detections(image_inds, BB.astype(float), gt_bbox, gt_difficult, gt_offsets, ovthresh)
+
+    # compute precision recall
+    fp = np.cumsum(fp)# how many 1 in fp array
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+    return rec, prec, ap
+
+def read_dets(detfile, image_index):
+    """Read a results file: image_inds, confidence and BB for eval_class()"""
+    with open(detfile, 'r') as f:
+        lines = f.readlines()
+    if not any(lines):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 4))
+    splitlines = [x.strip().split(' ') for x in lines] # [[image_id1, confidence1, xmin1, xmax1, ymin1, ymax1], [], [], []...]
+    image_inds = np.array([image_index[x[0]] for x in splitlines], dtype=np.int64)
+    confidence = np.array([float(x[1]) for x in splitlines])
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
+    return image_inds, confidence, BB
+
+def class_dets(dets_per_image, image_inds_per_image):
+    """
+    image_inds, confidence, BB = class_dets(all_boxes[cls], ...)
+    The detections of a class straight from all_boxes, without a results file.
+    dets_per_image: all_boxes[cls], [] or np.array of shape #dets x 5 for every image
+    image_inds_per_image: group in gt of every image
+    Scores and coords are rounded as in the results files (boxes shifted by +1
+    as well), so the APs are the same as with voc_eval().
+    """
+    inds = [i for i, dets in enumerate(dets_per_image) if len(dets) > 0]
+    if len(inds) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 4))
+    dets = np.concatenate([dets_per_image[i] for i in inds])
+    image_inds = np.repeat(np.asarray(image_inds_per_image)[inds],
+                           [len(dets_per_image[i]) for i in inds]).astype(np.int64)
+    confidence = np.round(dets[:, -1].astype(float), 3)
+    BB = np.round((dets[:, :4] + 1).astype(float), 1)
+    return image_inds, confidence, BB
+
 """
 rec, prec, ap = voc_eval(...)
 
@@ -70,7 +294,7 @@ annopath: Path to annotations
    annopath.format(imagename) should be the xml annotations file.
 imagesetfile: Text file containing the list of images, one image per line.
 classname: Category name (duh)
-cachedir: Directory for caching/storing the annotations .pkl
+cachedir: Directory for caching/storing the GTIndex of the annotations
 [ovthresh]: Overlap threshold (default = 0.5)
 [use_07_metric]: Whether to use VOC07's 11 point AP computation
    (default True)
@@ -86,115 +310,65 @@ def voc_eval(detpath,
 # assumes detections are in detpath.format(classname)
 # assumes annotations are in annopath.format(imagename)
 # assumes imagesetfile is a text file with each line an image name
-# cachedir caches the annotations in a pickle file
+# cachedir caches the annotations in a GTIndex
 # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl') # if dataset changed, you need to delete old annots.pkl first
     # read list of images
     with open(imagesetfile, 'r') as f:
         lines = f.readlines()
     imagenames = [x.strip() for x in lines]
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath % (imagename))
-            if i % 100 == 0:
-                print('Reading annotation for {:d}/{:d}'.format(
-                   i + 1, len(imagenames)))
-        # save
-        print('Saving cached annotations to {:s}'.format(cachefile))
-        with open(cachefile, 'wb') as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'rb') as f:
-            recs = pickle.load(f)
-    # recs stores the annots for each images
-    # class_recs stores the gt for a class
-
-    # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    # go through every image
-    for imagename in imagenames:
-        # and extract those objects in this image that are under this designated class
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R]) # the object belongs to this class
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        # for each image, store the bboxs for this class inside this image
-        class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
+    gt_index = GTIndex.load_or_build(cachedir, imagenames, [annopath % x for x in imagenames])
+    # gt stores the gt for a class
+    gt = gt_index.class_gt(classname)
 
     # read dets
-    detfile = detpath.format(classname)
-    with open(detfile, 'r') as f:
-        lines = f.readlines()
-    if any(lines) == 1:
-
-        splitlines = [x.strip().split(' ') for x in lines] # [[image_id1, confidence1, xmin1, xmax1, ymin1, ymax1], [], [], []...]
-        image_ids = [x[0] for x in splitlines]
-        confidence = np.array([float(x[1]) for x in splitlines])
-        BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
-
-        # sort by confidence
-        sorted_ind = np.argsort(-confidence)
-        sorted_scores = np.sort(-confidence)
-        BB = BB[sorted_ind, :]
-        image_ids = [image_ids[x] for x in sorted_ind]
-
-        # go down dets and mark TPs and FPs
-        nd = len(image_ids)
-        tp = np.zeros(nd)
-        fp = np.zeros(nd)
-        for d in range(nd):
-            R = class_recs[image_ids[d]]
-            bb = BB[d, :].astype(float)
-            ovmax = -np.inf
-            BBGT = R['bbox'].astype(float)
-            if BBGT.size > 0:
-                # compute overlaps
-                # intersection
-                ixmin = np.maximum(BBGT[:, 0], bb[0])
-                iymin = np.maximum(BBGT[:, 1], bb[1])
-                ixmax = np.minimum(BBGT[:, 2], bb[2])
-                iymax = np.minimum(BBGT[:, 3], bb[3])
-                iw = np.maximum(ixmax - ixmin, 0.)# find the vertex of intersected rectangle
-                ih = np.maximum(iymax - iymin, 0.)# find the vertex of intersected rectangle
-                inters = iw * ih
-                uni = ((bb[2] - bb[0]) * (bb[3] - bb[1]) +
-                       (BBGT[:, 2] - BBGT[:, 0]) *
-                       (BBGT[:, 3] - BBGT[:, 1]) - inters)
-                overlaps = inters / uni
-                ovmax = np.max(overlaps)
-                jmax = np.argmax(overlaps)
-
-            if ovmax > ovthresh:
-                if not R['difficult'][jmax]:# ignore difficult
-                    if not R['det'][jmax]: #R['det'][jmax] has NOT already been 1
-                        tp[d] = 1.
-                        R['det'][jmax] = 1
-                    else:
-                        fp[d] = 1. # false positive
-            else:
-                fp[d] = 1. #false positive
-
-        # compute precision recall
-        fp = np.cumsum(fp)# how many 1 in fp array
-        tp = np.cumsum(tp)
-        rec = tp / float(npos)
-        # avoid divide by zero in case the first detection matches a difficult
-        # ground truth
-        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-        ap = voc_ap(rec, prec, use_07_metric)
+    image_inds, confidence, BB = read_dets(detpath.format(classname), gt[0])
+    return eval_class(image_inds, confidence, BB, gt, ovthresh, use_07_metric)
+
+"""
+rec, prec, ap = voc_eval_dets(...)
+
+Same as voc_eval() but with the detections of the class in memory, no results file.
+dets_per_image: all_boxes[cls], [] or np.array of shape #dets x 5 for every image
+gt_index: GTIndex of the evaluated set, built once for all the classes
+classname: Category name
+[det_imagenames]: name of every image of dets_per_image (default = the images of gt_index)
+"""
+def voc_eval_dets(dets_per_image,
+                  gt_index,
+                  classname,
+                  ovthresh=0.5,
+                  use_07_metric=True,
+                  det_imagenames=None):
+    gt = gt_index.class_gt(classname)
+    if det_imagenames is None:
+        image_inds_per_image = np.arange(len(dets_per_image))
     else:
-        print("Exception: line == 1!")
-        rec = -1.
-        prec = -1.
-        ap = -1.
+        image_inds_per_image = [gt[0][x] for x in det_imagenames]
+    image_inds, confidence, BB = class_dets(dets_per_image, image_inds_per_image)
+    return eval_class(image_inds, confidence, BB, gt, ovthresh, use_07_metric)
 
-    return rec, prec, ap
+# tasks of map_classes(), inherited by the forked workers instead of pickled
+_tasks = []
+
+def _run_task(i):
+    fn, args = _tasks[i]
+    return fn(*args)
+
+def map_classes(fn, tasks, num_workers=0):
+    """
+    results = map_classes(fn, tasks, [num_workers])
+    Return [fn(*args) for args in tasks], e.g. voc_eval_dets() for every class,
+    computed by a pool of num_workers processes (in this process if 0).
+    The workers are forked, so they share the tasks (ground truth, all_boxes)
+    read-only with this process; only the results are pickled back.
+    """
+    if num_workers <= 0 or len(tasks) <= 1 or not hasattr(os, 'fork'):
+        return [fn(*args) for args in tasks]
+    global _tasks
+    _tasks = [(fn, args) for args in tasks]
+    try:
+        with ProcessPoolExecutor(min(num_workers, len(tasks)),
+                                 mp_context=multiprocessing.get_context('fork')) as pool:
+            return list(pool.map(_run_task, range(len(tasks))))
+    finally:
+        _tasks = []
@@ -15,7 +15,12 @@ cv2.setNumThreads(0) # pytorch issue 1355: possible deadlock in DataLoader
 # disable it because it because it's not thread safe and causes unwanted GPU memory allocations
 cv2.ocl.setUseOpenCL(False)
 import numpy as np
-from .weishi_eval import weishi_eval
+from .weishi_eval import load_gt_index
+from .voc_eval import voc_eval_dets, map_classes
+from .anno_index import AnnotationIndex
+from .image_store import ImageStore
+from .image_meta import ImageMeta
+from .image_cache import ImageCache
 
 if sys.version_info[0] == 2:
     import xml.etree.cElementTree as ET
@@ -107,13 +112,25 @@ class WeishiDetection(data.Dataset):
         _imgpath: path for a specific image, extract from .txt file later
         dataset_name (string, optional): which dataset to load
             (default: 'VOC2007')
+        use_anno_index (bool, optional): read annotations from a pre-parsed
+            AnnotationIndex saved under root/annotations_cache instead of parsing the XMLs
+        image_store (string, optional): prefix of an ImageStore packed in dataset
+            order, read images from its shards instead of the individual files
+        image_cache (int, optional): byte budget of an ImageCache keeping decoded
+            images across epochs and evaluations, 0 disables it
+        image_meta (bool, optional): load the ImageMeta size index of the images
+            (self.image_meta), e.g. for BucketBatchSampler
+        decode_size (int, optional): pull_item() decodes JPEGs at 1/2, 1/4 or 1/8 of
+            their resolution while both sides stay >= decode_size, e.g. the training
+            size; implies image_meta, the reduced images bypass the image_cache
     """
 
     def __init__(self, root,
                  image_xml_path="input (jpg, xml) file lists",
                  label_file_path = None,
                  transform=None,
-                 dataset_name='WEISHI'):
+                 dataset_name='WEISHI', use_anno_index=False, image_store=None, image_cache=0,
+                 image_meta=False, decode_size=None):
         target_transform=WeishiAnnotationTransform(label_file_path)
         self.root = root # used to store detection results
         self.transform = transform
@@ -134,6 +151,26 @@ class WeishiDetection(data.Dataset):
             self.ids.append(str(count)) # assign unique id for each image for tracking detection results later
             count = count + 1
         fin.close()
+        self.image_store = None
+        if image_store is not None:
+            self.image_store = ImageStore(image_store)
+            assert len(self.image_store) == len(self.ids), 'ImageStore does not match the image set'
+        self.image_cache = None
+        if image_cache > 0:
+            self.image_cache = ImageCache(len(self.ids), image_cache)
+        self.image_meta = None
+        if image_meta or decode_size is not None:
+            if self.image_store is not None:
+                self.image_meta = ImageMeta.from_store(self.image_store)
+            else:
+                self.image_meta = ImageMeta.load_or_build(
+                    osp.join(self.root, 'annotations_cache'), self.name, [self._imgpath[i] for i in range(count)])
+        self.decode_size = decode_size
+        self.anno_index = None
+        if use_anno_index:
+            self.anno_index = AnnotationIndex.load_or_build(
+                osp.join(self.root, 'annotations_cache'), self.name,
+                [self._annopath[i] for i in range(count)], self.target_transform.class_to_ind)
 
     def __getitem__(self, index):
         im, gt, h, w = self.pull_item(index)
@@ -143,11 +180,20 @@ class WeishiDetection(data.Dataset):
         return len(self._imgpath)
 
     def pull_item(self, index):
-        target = ET.parse(self._annopath[index]).getroot()
-        img = cv2.imread(self._imgpath[index])
-        height, width, channels = img.shape
-
-        if self.target_transform is not None:
+        if self.anno_index is None:
+            target = ET.parse(self._annopath[index]).getroot()
+        img = self._pull_image(index)
+        if self.image_store is not None:
+            height, width, channels = self.image_store.shape(index) # size of the original image
+        elif self.decode_size is not None:
+            height, width, channels = self.image_meta.shape(index) # size of the original image
+        else:
+            height, width, channels = img.shape
+
+        if self.anno_index is not None:
+            # pre-parsed, scaled the same way as target_transform
+            target = self.anno_index.target(index, width, height, self.target_transform.keep_difficult)
+        elif self.target_transform is not None:
             target = self.target_transform(target, width, height)
 
         if self.transform is not None:
@@ -172,7 +218,31 @@ class WeishiDetection(data.Dataset):
         Return:
             PIL img
         '''
-        return cv2.imread(self._imgpath[index], cv2.IMREAD_COLOR)
+        return self._read_image(index)
+
+    def _read_image(self, index, flag=cv2.IMREAD_COLOR):
+        # the decoded-image cache first, then the packed store or the image file
+        if flag != cv2.IMREAD_COLOR: # a reduced decode, not cached
+            if self.image_store is not None:
+                return self.image_store.read(index, flag)
+            return cv2.imread(self._imgpath[index], flag)
+        if self.image_cache is not None:
+            img = self.image_cache.get(index)
+            if img is not None:
+                return img
+        if self.image_store is not None:
+            img = self.image_store.read(index)
+        else:
+            img = cv2.imread(self._imgpath[index])
+        if self.image_cache is not None and img is not None:
+            self.image_cache.put(index, img)
+        return img
+
+    def _pull_image(self, index):
+        # the image of pull_item, decoded at reduced resolution with decode_size
+        if self.decode_size is None:
+            return self._read_image(index)
+        return self._read_image(index, self.image_meta.imread_flag(index, self.decode_size))
 
     def pull_anno(self, index):
         '''Returns the original annotation of image at index
@@ -186,6 +256,10 @@ class WeishiDetection(data.Dataset):
             list:  [img_id, [(label, bbox coords),...]]
                 eg: ('001718', [('dog', (96, 13, 438, 332))])
         '''
+        if self.anno_index is not None:
+            gt = self.anno_index.target(index, 1, 1, self.target_transform.keep_difficult).tolist()
+            gt = [bndbox[:4] + [int(bndbox[4])] for bndbox in gt]
+            return self.ids[index], gt
         anno = ET.parse(self._annopath[index]).getroot()
         gt = self.target_transform(anno, 1, 1)
         return self.ids[index], gt
@@ -203,7 +277,7 @@ class WeishiDetection(data.Dataset):
         '''
         return torch.Tensor(self.pull_image(index)).unsqueeze_(0)
 
-    def evaluate_detections(self, all_boxes, output_dir=None):
+    def evaluate_detections(self, all_boxes, output_dir=None, write_results=False, num_workers=0):
         """
         all_boxes is a list of length number-of-classes.
         Each list element is a list of length number-of-images.
@@ -211,11 +285,16 @@ class WeishiDetection(data.Dataset):
         or a numpy array of detection.
 
         all_boxes[class][image] = [] or np.array of shape #dets x 5
+
+        The APs are computed from all_boxes directly; with write_results the
+        detections are also written down as results files (e.g. for the devkit).
+        num_workers processes evaluate the classes in parallel.
         """
-        # write down the detection results
-        self._write_weishi_results_file(all_boxes)
-        # after getting the result file, do evaluation and store in output_dir
-        aps, map = self._do_python_eval(output_dir)
+        if write_results:
+            # write down the detection results
+            self._write_weishi_results_file(all_boxes)
+        # do evaluation and store in output_dir
+        aps, map = self._do_python_eval(all_boxes, output_dir, num_workers)
         return aps, map
 
     def _get_weishi_results_file_template(self):
@@ -238,7 +317,7 @@ class WeishiDetection(data.Dataset):
                 for im_ind, index in enumerate(self.ids):
                     index = index # not index[1]
                     dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
+                    if len(dets) == 0:
                         continue
                     for k in range(dets.shape[0]):
                         # for a class in an image: {image_id} {score} {xcor} {xcor} {ycor} {ycor}
@@ -247,7 +326,7 @@ class WeishiDetection(data.Dataset):
                                        dets[k, 0] + 1, dets[k, 1] + 1,
                                        dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def _do_python_eval(self, output_dir='output'):
+    def _do_python_eval(self, all_boxes, output_dir='output', num_workers=0):
         rootpath = self.root
         cachedir = os.path.join(self.root, 'annotations_cache')
         aps = []
@@ -256,15 +335,13 @@ class WeishiDetection(data.Dataset):
         print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if output_dir is not None and not os.path.isdir(output_dir):
             os.mkdir(output_dir)
-        for i, cls in enumerate(WEISHI_CLASSES):
-
-            if cls == '__background__':
-                continue
-
-            filename = self._get_weishi_results_file_template().format(cls)
-            # self is dataset
-            rec, prec, ap = weishi_eval(filename, self, \
-                                        cls, cachedir, ovthresh=0.5, use_07_metric=use_07_metric)
+        # annotations are loaded once for all the classes
+        gt_index = load_gt_index(self, cachedir)
+        classes = [(i, cls) for i, cls in enumerate(WEISHI_CLASSES) if cls != '__background__']
+        # the classes are evaluated in parallel by num_workers processes
+        tasks = [(all_boxes[i], gt_index, cls, 0.5, use_07_metric) for i, cls in classes]
+        results = map_classes(voc_eval_dets, tasks, num_workers)
+        for (i, cls), (rec, prec, ap) in zip(classes, results):
             # AP = AVG(Precision for each of 11 Recalls's precision)
             aps += [ap]
             print('AP for {} = {:.4f}'.format(cls, ap))
@@ -2,11 +2,11 @@
 # eval tools for WEISHI dataset or other jpg-xml path like dataset
 # --------------------------------
 
-import pickle
 import xml.etree.ElementTree as ET
 
 import numpy as np
 import os
+from .voc_eval import GTIndex, read_dets, eval_class
 
 def parse_rec(filename):
     """ Parse a WEISHI xml file """
@@ -60,6 +60,17 @@ def weishi_ap(rec, prec, use_07_metric=True):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+def load_gt_index(dataset, cachedir):
+    """
+    gt_index = load_gt_index(...)
+    GTIndex of every image of dataset, cached in cachedir
+    """
+    imagenames = dataset.ids# a list of image ids
+    # read list of images
+    with open(dataset.image_xml_path, 'r') as fin:
+        anno_paths = [line.strip().split(' ')[1] for line in fin.readlines()]
+    return GTIndex.load_or_build(cachedir, imagenames, anno_paths, parse_rec)
+
 # for a specific class
 def weishi_eval(detpath,
                 dataset,
@@ -68,116 +79,10 @@ def weishi_eval(detpath,
                 ovthresh=0.5,
                 use_07_metric=True):
     # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl')
-    imagenames = dataset.ids# a list of image ids
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        # read list of images
-        fin = open(dataset.image_xml_path, 'r')
-        for i, line in enumerate(fin.readlines()):
-            line = line.strip()
-            des = line.split(' ')
-            annopath = des[1]
-            imagename = imagenames[i]
-            recs[imagename] = parse_rec(annopath)
-            if i % 100 == 0:
-                print('Reading annotation for {:d}/{:d}'.format(
-                   i + 1, len(imagenames)))
-        # save
-        print('Saving cached annotations to {:s}'.format(cachefile))
-        with open(cachefile, 'wb') as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'rb') as f:
-            recs = pickle.load(f)
-    # recs stores the annots for each images
-    # class_recs stores the gt for a class
-
-    # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    # go through every image
-    for imagename in imagenames:
-        # and extract those objects in this image that are under this designated class
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R]) # the object belongs to this class
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        # for each image, store the bboxs for this class inside this image
-        class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
+    gt_index = load_gt_index(dataset, cachedir)
+    # gt stores the gt for a class
+    gt = gt_index.class_gt(classname)
 
     # read dets
-    detfile = detpath.format(classname)
-    with open(detfile, 'r') as f:
-        lines = f.readlines()
-    if any(lines) == 1:
-
-        splitlines = [x.strip().split(' ') for x in lines] # [[image_id1, confidence1, xmin1, xmax1, ymin1, ymax1], [], [], []...]
-        image_ids = [x[0] for x in splitlines]
-        confidence = np.array([float(x[1]) for x in splitlines])
-        BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
-
-        # sort by confidence
-        sorted_ind = np.argsort(-confidence)
-        sorted_scores = np.sort(-confidence)
-        BB = BB[sorted_ind, :]
-        image_ids = [image_ids[x] for x in sorted_ind]
-
-        # go down dets and mark TPs and FPs
-        nd = len(image_ids)
-        tp = np.zeros(nd)
-        fp = np.zeros(nd)
-        for d in range(nd):
-            R = class_recs[image_ids[d]]
-            bb = BB[d, :].astype(float)
-            ovmax = -np.inf
-            BBGT = R['bbox'].astype(float)
-            if BBGT.size > 0:
-                # compute overlaps
-                # intersection
-                ixmin = np.maximum(BBGT[:, 0], bb[0])
-                iymin = np.maximum(BBGT[:, 1], bb[1])
-                ixmax = np.minimum(BBGT[:, 2], bb[2])
-                iymax = np.minimum(BBGT[:, 3], bb[3])
-                iw = np.maximum(ixmax - ixmin, 0.)# find the vertex of intersected rectangle
-                ih = np.maximum(iymax - iymin, 0.)# find the vertex of intersected rectangle
-                inters = iw * ih
-                uni = ((bb[2] - bb[0]) * (bb[3] - bb[1]) +
-                       (BBGT[:, 2] - BBGT[:, 0]) *
-                       (BBGT[:, 3] - BBGT[:, 1]) - inters)
-                overlaps = inters / uni
-                ovmax = np.max(overlaps)
-                jmax = np.argmax(overlaps)
-
-            if ovmax > ovthresh:
-                if not R['difficult'][jmax]:# ignore difficult
-                    if not R['det'][jmax]: #R['det'][jmax] has NOT already been 1
-                        tp[d] = 1.
-                        R['det'][jmax] = 1
-                    else:
-                        fp[d] = 1. # false positive
-            else:
-                fp[d] = 1. #false positive
-
-        # compute precision recall
-        fp = np.cumsum(fp)# how many 1 in fp array
-        tp = np.cumsum(tp)
-        rec = tp / float(npos)
-        # avoid divide by zero in case the first detection matches a difficult
-        # ground truth
-        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-        ap = weishi_ap(rec, prec, use_07_metric)
-    else:
-        print("Exception: line == 1!")
-        rec = -1.
-        prec = -1.
-        ap = -1.
-
-    return rec, prec, ap
+    image_inds, confidence, BB = read_dets(detpath.format(classname), gt[0])
+    return eval_class(image_inds, confidence, BB, gt, ovthresh, use_07_metric)
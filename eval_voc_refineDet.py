@@ -15,7 +15,7 @@ from torch.autograd import Variable
 
 # for evaluation on refineDet
 from data import * # val_dataset_root, dataset_root
-from layers.box_utils import refine_nms # for detection in test_net for RefineDet
+from utils.evaluation import test_net
 from layers.functions import RefineDetect, PriorBox
 from models.RefineSSD_vgg import build_refine
 import torch.utils.data as data
@@ -54,12 +54,26 @@ parser.add_argument('--confidence_threshold', default=0.01, type=float,
 # 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--pre_nms_top_k', default=None, type=int,
+                    help='Candidates per class kept before nms, all by default')
+parser.add_argument('--global_top_k', default=None, type=int,
+                    help='Candidates per image across all classes kept before nms, all by default')
 parser.add_argument('--cuda', default=True, type=str2bool,
                     help='Use cuda to train model')
 parser.add_argument('--voc_root', default=VOC_ROOT, #XL_ROOT, for VOC_xlab_products dataset
                     help='Location of XL root directory')
 parser.add_argument('--cleanup', default=True, type=str2bool,
                     help='Cleanup and remove results files following eval')
+parser.add_argument('--batch_size', default=16, type=int,
+                    help='Batch size for evaluation')
+parser.add_argument('--num_workers', default=4, type=int,
+                    help='Number of workers used in dataloading')
+parser.add_argument('--image_cache', default=0, type=int,
+                    help='MB of decoded test images kept in memory across evaluations, 0 to disable')
+parser.add_argument('--image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the test images (python -m data.image_store), read instead of the files')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of processes computing the per-class APs, 0 to compute them in the main process')
 
 args = parser.parse_args()
 
@@ -82,98 +96,9 @@ cfg = voc320 #xl320, for VOC_xlab_products dataset
 priorbox = PriorBox(cfg)
 priors = Variable(priorbox.forward(), volatile=True)
 # detector used in test_net for testing
-detector = RefineDetect(cfg['num_classes'], 0, cfg, object_score=0.01)
+detector = RefineDetect(cfg['num_classes'], 0, cfg, object_score=0.01, conf_thresh=args.confidence_threshold,
+                        pre_nms_top_k=args.pre_nms_top_k, global_top_k=args.global_top_k)
 
-# test function for RefineDet
-"""
-    Args:
-        save_folder: the eval results saving folder
-        net: test-type ssd net
-        testset: validation dataset
-        transform: BaseTransform -- required for refineDet testing,
-                   because it pull_image instead of pull_item (this will transform for you)
-        max_per_image/top_k： The Maximum number of box preds to consider
-"""
-def test_net(save_folder, net, detector, priors, cuda,
-             testset, transform, max_per_image=200, thresh=0.05):
-
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-
-    num_images = len(testset)
-    num_classes = cfg['num_classes']
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
-    #file storing output result under output_dir
-    det_file = os.path.join(save_folder, 'detections.pkl')
-
-    for i in range(num_images):
-        img = testset.pull_image(i)
-        im, _a, _b = transform(img) # to use our incomplete BaseTransform
-        im = im.transpose((2, 0, 1))# convert rgb, as extension for our incomplete BaseTransform
-        x = Variable(torch.from_numpy(im).unsqueeze(0),volatile=True)
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        out = net(x=x, test=True)  # forward pass
-        arm_loc, arm_conf, odm_loc, odm_conf = out
-        boxes, scores = detector.forward((odm_loc,odm_conf), priors, (arm_loc,arm_conf))
-        detect_time = _t['im_detect'].toc()
-        boxes = boxes[0]
-        scores = scores[0]
-
-        boxes = boxes.cpu().numpy()
-        scores = scores.cpu().numpy()
-        # scale each detection back up to the image
-        scale = torch.Tensor([img.shape[1], img.shape[0],
-                              img.shape[1], img.shape[0]]).cpu().numpy()
-        boxes *= scale
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in range(1, num_classes): # for every class
-            # for particular class, keep those boxes with score greater than threshold
-            inds = np.where(scores[:, j] > thresh)[0]
-            if len(inds) == 0:
-                all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
-                continue
-            c_bboxes = boxes[inds] #filter by inds
-            c_scores = scores[inds, j] #filter by inds
-            c_dets = np.hstack((c_bboxes, c_scores[:, np.newaxis])).astype(
-                np.float32, copy=False)
-            # nms
-            keep = refine_nms(c_dets, 0.45) #0.45 is nms threshold
-            keep = keep[:50]
-            c_dets = c_dets[keep, :]
-            all_boxes[j][i] = c_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1,num_classes)])
-            # to keep only max_per_image results
-            if len(image_scores) > max_per_image:
-                # get the smallest score for each class for each image if want to keep only max_per_image results
-                image_thresh = np.sort(image_scores)[-max_per_image] # only keep top_k results
-                for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
-        nms_time = _t['misc'].toc()
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s {:.3f}s'.format(i + 1, num_images, detect_time, nms_time))
-
-    #write the detection results into det_file
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
-
-    print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
 
 if __name__ == '__main__':
     # load net
@@ -204,7 +129,8 @@ if __name__ == '__main__':
     # load data
     dataset = VOCDetection(args.voc_root, [('2007', set_type)],
                            BaseTransform(320, cfg['dataset_mean']),
-                           VOCAnnotationTransform())
+                           VOCAnnotationTransform(),
+                           image_cache=args.image_cache << 20, image_store=args.image_store)
 #    dataset = XLDetection(args.voc_root, [set_type], # for VOC_xlab_products dataset
 #                           BaseTransform(320, cfg['dataset_mean']),
 #                           XLAnnotationTransform())
@@ -212,6 +138,8 @@ if __name__ == '__main__':
         net = net.cuda()
         cudnn.benchmark = True
     # evaluation
-    test_net(args.save_folder, net, detector, priors, args.cuda, dataset,
+    test_net(args.save_folder, net, args.cuda, dataset,
              BaseTransform(net.size, cfg['dataset_mean']),
-             args.max_per_image, thresh=args.confidence_threshold) # 320 originally for cfg['min_dim']
+             args.max_per_image, thresh=args.confidence_threshold, # 320 originally for cfg['min_dim']
+             detector=detector, priors=priors, batch_size=args.batch_size,
+             num_workers=args.num_workers, eval_workers=args.eval_workers)
@@ -23,6 +23,7 @@ import torch.nn as nn
 import torch.backends.cudnn as cudnn
 from torch.autograd import Variable
 from data import *
+from utils.evaluation import test_net
 import torch.utils.data as data
 
 from models.SSD_vggres import build_ssd
@@ -62,12 +63,26 @@ parser.add_argument('--confidence_threshold', default=0.01, type=float,
 # 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--pre_nms_top_k', default=None, type=int,
+                    help='Candidates per class kept before nms, max_per_image by default')
+parser.add_argument('--global_top_k', default=None, type=int,
+                    help='Candidates per image across all classes kept before nms, all by default')
 parser.add_argument('--cuda', default=True, type=str2bool,
                     help='Use cuda to train model')
 parser.add_argument('--voc_root', default= VOC_ROOT,# XL_ROOT, for VOC_xlab_products dataset
                     help='Location of XL root directory')
 parser.add_argument('--cleanup', default=True, type=str2bool,
                     help='Cleanup and remove results files following eval')
+parser.add_argument('--batch_size', default=16, type=int,
+                    help='Batch size for evaluation')
+parser.add_argument('--num_workers', default=4, type=int,
+                    help='Number of workers used in dataloading')
+parser.add_argument('--image_cache', default=0, type=int,
+                    help='MB of decoded test images kept in memory across evaluations, 0 to disable')
+parser.add_argument('--image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the test images (python -m data.image_store), read instead of the files')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of processes computing the per-class APs, 0 to compute them in the main process')
 # for resnet backbone
 parser.add_argument("--use_res", dest="use_res", action="store_true")
 parser.set_defaults(use_res=False)
@@ -96,86 +111,22 @@ else:
 set_type = 'test'
 cfg = voc #xl, for VOC_xlab_products dataset
 
-# test function for vggSSD
-"""
-    Args:
-        save_folder: the eval results saving folder
-        net: test-type ssd net
-        dataset: validation dataset
-        transform: BaseTransform - not used here
-"""
-def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=300, thresh=0.05):
-
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-
-    num_images = len(testset)
-    num_classes = cfg['num_classes']
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
-    #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
-    #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
-    det_file = os.path.join(save_folder, 'detections.pkl')
-
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        detections = net(x=x, test=True).data # get the detection results
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1,
-                                                        num_images, detect_time))
-
-    #write the detection results into det_file
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
-
-    print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
 
 if __name__ == '__main__':
     # load net
     num_classes = cfg['num_classes']
     if args.use_res:
-        net = build_ssd('test', cfg, 300, num_classes, base='resnet', max_per_image = args.max_per_image) # initialize SSD (resnet)
+        net = build_ssd('test', cfg, 300, num_classes, base='resnet', max_per_image = args.max_per_image,
+                        pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # initialize SSD (resnet)
     elif args.use_m1:
-        net = build_mssd('test', cfg, 300, num_classes, base='m1', max_per_image = args.max_per_image) # backbone network is m1
+        net = build_mssd('test', cfg, 300, num_classes, base='m1', max_per_image = args.max_per_image,
+                         pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # backbone network is m1
     elif args.use_m2:
-        net = build_mssd('test', cfg, 300, num_classes, base='m2', max_per_image = args.max_per_image) # backbone network is m2
+        net = build_mssd('test', cfg, 300, num_classes, base='m2', max_per_image = args.max_per_image,
+                         pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # backbone network is m2
     else:
-        net = build_ssd('test', cfg, 300, num_classes, base='vgg', max_per_image = args.max_per_image) # initialize SSD (vgg)
+        net = build_ssd('test', cfg, 300, num_classes, base='vgg', max_per_image = args.max_per_image,
+                        pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # initialize SSD (vgg)
     # if you want to eval SSD from original version ssd.pytorch because self.vgg was changed to self.base
     '''
     # load resume SSD network
@@ -201,11 +152,13 @@ if __name__ == '__main__':
 #                           XLAnnotationTransform())
     dataset = VOCDetection(args.voc_root, [('2007', set_type)],
                            BaseTransform(300, cfg['dataset_mean']),
-                           VOCAnnotationTransform())
+                           VOCAnnotationTransform(),
+                           image_cache=args.image_cache << 20, image_store=args.image_store)
     if args.cuda:
         net = net.cuda()
         cudnn.benchmark = True
     # evaluation
     test_net(args.save_folder, net, args.cuda, dataset,
              BaseTransform(net.size, cfg['dataset_mean']), args.max_per_image,
-             thresh=args.confidence_threshold)
+             thresh=args.confidence_threshold, batch_size=args.batch_size,
+             num_workers=args.num_workers, eval_workers=args.eval_workers)
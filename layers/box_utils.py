@@ -11,8 +11,8 @@ def point_form(boxes):
     Return:
         boxes: (tensor) Converted xmin, ymin, xmax, ymax form of boxes.
     """
-    return torch.cat((boxes[:, :2] - boxes[:, 2:]/2,     # xmin, ymin
-                     boxes[:, :2] + boxes[:, 2:]/2), 1)  # xmax, ymax
+    return torch.cat((boxes[..., :2] - boxes[..., 2:]/2,     # xmin, ymin
+                     boxes[..., :2] + boxes[..., 2:]/2), -1)  # xmax, ymax
 
 
 def center_size(boxes):
@@ -23,8 +23,8 @@ def center_size(boxes):
     Return:
         boxes: (tensor) Converted xmin, ymin, xmax, ymax form of boxes.
     """
-    return torch.cat([(boxes[:, 2:] + boxes[:, :2])/2,  # cx, cy
-                     boxes[:, 2:] - boxes[:, :2]], 1)  # w, h
+    return torch.cat([(boxes[..., 2:] + boxes[..., :2])/2,  # cx, cy
+                     boxes[..., 2:] - boxes[..., :2]], -1)  # w, h
 
 
 def intersect(box_a, box_b):
@@ -70,6 +70,29 @@ def jaccard(box_a, box_b):
     return inter / union  # [A,B]
 
 
+def batch_jaccard(box_a, box_b):
+    """Compute the jaccard overlap of two sets of boxes for a whole batch
+    using broadcasting instead of one jaccard() call per image.
+    Args:
+        box_a: (tensor) Ground truth bounding boxes, Shape: [batch,num_objects,4]
+        box_b: (tensor) Prior boxes, Shape: [num_priors,4] shared by the batch,
+            or [batch,num_priors,4] when every image has its own boxes (e.g. ARM refined anchors)
+    Return:
+        jaccard overlap: (tensor) Shape: [batch,num_objects,num_priors]
+    """
+    if box_b.dim() == 2:
+        box_b = box_b.unsqueeze(0)
+    a = box_a.unsqueeze(2)  # [B,A,1,4]
+    b = box_b.unsqueeze(1)  # [B or 1,1,P,4]
+    inter_w = torch.clamp(torch.min(a[..., 2], b[..., 2]) - torch.max(a[..., 0], b[..., 0]), min=0)
+    inter_h = torch.clamp(torch.min(a[..., 3], b[..., 3]) - torch.max(a[..., 1], b[..., 1]), min=0)
+    inter = inter_w * inter_h  # [B,A,P]
+    area_a = (a[..., 2]-a[..., 0]) * (a[..., 3]-a[..., 1])  # [B,A,1]
+    area_b = (b[..., 2]-b[..., 0]) * (b[..., 3]-b[..., 1])  # [B or 1,1,P]
+    union = area_a + area_b - inter
+    return inter / union  # [B,A,P]
+
+
 def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
     """Match each prior box with the ground truth box of the highest jaccard
     overlap, encode the bounding boxes, then return the matched indices
@@ -165,6 +188,109 @@ def refine_match(threshold, truths, priors, variances, labels, loc_t, conf_t, id
     loc_t[idx] = loc    # [num_priors,4] encoded offsets to learn
     conf_t[idx] = conf  # [num_priors] top class label for each prior
 
+def pad_targets(targets):
+    """Stack a list of per-image annotations into one zero padded tensor,
+    so that a whole batch can be matched at once by batch_match().
+    Args:
+        targets: (list of tensor) Ground truth boxes and labels for each image,
+            Shape: [num_objs,5] (last idx is the label).
+    Return:
+        padded: (tensor) Shape: [batch,max_objs,5], rows past num_objs are 0.
+        counts: (tensor) number of objects for each image, Shape: [batch].
+    """
+    num = len(targets)
+    counts = torch.LongTensor([t.size(0) for t in targets])
+    max_objs = max(int(counts.max()), 1) if num > 0 else 1
+    padded = targets[0].new(num, max_objs, 5).zero_()
+    for idx, t in enumerate(targets):
+        if t.size(0) > 0:
+            padded[idx, :t.size(0)] = t
+    return padded, counts.to(padded.device)
+
+def batch_targets(targets):
+    """Padded targets and object counts of a batch, as pad_targets() returns them.
+    Args:
+        targets: (list of tensor) Ground truth boxes and labels for each image,
+            as from detection_collate, or (tuple) the padded targets and counts,
+            as from padded_detection_collate.
+    Return:
+        padded: (tensor) Shape: [batch,max_objs,5], rows past num_objs are 0.
+        counts: (tensor) number of objects for each image, Shape: [batch].
+    """
+    if isinstance(targets, tuple):
+        padded, counts = targets
+        return padded, counts.to(padded.device)
+    return pad_targets([ann.data for ann in targets])
+
+def objects_mask(counts, max_objs):
+    """Turn per-image object counts into the validity mask of padded targets.
+    Args:
+        counts: (tensor) number of objects for each image, Shape: [batch].
+        max_objs: (int) padded size of the object axis.
+    Return:
+        (tensor) Shape: [batch,max_objs], True for real objects, False for padding.
+    """
+    obj_range = torch.arange(max_objs, device=counts.device)
+    return obj_range.unsqueeze(0) < counts.unsqueeze(1)
+
+def batch_match(threshold, truths, priors, variances, labels, valid, arm_loc=None,
+                point_priors=None):
+    """Batched version of match()/refine_match(): match every image of a
+    minibatch in a few tensor ops instead of one python call per image.
+    Each prior is matched with the ground truth box of the highest jaccard
+    overlap, and every ground truth is forced onto its best prior with a
+    single scatter. When two objects share the same best prior, the later one
+    wins, exactly like the sequential loop in match().
+    Args:
+        threshold: (float) The overlap threshold used when matching boxes.
+        truths: (tensor) Padded ground truth boxes, Shape: [batch,max_objs,4]. - point_form
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4]. - center_form
+        variances: (tensor) Variances corresponding to each prior coord,
+            Shape: [num_priors, 4].
+        labels: (tensor) Padded class labels, Shape: [batch,max_objs].
+        valid: (tensor) Validity mask of the padded objects, Shape: [batch,max_objs].
+        arm_loc: (tensor, optional) arm loc data, Shape: [batch,n_priors,4].
+            When given, matching is done against the refined anchors as in refine_match().
+        point_priors: (tensor, optional) priors already in point form, e.g. from
+            PriorBox.forward(point_form=True), so they are not converted again.
+    Return:
+        loc_t: (tensor) encoded location targets, Shape: [batch,num_priors,4].
+        conf_t: (tensor) matched class label for each prior, Shape: [batch,num_priors].
+    """
+    num, max_objs = truths.size(0), truths.size(1)
+    valid = valid.bool()
+    if arm_loc is not None:
+        # [batch,num_priors,4] point-form refined anchors, one set per image
+        match_boxes = decode(arm_loc, priors, variances)
+        encode_priors = center_size(match_boxes)
+    else:
+        match_boxes = point_priors if point_priors is not None else point_form(priors)
+        encode_priors = priors
+    # jaccard index - [batch,num_objs,num_priors], padding can never be the best truth
+    overlaps = batch_jaccard(truths, match_boxes)
+    overlaps.masked_fill_(~valid.unsqueeze(2), -1)
+    num_priors = overlaps.size(2)
+    # [batch,num_objs] best prior for each ground truth
+    best_prior_overlap, best_prior_idx = overlaps.max(2)
+    # [batch,num_priors] best ground truth for each prior
+    best_truth_overlap, best_truth_idx = overlaps.max(1)
+    # an object keeps its best prior unless a later object claims the same one,
+    # so the scatter below has no duplicated index and the result is deterministic
+    same_prior = best_prior_idx.unsqueeze(2) == best_prior_idx.unsqueeze(1)  # [batch,j,k]
+    later = torch.ones(max_objs, max_objs, device=truths.device).triu(1).bool()
+    overridden = (same_prior & later.unsqueeze(0) & valid.unsqueeze(1)).any(2)
+    forced = valid & ~overridden
+    batch_idx, obj_idx = forced.nonzero(as_tuple=True)
+    prior_idx = best_prior_idx[batch_idx, obj_idx]
+    # ensure every gt matches with its prior of max overlap
+    best_truth_overlap[batch_idx, prior_idx] = 2
+    best_truth_idx[batch_idx, prior_idx] = obj_idx
+    matches = truths.gather(1, best_truth_idx.unsqueeze(2).expand(num, num_priors, 4))
+    conf = labels.gather(1, best_truth_idx).long()  # Shape: [batch,num_priors]
+    conf[best_truth_overlap < threshold] = 0  # label as background
+    loc = encode(matches, encode_priors, variances)  # Shape: [batch,num_priors,4]
+    return loc, conf
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -181,14 +307,14 @@ def encode(matched, priors, variances):
     """
 
     # distance between match center and prior's center
-    g_cxcy = (matched[:, :2] + matched[:, 2:])/2 - priors[:, :2]# cx, cy
+    g_cxcy = (matched[..., :2] + matched[..., 2:])/2 - priors[..., :2]# cx, cy
     # encode variance
-    g_cxcy /= (variances[0] * priors[:, 2:])
+    g_cxcy /= (variances[0] * priors[..., 2:])
     # match wh / prior wh
-    g_wh = (matched[:, 2:] - matched[:, :2]) / priors[:, 2:]
+    g_wh = (matched[..., 2:] - matched[..., :2]) / priors[..., 2:]
     g_wh = torch.log(g_wh) / variances[1]
     # return target for smooth_l1_loss
-    return torch.cat([g_cxcy, g_wh], 1)  # [num_priors,4]
+    return torch.cat([g_cxcy, g_wh], -1)  # [num_priors,4]
 
 
 # Adapted from https://github.com/Hakuyume/chainer-ssd
@@ -207,10 +333,10 @@ def decode(loc, priors, variances):
     """
 
     boxes = torch.cat((
-        priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-        priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
+        priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:],
+        priors[..., 2:] * torch.exp(loc[..., 2:] * variances[1])), -1)
+    boxes[..., :2] -= boxes[..., 2:] / 2
+    boxes[..., 2:] += boxes[..., :2]
     return boxes
 
 
@@ -225,6 +351,27 @@ def log_sum_exp(x):
     return torch.log(torch.sum(torch.exp(x-x_max), 1, keepdim=True)) + x_max
 
 
+def hard_negative_mask(loss_c, num_neg):
+    """Pick the num_neg highest confidence losses of every image for hard
+    negative mining, with one topk per row instead of ranking all priors
+    by sorting the loss matrix twice.
+    Args:
+        loss_c: (tensor) confidence loss of every prior, positives already
+            set to 0, Shape: [batch,num_priors].
+        num_neg: (tensor) number of negatives to keep for each image, Shape: [batch,1].
+    Return:
+        (tensor) mask of the selected negatives, Shape: [batch,num_priors].
+    """
+    neg = torch.zeros_like(loss_c, dtype=torch.bool)
+    max_neg = int(num_neg.max())
+    if max_neg == 0:
+        return neg
+    # top max_neg losses of each row in descending order, the first num_neg of them are kept
+    _, loss_idx = loss_c.topk(max_neg, dim=1)
+    rank = torch.arange(max_neg, device=loss_c.device).unsqueeze(0)
+    return neg.scatter_(1, loss_idx, rank < num_neg)
+
+
 # Original author: Francisco Massa:
 # https://github.com/fmassa/object-detection.torch
 # Ported to PyTorch by Max deGroot (02/01/2017)
@@ -294,33 +441,95 @@ def nms(boxes, scores, overlap=0.5, max_per_image=200): # for VOC, top_k = 300,
         idx = idx[IoU.le(overlap)]
     return keep, count
 
-def refine_nms(dets, thresh):
-    """Pure Python NMS baseline."""
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
+def batched_nms(boxes, valid, overlap=0.5):
+    """Apply non-maximum suppression to many independent groups of boxes
+    (e.g. every class of every image) at once with a vectorized IoU matrix.
+    The greedy result of nms() is the unique fixed point of
+        keep[i] = valid[i] and no j < i with keep[j] and IoU(j, i) > overlap,
+    which is reached by repeating that rule over the whole matrix; every pass
+    fixes at least one more box, and in practice only a few passes are needed.
+    Args:
+        boxes: (tensor) The location preds of each group, sorted by descending
+            score inside the group, Shape: [num_groups,num_boxes,4].
+        valid: (tensor) Boxes taking part in nms (e.g. score > conf_thresh),
+            Shape: [num_groups,num_boxes].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+    Return:
+        (tensor) keep mask of the boxes, Shape: [num_groups,num_boxes].
+    """
+    valid = valid.bool()
+    keep = torch.zeros_like(valid)
+    # boxes are sorted, so only the groups with candidates and the longest
+    # run of candidates need the IoU matrix
+    groups = valid.any(1).nonzero(as_tuple=True)[0]
+    if groups.numel() == 0:
+        return keep
+    num_boxes = int(valid.sum(1).max())
+    boxes = boxes[groups, :num_boxes]
+    cand = valid[groups, :num_boxes]
+    # suppress[g, j, i]: higher scored box j would remove box i
+    higher = torch.ones(num_boxes, num_boxes, device=boxes.device).triu(1)
+    suppress = batch_jaccard(boxes, boxes).gt(overlap).float() * higher.unsqueeze(0)
+    suppress *= cand.unsqueeze(2).float()
+    group_keep = cand
+    while True:
+        suppressed = torch.bmm(group_keep.unsqueeze(1).float(), suppress).squeeze(1) > 0
+        new_keep = cand & ~suppressed
+        if torch.equal(new_keep, group_keep):
+            break
+        group_keep = new_keep
+    keep[groups, :num_boxes] = group_keep
+    return keep
+
+def refine_nms(dets, thresh, top_k=None, block_size=256):
+    """NMS over the pre-thresholded detections of one class, with the IoU of
+    a block of candidates against all lower scored ones computed in one numpy
+    call instead of re-slicing the remaining order for every kept box.
+    Returns the same keep list as the pure python NMS baseline.
+    Args:
+        dets: (ndarray) detections of a class, Shape: [num_dets,5] as x1, y1, x2, y2, score.
+        thresh: (float) The overlap thresh for suppressing unnecessary boxes.
+        top_k: (int, optional) stop as soon as top_k boxes are kept, same as keep[:top_k].
+        block_size: (int) number of candidates whose IoU rows are computed together,
+            bounds the memory to block_size x num_dets.
+    Return:
+        keep: (list) indices of the kept detections, in descending score order.
+    """
     scores = dets[:, 4]
+    order = scores.argsort()[::-1]
+    x1 = dets[order, 0]
+    y1 = dets[order, 1]
+    x2 = dets[order, 2]
+    y2 = dets[order, 3]
 
     #areas = (x2 - x1 + 1) * (y2 - y1 + 1)
     areas = (x2 - x1) * (y2 - y1)
-    order = scores.argsort()[::-1]
+    num_dets = order.size
+    suppressed = np.zeros(num_dets, dtype=np.bool_)
 
     keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
+    for start in range(0, num_dets, block_size):
+        rows = np.arange(start, min(start + block_size, num_dets))
+        rows = rows[~suppressed[rows]]
+        if rows.size == 0:
+            continue
+        # IoU of the block against every candidate from the block on (upper-triangular part)
+        xx1 = np.maximum(x1[rows, None], x1[None, start:])
+        yy1 = np.maximum(y1[rows, None], y1[None, start:])
+        xx2 = np.minimum(x2[rows, None], x2[None, start:])
+        yy2 = np.minimum(y2[rows, None], y2[None, start:])
         w = np.maximum(0.0, xx2 - xx1 + 1)
         h = np.maximum(0.0, yy2 - yy1 + 1)
         inter = w * h
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-
-        inds = np.where(ovr <= thresh)[0]
-        order = order[inds + 1]
+        ovr = inter / (areas[rows, None] + areas[None, start:] - inter)
+        # same test as the baseline: a box survives only if ovr <= thresh
+        over = ~(ovr <= thresh)
+        for r, i in enumerate(rows):
+            if suppressed[i]:
+                continue
+            keep.append(order[i])
+            if top_k is not None and len(keep) >= top_k:
+                return keep
+            suppressed[i + 1:] |= over[r, i + 1 - start:]
 
     return keep
@@ -1,6 +1,6 @@
 import torch
 from torch.autograd import Function
-from ..box_utils import decode, nms
+from ..box_utils import decode, batched_nms
 
 
 class Detect(Function):
@@ -10,10 +10,14 @@ class Detect(Function):
     scores and threshold to a top_k/max_per_image number of output predictions for both
     confidence score and locations.
     """
-    def __init__(self, num_classes, bkg_label, cfg, max_per_image, conf_thresh, nms_thresh):
+    def __init__(self, num_classes, bkg_label, cfg, max_per_image, conf_thresh, nms_thresh,
+                 pre_nms_top_k=None, global_top_k=None):
         self.num_classes = num_classes
         self.background_label = bkg_label
         self.max_per_image = max_per_image
+        # Candidates kept before nms: per class (max_per_image by default) and across all classes (off by default)
+        self.pre_nms_top_k = pre_nms_top_k or max_per_image
+        self.global_top_k = global_top_k
         # Parameters used in nms.
         self.nms_thresh = nms_thresh
         if nms_thresh <= 0:
@@ -33,39 +37,39 @@ class Detect(Function):
         """
         num = loc_data.size(0)  # batch size
         num_priors = prior_data.size(0)
+        num_fg = self.num_classes - 1 # skip the background class
         # top_k is 200 by default, num is 1 when testing because image input one by one
         output = torch.zeros(num, self.num_classes, self.max_per_image, 5)
         # for each sample, every prior box will have #num_classes conf. scores for it
         conf_preds = conf_data.view(num, num_priors,
                                     self.num_classes).transpose(2, 1)
-        # Decode predictions into bboxes based on loc_data(offsets) and prior_data
-        for i in range(num): # for each batch
-            decoded_boxes = decode(loc_data[i], prior_data, self.variance)
-            # For each class, perform nms to get bbox for this class
-            conf_scores = conf_preds[i].clone() # conf_scores = (num_classes, num_priors)
-
-            for cl in range(1, self.num_classes):
-                # for particular class, keep those boxes with score greater than threshold
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                # scores are those higher than threshold
-                scores = conf_scores[cl][c_mask]
-                # for this class, no object of this class exists in this image, because all scores < threshold
-                if scores.dim() == 0:
-                    continue
-                #if scores.size(0) == 0:
-                #    continue
-                l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
-                #step 1. remaining boxes for reasonable classes's objects, boxes being kept after conf_thresh
-                boxes = decoded_boxes[l_mask].view(-1, 4)
-                #step 2. use NMS to remove redundant boxes bounding the same class's object
-                # idx of highest scoring and non-overlapping boxes per class
-                ids, count = nms(boxes, scores, self.nms_thresh, self.max_per_image)
-                output[i, cl, :count] = \
-                    torch.cat((scores[ids[:count]].unsqueeze(1),
-                               boxes[ids[:count]]), 1)
-        flt = output.contiguous().view(num, -1, 5)
-        _, idx = flt[:, :, 0].sort(1, descending=True)
-        _, rank = idx.sort(1)
-        flt[(rank < self.max_per_image).unsqueeze(-1).expand_as(flt)].fill_(0) # this code has no effect
-        return output # before
-        #return flt # after
+        # nms only considers the pre_nms_top_k highest scores of a class,
+        # so take them for every class of every image at once: [num, num_fg, top_k], sorted
+        top_k = min(self.pre_nms_top_k, num_priors)
+        scores, idx = conf_preds[:, 1:].topk(top_k, dim=2)
+        # for particular class, keep those boxes with score greater than threshold
+        valid = scores.gt(self.conf_thresh)
+        if self.global_top_k and self.global_top_k < num_fg * top_k:
+            # only the global_top_k best candidates of an image across all classes go on to nms
+            _, global_idx = scores.masked_fill(~valid, 0).view(num, -1).topk(self.global_top_k, dim=1)
+            in_global = torch.zeros_like(valid).view(num, -1).scatter_(1, global_idx, True)
+            valid &= in_global.view_as(valid)
+        # Decode only the candidates that passed the filters into bboxes based on loc_data(offsets) and prior_data,
+        # the other slots are never kept by nms and stay zero
+        boxes = scores.new_zeros(num, num_fg, top_k, 4)
+        img_idx, cls_idx, cand_idx = valid.nonzero(as_tuple=True)
+        prior_idx = idx[img_idx, cls_idx, cand_idx]
+        boxes[img_idx, cls_idx, cand_idx] = decode(loc_data.view(num, num_priors, 4)[img_idx, prior_idx],
+                                                   prior_data[prior_idx], self.variance)
+        # use NMS to remove redundant boxes bounding the same class's object, all groups together
+        keep = batched_nms(boxes.view(-1, top_k, 4), valid.view(-1, top_k),
+                           self.nms_thresh).view(num, num_fg, top_k)
+        # move the kept detections to the front of their class, in descending score order,
+        # the suppressed ones and those past max_per_image go to an extra dump slot which is dropped
+        dets = torch.cat((scores.unsqueeze(3), boxes), 3)
+        slot = keep.long().cumsum(2) - 1
+        slot[~keep | slot.ge(self.max_per_image)] = self.max_per_image
+        packed = dets.new_zeros(num, num_fg, self.max_per_image + 1, 5).scatter_(
+            2, slot.unsqueeze(3).expand(num, num_fg, top_k, 5), dets)
+        output[:, 1:] = packed[:, :, :self.max_per_image]
+        return output
@@ -1,7 +1,11 @@
 from __future__ import division
 from math import sqrt as sqrt
-from itertools import product as product
 import torch
+from ..box_utils import point_form as to_point_form
+
+# priors only depend on a few cfg fields, so every model / script built from
+# the same cfg shares them: key -> (center-offset form, point form), on cpu
+_PRIOR_CACHE = {}
 
 # choosing scales and aspect_ratios for default boxes here
 # create default boxes
@@ -26,36 +30,63 @@ class PriorBox(object):
             if v <= 0:
                 raise ValueError('Variances must be greater than 0')
 
-    def forward(self):
+    def cache_key(self):
+        """The prior-relevant cfg fields, as a hashable key."""
+        return (self.image_size, tuple(self.feature_maps), tuple(self.steps),
+                tuple(self.min_sizes), tuple(self.max_sizes or ()),
+                tuple(tuple(ar) for ar in self.aspect_ratios), bool(self.clip))
+
+    def forward(self, point_form=False):
+        """Return the priors of this cfg, built once per process.
+        Args:
+            point_form: (bool) return (xmin, ymin, xmax, ymax) instead of (cx, cy, w, h)
+        Return:
+            (tensor) prior boxes, Shape: [num_priors,4], of the default tensor type
+        """
+        key = self.cache_key()
+        if key not in _PRIOR_CACHE:
+            center = self._build()
+            _PRIOR_CACHE[key] = (center, to_point_form(center))
+        output = _PRIOR_CACHE[key][1 if point_form else 0]
+        # follow the default tensor type (e.g. cuda), and never hand out the cached tensor itself
+        default_type = torch.Tensor().type()
+        if output.type() != default_type:
+            return output.type(default_type)
+        return output.clone()
+
+    def _build(self):
         mean = []
         for k, f in enumerate(self.feature_maps):# use k feature map for prediction
-            # per feature map location
-            for i, j in product(range(f), repeat=2):#nested loop with (A, A) where A in range(f)
-                f_k = self.image_size / self.steps[k] #size of k-th square feature map
-                # unit center x,y
-                cx = (j + 0.5) / f_k
-                cy = (i + 0.5) / f_k
-
-                # aspect_ratio: 1
-                # rel size: min_size
-                # when k = 1, s_k = s_min
-                s_k = self.min_sizes[k]/self.image_size # this is s_min i.e. min scale in fact
-                mean += [cx, cy, s_k, s_k]# because aspect_ratio is 1, so width = height
-
-                # aspect_ratio: 1
-                # rel size: sqrt(s_k * s_(k+1))
-                # when k = m, s_k = s_max
-                if self.max_sizes:
-                    s_k_prime = sqrt(s_k * (self.max_sizes[k]/self.image_size)) # this is s_max i.e. max scale in fact
-                    mean += [cx, cy, s_k_prime, s_k_prime]# because aspect_ratio is 1, so width = height
-
-                # rest of aspect ratios other than 1 and m, which means 2 ~ m-1
-                for ar in self.aspect_ratios[k]:
-                    mean += [cx, cy, s_k*sqrt(ar), s_k/sqrt(ar)]
-                    mean += [cx, cy, s_k/sqrt(ar), s_k*sqrt(ar)]
-        # back to torch land
-        # 6 default boxes (there are 6 [] in mean)
-        output = torch.Tensor(mean).view(-1, 4)
+            f_k = self.image_size / self.steps[k] #size of k-th square feature map
+            # unit center x,y of every location, on a (f, f) meshgrid in the
+            # row-major order of product(range(f), repeat=2)
+            centers = (torch.arange(f, dtype=torch.float64) + 0.5) / f_k
+            cx = centers.view(1, f).expand(f, f).reshape(-1)
+            cy = centers.view(f, 1).expand(f, f).reshape(-1)
+
+            # aspect_ratio: 1
+            # rel size: min_size
+            # when k = 1, s_k = s_min
+            s_k = self.min_sizes[k]/self.image_size # this is s_min i.e. min scale in fact
+            sizes = [(s_k, s_k)]# because aspect_ratio is 1, so width = height
+
+            # aspect_ratio: 1
+            # rel size: sqrt(s_k * s_(k+1))
+            # when k = m, s_k = s_max
+            if self.max_sizes:
+                s_k_prime = sqrt(s_k * (self.max_sizes[k]/self.image_size)) # this is s_max i.e. max scale in fact
+                sizes += [(s_k_prime, s_k_prime)]# because aspect_ratio is 1, so width = height
+
+            # rest of aspect ratios other than 1 and m, which means 2 ~ m-1
+            for ar in self.aspect_ratios[k]:
+                sizes += [(s_k*sqrt(ar), s_k/sqrt(ar))]
+                sizes += [(s_k/sqrt(ar), s_k*sqrt(ar))]
+            # [f*f, len(sizes), 4]: every size at every location
+            wh = torch.tensor(sizes, dtype=torch.float64)
+            loc_centers = torch.stack((cx, cy), 1).unsqueeze(1).expand(f * f, len(sizes), 2)
+            mean.append(torch.cat((loc_centers, wh.unsqueeze(0).expand(f * f, len(sizes), 2)), 2).reshape(-1, 4))
+        # back to float
+        output = torch.cat(mean, 0).float()
         if self.clip:
             output.clamp_(max=1, min=0)
         return output
@@ -11,13 +11,22 @@ class RefineDetect(Function):
     apply non-maximum suppression to location predictions based on conf
     scores and threshold to a top_k number of output predictions for both
     confidence score and locations.
+
+    With conf_thresh, pre_nms_top_k (per class) and/or global_top_k (across
+    all classes of an image), only the priors holding a surviving candidate
+    are decoded and returned, and the scores of the other (prior, class) pairs
+    are zeroed, so the thresholding and nms in test_net only see those candidates.
+    Anchors rejected by negative anchor filtering (object_score) are never decoded.
     """
 
-    def __init__(self, num_classes, bkg_label, cfg, object_score=0):
+    def __init__(self, num_classes, bkg_label, cfg, object_score=0, conf_thresh=None,
+                 pre_nms_top_k=None, global_top_k=None):
         self.num_classes = num_classes
         self.background_label = bkg_label
         self.object_score = object_score
-        # self.thresh = thresh
+        self.thresh = conf_thresh
+        self.pre_nms_top_k = pre_nms_top_k
+        self.global_top_k = global_top_k
 
         # Parameters used in nms.
         self.variance = cfg['variance']
@@ -31,6 +40,9 @@ class RefineDetect(Function):
                 Shape: [batch*num_priors,num_classes]
             prior_data: (tensor) Prior boxes and variances from priorbox layers
                 Shape: [1,num_priors,4]
+        Return:
+            boxes: decoded boxes, Shape: [batch,num_priors,4], or [batch,num_selected,4] with pre-selection
+            scores: class scores, Shape: [batch,num_priors,num_classes], or [batch,num_selected,num_classes]
         """
 
         loc, conf = predictions
@@ -38,6 +50,9 @@ class RefineDetect(Function):
         conf_data = conf.data
         prior_data = prior.data
         num = loc_data.size(0)  # batch size
+        self.num_priors = prior_data.size(0)
+        conf_preds = conf_data.view(num, self.num_priors, self.num_classes)
+        object_index = None
         if arm_data:
             arm_loc, arm_conf = arm_data
             arm_loc_data = arm_loc.data
@@ -45,38 +60,62 @@ class RefineDetect(Function):
             arm_object_conf = arm_conf_data[:, 1:]
             no_object_index = arm_object_conf <= self.object_score
             conf_data[no_object_index.expand_as(conf_data)] = 0
+            object_index = ~no_object_index.view(num, self.num_priors)
+
+        if self.thresh is not None or self.pre_nms_top_k or self.global_top_k:
+            return self._forward_selected(loc_data, conf_preds, prior_data,
+                                          arm_loc_data if arm_data else None)
 
-        self.num_priors = prior_data.size(0)
         self.boxes = torch.zeros(num, self.num_priors, 4)
         self.scores = torch.zeros(num, self.num_priors, self.num_classes)
-
-        if num == 1:
-            # size batch x num_classes x num_priors
-            conf_preds = conf_data.unsqueeze(0)
-
-        else:
-            conf_preds = conf_data.view(num, self.num_priors,
-                                        self.num_classes)
-            self.boxes.expand(num, self.num_priors, 4)
-            self.scores.expand(num, self.num_priors, self.num_classes)
         # Decode predictions into bboxes.
         for i in range(num):
             if arm_data:
-                default = decode(arm_loc_data[i], prior_data, self.variance)
+                # anchors rejected by the arm have zero scores, skip both of their decodes
+                idx = object_index[i].nonzero().squeeze(1)
+                default = decode(arm_loc_data[i][idx], prior_data[idx], self.variance)
                 default = center_size(default)
+                self.boxes[i][idx] = decode(loc_data[i][idx], default, self.variance)
             else:
-                default = prior_data
-            decoded_boxes = decode(loc_data[i], default, self.variance)
-            # For each class, perform nms
-            conf_scores = conf_preds[i].clone()
-            '''
-            c_mask = conf_scores.gt(self.thresh)
-            decoded_boxes = decoded_boxes[c_mask]
-            conf_scores = conf_scores[c_mask]
-            '''
+                self.boxes[i] = decode(loc_data[i], prior_data, self.variance)
+            # For each class, perform nms (in test_net)
+            self.scores[i] = conf_preds[i]
 
-            # after decoded
-            self.boxes[i] = decoded_boxes
-            self.scores[i] = conf_scores
+        return self.boxes, self.scores
+
+    def _forward_selected(self, loc_data, conf_preds, prior_data, arm_loc_data=None):
+        """Pre-select the nms candidates by threshold and topk, then decode only their priors.
+        Images of a batch keep different numbers of priors, the rows past
+        that number are padded with zero boxes and zero scores.
+        """
+        num = loc_data.size(0)
+        fg_scores = conf_preds[:, :, 1:] # skip the background class
+        # [num, num_priors, num_classes-1] mask of the (prior, class) pairs going on to nms,
+        # the scores of anchors rejected by the arm are zero so they never pass
+        selected = fg_scores.gt(self.thresh or 0)
+        if self.pre_nms_top_k and self.pre_nms_top_k < self.num_priors:
+            _, top_idx = fg_scores.topk(self.pre_nms_top_k, dim=1)
+            in_top = torch.zeros_like(selected).scatter_(1, top_idx, True)
+            selected &= in_top
+        if self.global_top_k and self.global_top_k < selected[0].numel():
+            _, global_idx = fg_scores.masked_fill(~selected, 0).view(num, -1).topk(self.global_top_k, dim=1)
+            in_global = torch.zeros_like(selected).view(num, -1).scatter_(1, global_idx, True)
+            selected &= in_global.view_as(selected)
+        selected_priors = selected.any(2)
+        num_selected = int(selected_priors.sum(1).max())
+
+        self.boxes = torch.zeros(num, num_selected, 4)
+        self.scores = torch.zeros(num, num_selected, self.num_classes)
+        for i in range(num):
+            idx = selected_priors[i].nonzero().squeeze(1)
+            if idx.numel() == 0:
+                continue
+            priors = prior_data[idx]
+            if arm_loc_data is not None:
+                default = center_size(decode(arm_loc_data[i][idx], priors, self.variance))
+            else:
+                default = priors
+            self.boxes[i, :idx.numel()] = decode(loc_data[i][idx], default, self.variance)
+            self.scores[i, :idx.numel(), 1:] = fg_scores[i][idx] * selected[i][idx].float()
 
         return self.boxes, self.scores
@@ -4,7 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from data import coco as cfg
-from ..box_utils import match, log_sum_exp
+from ..box_utils import batch_match, batch_targets, objects_mask, log_sum_exp, hard_negative_mask
 
 #loss function
 class MultiBoxLoss(nn.Module):
@@ -54,8 +54,10 @@ class MultiBoxLoss(nn.Module):
                 loc shape: torch.size(batch_size,num_priors,4)
                 priors shape: torch.size(num_priors,4)
 
-            targets (tensor): Ground truth boxes and labels for a batch,
-                shape: [batch_size,num_objs,5] (last idx is the label).
+            targets (list of tensor): Ground truth boxes and labels for a batch,
+                shape: [num_objs,5] per image (last idx is the label),
+                or (tuple) the padded targets, shape: [batch_size,max_objs,5],
+                and the number of objects of every image, as from padded_detection_collate.
         """
         loc_data, conf_data, priors = predictions
         num = loc_data.size(0)#batch size
@@ -63,15 +65,11 @@ class MultiBoxLoss(nn.Module):
         num_priors = (priors.size(0))
         num_classes = self.num_classes
 
-        # match priors (default boxes) and ground truth boxes
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.LongTensor(num, num_priors)
-        for idx in range(num):
-            truths = targets[idx][:, :-1].data
-            labels = targets[idx][:, -1].data
-            defaults = priors.data
-            match(self.threshold, truths, defaults, self.variance, labels,
-                  loc_t, conf_t, idx)
+        # match priors (default boxes) and ground truth boxes of the whole batch at once
+        padded, num_objs = batch_targets(targets)
+        valid = objects_mask(num_objs, padded.size(1))
+        loc_t, conf_t = batch_match(self.threshold, padded[:, :, :-1], priors.data,
+                                    self.variance, padded[:, :, -1], valid)
         if self.use_gpu:
             loc_t = loc_t.cuda()
             conf_t = conf_t.cuda()
@@ -93,15 +91,12 @@ class MultiBoxLoss(nn.Module):
         loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1, 1))
 
         # Hard Negative Mining
-        loss_c[pos] = 0  # filter out pos boxes for now
-        #loss_c[pos.view(-1)] = 0  # filter out pos boxes for now
-        loss_c = loss_c.view(num, -1) #resize
-        _, loss_idx = loss_c.sort(1, descending=True)
-        _, idx_rank = loss_idx.sort(1)
+        loss_c = loss_c.data.view(num, -1) #resize
+        loss_c[pos.data] = 0  # filter out pos boxes for now
         num_pos = pos.long().sum(1, keepdim=True)
         num_neg = torch.clamp(self.negpos_ratio*num_pos, max=pos.size(1)-1)
-        #all pos are kept, only neg with rank > threshold are kept
-        neg = idx_rank < num_neg.expand_as(idx_rank) #those > idx_rank is 1, others are 0
+        #all pos are kept, only the num_neg negatives with the highest loss are kept
+        neg = hard_negative_mask(loss_c, num_neg.data)
 
         # Confidence Loss Including Positive and Negative Examples
         pos_idx = pos.unsqueeze(2).expand_as(conf_data)
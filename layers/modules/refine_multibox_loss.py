@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from ..box_utils import match, refine_match, log_sum_exp, decode
+from ..box_utils import batch_match, batch_targets, objects_mask, log_sum_exp, hard_negative_mask
 
 from data import coco as cfg # TODO: for self.variance, need to udpate for different dataset
 
@@ -45,7 +45,7 @@ class RefineMultiBoxLoss(nn.Module):
         self.object_score = object_score
         self.variance = [0.1,0.2]
 
-    def forward(self, odm_data, priors, targets, arm_data = None, filter_object = False):
+    def forward(self, odm_data, priors, targets, arm_data = None, filter_object = False, point_priors = None):
         """Multibox Loss for RefineSSD
         Args:
             odm_data (tuple): A tuple containing loc data, conf data from RefineSSD net
@@ -55,12 +55,17 @@ class RefineMultiBoxLoss(nn.Module):
             priors: prior boxes from SSD net
                 shape: num_priors, 4
 
-            targets (tensor): Ground truth boxes and labels for a batch,
-                shape: [batch_size,num_objs,5] (last idx is the label).
+            targets (list of tensor): Ground truth boxes and labels for a batch,
+                shape: [num_objs,5] per image (last idx is the label),
+                or (tuple) the padded targets, shape: [batch_size,max_objs,5],
+                and the number of objects of every image, as from padded_detection_collate.
 
             arm_data (tuple): arm branch containing arm_loc and arm_conf
 
             filter_object: whether filter out the prediction according to the arm conf score
+
+            point_priors: priors in point form (PriorBox.forward(point_form=True)),
+                reused for matching instead of converting priors on every call
         """
 
         loc_data, conf_data = odm_data
@@ -72,23 +77,18 @@ class RefineMultiBoxLoss(nn.Module):
         num = loc_data.size(0) #batch size
         num_priors = (priors.size(0))
 
-        # match priors (default boxes) and ground truth boxes
-        # loc and conf results after matching will store in following two Tensor
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.LongTensor(num, num_priors)# top label for each prior
-        for idx in range(num): # for each image
-            truths = targets[idx][:,:-1].data
-            labels = targets[idx][:,-1].data
-            #for object detection
-            if self.num_classes == 2:
-                labels = labels > 0
-            if arm_data:
-                #match and calculate loc&conf based on arm output
-                refine_match(self.threshold, truths, priors, self.variance, labels,
-                             loc_t, conf_t, idx, arm_loc[idx].data)
-            else:
-                match(self.threshold, truths, priors, self.variance, labels,
-                      loc_t, conf_t, idx)
+        # match priors (default boxes) and ground truth boxes of the whole batch at once
+        padded, num_objs = batch_targets(targets)
+        valid = objects_mask(num_objs, padded.size(1))
+        truths = padded[:,:,:-1]
+        labels = padded[:,:,-1]
+        #for object detection
+        if self.num_classes == 2:
+            labels = (labels > 0).float()
+        #match and calculate loc&conf based on arm output
+        loc_t, conf_t = batch_match(self.threshold, truths, priors, self.variance, labels, valid,
+                                    arm_loc.data if arm_data else None,
+                                    point_priors.data if point_priors is not None else None)
         if self.use_gpu:
             loc_t = loc_t.cuda()
             conf_t = conf_t.cuda()
@@ -121,13 +121,12 @@ class RefineMultiBoxLoss(nn.Module):
         loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1,1))# get the score indicated by the list named conf_t
 
         # Hard Negative Mining
-        loss_c[pos] = 0 # filter out pos boxes for now
-        loss_c = loss_c.view(num, -1)
-        _,loss_idx = loss_c.sort(1, descending=True)# only sort within every image, so that filter negative based on one image itself
-        _,idx_rank = loss_idx.sort(1)# so that as long as the number itself < num_neg, the loss it represents should be kept
+        loss_c = loss_c.data.view(num, -1)
+        loss_c[pos.data] = 0 # filter out pos boxes for now
         num_pos = pos.long().sum(1,keepdim=True)
         num_neg = torch.clamp(self.negpos_ratio*num_pos, max=pos.size(1)-1)# keep how many neg example
-        neg = idx_rank < num_neg.expand_as(idx_rank)
+        # only rank within every image, so that filter negative based on one image itself
+        neg = hard_negative_mask(loss_c, num_neg.data)
 
         # Confidence Loss Including Positive and Negative Examples
         pos_idx = pos.unsqueeze(2).expand_as(conf_data) # pos_idx only focus on pos samples
@@ -25,9 +25,12 @@ class SSD_MobN1(nn.Module):
         extras: extra layers that feed to multibox loc and conf layers
         head: "multibox head" consists of loc and conf conv layers
         max_per_image: same as top_k, used in Detection, keep 200 detections per image by default
+        pre_nms_top_k: candidates per class kept before nms in Detection, max_per_image by default
+        global_top_k: candidates per image across all classes kept before nms in Detection, off by default
     """
 
-    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image):
+    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image,
+                 pre_nms_top_k=None, global_top_k=None):
         super(SSD_MobN1, self).__init__()
         self.phase = phase
         self.num_classes = num_classes
@@ -48,7 +51,8 @@ class SSD_MobN1(nn.Module):
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45,
+                             pre_nms_top_k, global_top_k)
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -130,7 +134,8 @@ class SSD_MobN2(nn.Module):
     added multibox conv layers.  Each multibox layer branches into
     """
 
-    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image):
+    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image,
+                 pre_nms_top_k=None, global_top_k=None):
         super(SSD_MobN2, self).__init__()
         self.phase = phase
         self.num_classes = num_classes
@@ -151,7 +156,8 @@ class SSD_MobN2(nn.Module):
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45,
+                             pre_nms_top_k, global_top_k)
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -275,7 +281,8 @@ mbox = {
     '512': [],
 }
 
-def build_mssd(phase, cfg, size=300, num_classes=21, base='m1', max_per_image = 200, width_mult = 1.):
+def build_mssd(phase, cfg, size=300, num_classes=21, base='m1', max_per_image = 200, width_mult = 1.,
+               pre_nms_top_k=None, global_top_k=None):
     if phase != "test" and phase != "train":
         print("ERROR: Phase: " + phase + " not recognized")
         return
@@ -288,9 +295,11 @@ def build_mssd(phase, cfg, size=300, num_classes=21, base='m1', max_per_image =
         base_, extras_, head_ = mob2_multibox(mobilenetv2(width_mult),
                                          add_extras(extras[str(size)], int(1280 * width_mult) if width_mult > 1.0 else 1280),
                                          mbox[str(size)], num_classes)
-        return SSD_MobN2(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image)
+        return SSD_MobN2(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image,
+                         pre_nms_top_k, global_top_k)
     else:
         base_, extras_, head_ = mob1_multibox(mobilenetv1(),
                                          add_extras(extras[str(size)], 1024),
                                          mbox[str(size)], num_classes)
-        return SSD_MobN1(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image)
+        return SSD_MobN1(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image,
+                         pre_nms_top_k, global_top_k)
@@ -26,7 +26,8 @@ class SSD_VGG(nn.Module):
         head: "multibox head" consists of loc and conf conv layers
     """
 
-    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image):
+    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image,
+                 pre_nms_top_k=None, global_top_k=None):
         super(SSD_VGG, self).__init__()
         self.phase = phase
         self.num_classes = num_classes
@@ -47,7 +48,8 @@ class SSD_VGG(nn.Module):
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45,
+                             pre_nms_top_k, global_top_k)
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -132,7 +134,8 @@ class SSD_RESNET(nn.Module):
     added multibox conv layers.
     """
 
-    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image):
+    def __init__(self, phase, size, base, extras, head, num_classes, cfg, max_per_image,
+                 pre_nms_top_k=None, global_top_k=None):
         super(SSD_RESNET, self).__init__()
         self.phase = phase
         self.num_classes = num_classes
@@ -153,7 +156,8 @@ class SSD_RESNET(nn.Module):
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45,
+                             pre_nms_top_k, global_top_k)
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -278,7 +282,8 @@ mbox = {
 }
 
 
-def build_ssd(phase, cfg, size=300, num_classes=21, base='vgg', max_per_image = 200):
+def build_ssd(phase, cfg, size=300, num_classes=21, base='vgg', max_per_image = 200,
+              pre_nms_top_k=None, global_top_k=None):
     if phase != "test" and phase != "train":
         print("ERROR: Phase: " + phase + " not recognized")
         return
@@ -291,9 +296,11 @@ def build_ssd(phase, cfg, size=300, num_classes=21, base='vgg', max_per_image =
         base_, extras_, head_ = resnet_multibox(resnet(),
                                          add_extras(extras[str(size)], 2048),
                                          mbox[str(size)], num_classes)
-        return SSD_RESNET(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image)
+        return SSD_RESNET(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image,
+                          pre_nms_top_k, global_top_k)
     else:
         base_, extras_, head_ = vgg_multibox(vgg(),
                                          add_extras(extras[str(size)], 1024),
                                          mbox[str(size)], num_classes)
-        return SSD_VGG(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image)
+        return SSD_VGG(phase, size, base_, extras_, head_, num_classes, cfg, max_per_image,
+                       pre_nms_top_k, global_top_k)
@@ -31,7 +31,7 @@ import os
 from data import * # BaseTransform
 from data import VOC_CLASSES as labelmap
 import torch.utils.data as data
-from layers.box_utils import refine_nms # for detection in test_net for RefineDet
+from utils.evaluation import test_net
 from layers.modules import RefineMultiBoxLoss
 from layers.functions import RefineDetect, PriorBox
 from models.RefineSSD_vgg import build_refine
@@ -48,6 +48,14 @@ parser.add_argument('--cuda', default=True, type=str2bool, help='Use cuda to tra
 #for test_net: 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--image_cache', default=0, type=int,
+                    help='MB of decoded test images kept in memory across evaluations, 0 to disable')
+parser.add_argument('--image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the test images (python -m data.image_store), read instead of the files')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of processes computing the per-class APs, 0 to compute them in the main process')
+parser.add_argument('--anno_index', default=False, type=str2bool,
+                    help='Read the annotations from a pre-parsed AnnotationIndex instead of parsing the XMLs')
 args = parser.parse_args()
 
 cfg = voc320
@@ -55,89 +63,8 @@ cfg = voc320
 # different from normal ssd, where the PriorBox is stored inside SSD object
 priorbox = PriorBox(cfg)
 priors = Variable(priorbox.forward().cuda(), volatile=True) # set the priors to cuda
-detector = RefineDetect(cfg['num_classes'], 0, cfg, object_score=0.01)
-
-def test_net(save_folder, net, detector, priors, cuda,
-             testset, transform, max_per_image=200, thresh=0.05): # max_per_image is same as top_k
-
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-
-    num_images = len(testset)
-    num_classes = len(labelmap)                      # +1 for background
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
-    #file storing output result under output_dir
-    det_file = os.path.join(save_folder, 'detections.pkl')
-
-    for i in range(num_images):
-        img = testset.pull_image(i)
-        im, _a, _b = transform(img) # to use our incomplete BaseTransform
-        im = im.transpose((2, 0, 1))# convert rgb, as extension for our incomplete BaseTransform
-        x = Variable(torch.from_numpy(im).unsqueeze(0),volatile=True)
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        out = net(x=x, test=True)  # forward pass
-        arm_loc, arm_conf, odm_loc, odm_conf = out
-        boxes, scores = detector.forward((odm_loc,odm_conf), priors, (arm_loc,arm_conf))
-        detect_time = _t['im_detect'].toc()
-        boxes = boxes[0]
-        scores = scores[0]
-
-        boxes = boxes.cpu().numpy()
-        scores = scores.cpu().numpy()
-        # scale each detection back up to the image
-        scale = torch.Tensor([img.shape[1], img.shape[0],
-                              img.shape[1], img.shape[0]]).cpu().numpy()
-        boxes *= scale
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in range(1, num_classes): # for every class
-            # for particular class, keep those boxes with score greater than threshold
-            inds = np.where(scores[:, j] > thresh)[0]
-            if len(inds) == 0:
-                all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
-                continue
-            c_bboxes = boxes[inds] #filter by inds
-            c_scores = scores[inds, j] #filter by inds
-            c_dets = np.hstack((c_bboxes, c_scores[:, np.newaxis])).astype(
-                np.float32, copy=False)
-            # nms
-            keep = refine_nms(c_dets, 0.45) #0.45 is nms threshold
-            keep = keep[:50]
-            c_dets = c_dets[keep, :]
-            all_boxes[j][i] = c_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1,num_classes)])
-            # to keep only max_per_image results
-            if len(image_scores) > max_per_image:
-                # get the smallest score for each class for each image if want to keep only max_per_image results
-                image_thresh = np.sort(image_scores)[-max_per_image] # only keep top_k results
-                for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
-        nms_time = _t['misc'].toc()
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s {:.3f}s'.format(i + 1, num_images, detect_time, nms_time))
-
-    #write the detection results into det_file
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
-
-    print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
+detector = RefineDetect(cfg['num_classes'], 0, cfg, object_score=0.01, conf_thresh=0.01)
+
 
 # --------------------------------------------------------------------------- Pruning Part
 class Prunner_refineDet:
@@ -152,9 +79,9 @@ class Prunner_refineDet:
     def test(self):
         self.model.eval()
         # evaluation
-        test_net('prunes/test', self.model, detector, priors, args.cuda, testset,
+        test_net('prunes/test', self.model, args.cuda, testset,
                  BaseTransform(self.model.size, cfg['dataset_mean']),
-                 args.max_per_image, thresh=0.01)
+                 args.max_per_image, thresh=0.01, detector=detector, priors=priors, eval_workers=args.eval_workers)
 
         self.model.train()
 
@@ -213,7 +140,9 @@ if __name__ == '__main__':
     print('Finished loading model!')
 
     testset = VOCDetection(root=args.dataset_root, image_sets=[('2007', 'test')],
-                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']))
+                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']),
+                                image_cache=args.image_cache << 20, use_anno_index=args.anno_index,
+                                image_store=args.image_store)
     arm_criterion = RefineMultiBoxLoss(2, 0.5, True, 0, True, 3, 0.5, False, 0, args.cuda)
     odm_criterion = RefineMultiBoxLoss(cfg['num_classes'], 0.5, True, 0, True, 3, 0.5, False, 0.01, args.cuda)# 0.01 -> 0.99 negative confidence threshold
 
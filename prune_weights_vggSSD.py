@@ -29,6 +29,7 @@ import time
 import pickle
 import os
 from data import *
+from utils.evaluation import test_net
 from data import VOC_CLASSES as labelmap
 import torch.utils.data as data
 from layers.modules import MultiBoxLoss
@@ -46,70 +47,18 @@ parser.add_argument('--cuda', default=True, type=str2bool, help='Use cuda to tra
 #for test_net 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--image_cache', default=0, type=int,
+                    help='MB of decoded test images kept in memory across evaluations, 0 to disable')
+parser.add_argument('--image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the test images (python -m data.image_store), read instead of the files')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of processes computing the per-class APs, 0 to compute them in the main process')
+parser.add_argument('--anno_index', default=False, type=str2bool,
+                    help='Read the annotations from a pre-parsed AnnotationIndex instead of parsing the XMLs')
 args = parser.parse_args()
 
 cfg = voc
 
-def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=200, thresh=0.05):
-
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-
-    num_images = len(testset)
-    num_classes = len(labelmap)                      # +1 for background
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
-    #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
-    #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
-    det_file = os.path.join(save_folder, 'detections.pkl')
-
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        detections = net(x=x, test=True).data # get the detection results
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1, num_images, detect_time))
-
-    #write the detection results into det_file
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
-
-    print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
 
 # --------------------------------------------------------------------------- Pruning Part
 class Prunner_vggSSD:
@@ -125,7 +74,7 @@ class Prunner_vggSSD:
         # evaluation
         test_net('prunes/test', self.model, args.cuda, testset,
                  BaseTransform(self.model.size, cfg['dataset_mean']),
-                 args.max_per_image, thresh=0.01)
+                 args.max_per_image, thresh=0.01, eval_workers=args.eval_workers)
 
         self.model.train()
 
@@ -184,7 +133,9 @@ if __name__ == '__main__':
     print('Finished loading model!')
 
     testset = VOCDetection(root=args.dataset_root, image_sets=[('2007', 'test')],
-                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']))
+                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']),
+                                image_cache=args.image_cache << 20, use_anno_index=args.anno_index,
+                                image_store=args.image_store)
     criterion = MultiBoxLoss(cfg['num_classes'], 0.5, True, 0, True, 3, 0.5, False, args.cuda)
 
     prunner = Prunner_vggSSD(testset, criterion, model)
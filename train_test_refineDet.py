@@ -16,7 +16,7 @@
 '''
 from data import * # val_dataset_root, dataset_root, Timer
 from utils.augmentations import SSDAugmentation
-from layers.box_utils import refine_nms # for detection in test_net for RefineDet
+from utils.evaluation import test_net
 from layers.modules import RefineMultiBoxLoss
 from layers.functions import RefineDetect, PriorBox
 from models.RefineSSD_vgg import build_refine
@@ -54,6 +54,20 @@ parser.add_argument('--start_iter', default=0, type=int,
                     help='Resume training at this iter')
 parser.add_argument('--num_workers', default=4, type=int,
                     help='Number of workers used in dataloading')
+parser.add_argument('--image_cache', default=0, type=int,
+                    help='MB of decoded test images kept in memory across evaluations, 0 to disable')
+parser.add_argument('--image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the test images (python -m data.image_store), read instead of the files')
+parser.add_argument('--train_image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the training images, read instead of the files')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of processes computing the per-class APs, 0 to compute them in the main process')
+parser.add_argument('--anno_index', default=False, type=str2bool,
+                    help='Read the annotations from a pre-parsed AnnotationIndex instead of parsing the XMLs')
+parser.add_argument('--bucket_batches', default=False, type=str2bool,
+                    help='Batch WEISHI/XL training images by size bucket (BucketBatchSampler)')
+parser.add_argument('--reduced_decode', default=False, type=str2bool,
+                    help='Decode large WEISHI/XL training JPEGs at reduced resolution, down to the training size')
 parser.add_argument('--cuda', default=True, type=str2bool,
                     help='Use CUDA to train model')
 parser.add_argument('-we','--warm_epoch', default=1,
@@ -82,6 +96,10 @@ parser.add_argument('--confidence_threshold', default=0.01, type=float,
 # 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--pre_nms_top_k', default=None, type=int,
+                    help='Candidates per class kept before nms, all by default')
+parser.add_argument('--global_top_k', default=None, type=int,
+                    help='Candidates per image across all classes kept before nms, all by default')
 # for WEISHI dataset
 parser.add_argument('--jpg_xml_path', default='',
                     help='Image XML mapping path')
@@ -112,27 +130,38 @@ if args.dataset == 'VOC':
         parser.error('Must specify dataset if specifying dataset_root')
     cfg = voc320 # min_dim inside will ask SSDAugmentation change size of picture
     dataset = VOCDetection(root=args.dataset_root, \
-                           transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                           transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), use_anno_index=args.anno_index, \
+                           image_store=args.train_image_store)
     val_dataset = VOCDetection(root=voc_val_dataset_root, image_sets=[('2007', 'test')], \
-                               transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 320 originally
+                               transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                               image_cache=args.image_cache << 20, use_anno_index=args.anno_index, \
+                               image_store=args.image_store) # 320 originally
 elif args.dataset == 'XL':
     if args.dataset_root != XL_ROOT:
         parser.error('Must specify dataset_root if using XL')
     cfg = xl320
     dataset = XLDetection(root=args.dataset_root, \
-                          transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                          transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), \
+                          image_meta=args.bucket_batches, decode_size=cfg['min_dim'] if args.reduced_decode else None, \
+                          use_anno_index=args.anno_index, image_store=args.train_image_store)
     val_dataset = XLDetection(root=xl_val_dataset_root, image_sets=['test'], \
-                              transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 320 originally
+                              transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                              image_cache=args.image_cache << 20, use_anno_index=args.anno_index, \
+                              image_store=args.image_store) # 320 originally
 elif args.dataset == 'WEISHI':
     if args.jpg_xml_path == '':
         parser.error('Must specify jpg_xml_path if using WEISHI')
     cfg = weishi320
     dataset = WeishiDetection(root=args.dataset_root, \
                               image_xml_path=args.jpg_xml_path, label_file_path=args.label_name_path, \
-                              transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                              transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), \
+                              image_meta=args.bucket_batches, decode_size=cfg['min_dim'] if args.reduced_decode else None, \
+                              use_anno_index=args.anno_index, image_store=args.train_image_store)
     val_dataset = WeishiDetection(root = weishi_val_dataset_root, \
                                   image_xml_path=weishi_val_imgxml_path, label_file_path=args.label_name_path, \
-                                  transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 320 originally
+                                  transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                                  image_cache=args.image_cache << 20, use_anno_index=args.anno_index, \
+                                  image_store=args.image_store) # 320 originally
 elif args.dataset == 'COCO':
     if args.dataset_root == VOC_ROOT:
         if not os.path.exists(COCO_ROOT):
@@ -141,11 +170,13 @@ elif args.dataset == 'COCO':
               "--dataset_root was not specified.")
         args.dataset_root = COCO_ROOT
     cfg = coco # coco320
-    # TODO: evaluation on COCO dataset
     dataset = COCODetection(root=args.dataset_root, \
-                            transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                            transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), \
+                            image_store=args.train_image_store)
     val_dataset = COCODetection(root=coco_val_dataset_root, \
-                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) #320 originally
+                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                                image_cache=args.image_cache << 20, \
+                                image_store=args.image_store) #320 originally
 
 def train():
     # network set-up
@@ -185,8 +216,10 @@ def train():
     # different from normal ssd, where the PriorBox is stored inside SSD object
     priorbox = PriorBox(cfg)
     priors = Variable(priorbox.forward(), volatile=True)
+    point_priors = priorbox.forward(point_form=True) # used by the arm matching, converted once
     # detector used in test_net for testing
-    detector = RefineDetect(cfg['num_classes'], 0, cfg, object_score=0.01)
+    detector = RefineDetect(cfg['num_classes'], 0, cfg, object_score=0.01, conf_thresh=args.confidence_threshold,
+                            pre_nms_top_k=args.pre_nms_top_k, global_top_k=args.global_top_k)
 
     net.train()
     # loss counters
@@ -216,10 +249,17 @@ def train():
     step_index = 0
 
     # training data loader
-    data_loader = data.DataLoader(dataset, args.batch_size,
-                                  num_workers=args.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
-                                  pin_memory=True)
+    if args.bucket_batches:
+        if getattr(dataset, 'image_meta', None) is None:
+            parser.error('bucket_batches requires the WEISHI or XL dataset')
+        data_loader = data.DataLoader(dataset, batch_sampler=BucketBatchSampler(dataset.image_meta.sizes, args.batch_size),
+                                      num_workers=args.num_workers, collate_fn=padded_detection_collate,
+                                      pin_memory=True)
+    else:
+        data_loader = data.DataLoader(dataset, args.batch_size,
+                                      num_workers=args.num_workers,
+                                      shuffle=True, collate_fn=padded_detection_collate,
+                                      pin_memory=True)
     # create batch iterator
     batch_iterator = iter(data_loader)
 #    batch_iterator = None
@@ -249,9 +289,10 @@ def train():
             if args.evaluate == True:
                 # load net
                 net.eval()
-                APs,mAP = test_net(args.eval_folder, net, detector, priors, args.cuda, val_dataset,
+                APs,mAP = test_net(args.eval_folder, net, args.cuda, val_dataset,
                          BaseTransform(net.module.size, cfg['testset_mean']),
-                         args.max_per_image, thresh=args.confidence_threshold) # 320 originally for cfg['min_dim']
+                         args.max_per_image, thresh=args.confidence_threshold, # 320 originally for cfg['min_dim']
+                         detector=detector, priors=priors, num_workers=args.num_workers, eval_workers=args.eval_workers)
                 net.train()
             epoch += 1
 
@@ -262,10 +303,9 @@ def train():
 
         if args.cuda:
             images = Variable(images.cuda())
-            targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
+            targets = tuple(t.cuda(non_blocking=True) for t in targets) # padded targets and counts, pinned by the loader
         else:
             images = Variable(images)
-            targets = [Variable(ann, volatile=True) for ann in targets]
         # forward
         t0 = time.time()
         out = net(images)
@@ -274,7 +314,7 @@ def train():
         optimizer.zero_grad()
         #arm branch loss
         #priors = priors.type(type(images.data)) #convert to same datatype
-        arm_loss_l,arm_loss_c = arm_criterion((arm_loc,arm_conf),priors,targets)
+        arm_loss_l,arm_loss_c = arm_criterion((arm_loc,arm_conf),priors,targets,point_priors=point_priors)
         #odm branch loss
         odm_loss_l, odm_loss_c = odm_criterion((odm_loc,odm_conf),priors,targets,(arm_loc,arm_conf),False)
 
@@ -385,100 +425,6 @@ def update_vis_plot(iteration, loc, conf, window1, window2, update_type,
             update=True
         )
 
-# test function for RefineDet
-"""
-    Args:
-        save_folder: the eval results saving folder
-        net: test-type ssd net
-        testset: validation dataset
-        transform: BaseTransform -- required for refineDet testing,
-                   because it pull_image instead of pull_item (this will transform for you)
-"""
-def test_net(save_folder, net, detector, priors, cuda,
-             testset, transform, max_per_image=200, thresh=0.05): # max_per_image is same as top_k
-
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-
-    num_images = len(testset)
-    num_classes = cfg['num_classes']
-
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
-    #file storing output result under output_dir
-    det_file = os.path.join(save_folder, 'detections.pkl')
-
-    for i in range(num_images):
-        img = testset.pull_image(i)
-        im, _a, _b = transform(img) # to use our incomplete BaseTransform
-        im = im.transpose((2, 0, 1))# convert rgb, as extension for our incomplete BaseTransform
-        x = Variable(torch.from_numpy(im).unsqueeze(0),volatile=True)
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        out = net(x=x, test=True)  # forward pass
-        arm_loc, arm_conf, odm_loc, odm_conf = out
-        boxes, scores = detector.forward((odm_loc,odm_conf), priors, (arm_loc,arm_conf))
-        detect_time = _t['im_detect'].toc()
-        boxes = boxes[0]
-        scores = scores[0]
-
-        boxes = boxes.cpu().numpy()
-        scores = scores.cpu().numpy()
-        # scale each detection back up to the image
-        scale = torch.Tensor([img.shape[1], img.shape[0],
-                              img.shape[1], img.shape[0]]).cpu().numpy()
-        boxes *= scale
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in range(1, num_classes): # for every class
-            # for particular class, keep those boxes with score greater than threshold
-            inds = np.where(scores[:, j] > thresh)[0]
-            if len(inds) == 0:
-                all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
-                continue
-            c_bboxes = boxes[inds] #filter by inds
-            c_scores = scores[inds, j] #filter by inds
-            c_dets = np.hstack((c_bboxes, c_scores[:, np.newaxis])).astype(
-                np.float32, copy=False)
-            # nms
-            # keep, _ = nms(torch.from_numpy(c_bboxes), torch.from_numpy(c_scores), 0.45, top_k) #0.45 is nms threshold
-            keep = refine_nms(c_dets, 0.45) #0.45 is nms threshold
-            keep = keep[:50]
-            c_dets = c_dets[keep, :]
-            all_boxes[j][i] = c_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1,num_classes)])
-            # to keep only max_per_image results
-            if len(image_scores) > max_per_image:
-                # get the smallest score for each class for each image if want to keep only max_per_image results
-                image_thresh = np.sort(image_scores)[-max_per_image] # top_k
-                for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
-        nms_time = _t['misc'].toc()
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s {:.3f}s'.format(i + 1, num_images, detect_time, nms_time))
-
-    #write the detection results into det_file
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
-
-    print('Evaluating detections')
-
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
-    return APs,mAP
 
 if __name__ == '__main__':
     train()
@@ -27,6 +27,7 @@
     Author: xuhuahuang as intern in YouTu 07/2018
 '''
 from data import *
+from utils.evaluation import test_net
 from utils.augmentations import SSDAugmentation
 from layers.modules import MultiBoxLoss
 from models.SSD_vggres import build_ssd
@@ -65,6 +66,20 @@ parser.add_argument('--start_iter', default=0, type=int,
                     help='Resume training at this iter')
 parser.add_argument('--num_workers', default=4, type=int,
                     help='Number of workers used in dataloading')
+parser.add_argument('--image_cache', default=0, type=int,
+                    help='MB of decoded test images kept in memory across evaluations, 0 to disable')
+parser.add_argument('--image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the test images (python -m data.image_store), read instead of the files')
+parser.add_argument('--train_image_store', default=None, type=str,
+                    help='Prefix of an ImageStore packed from the training images, read instead of the files')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of processes computing the per-class APs, 0 to compute them in the main process')
+parser.add_argument('--anno_index', default=False, type=str2bool,
+                    help='Read the annotations from a pre-parsed AnnotationIndex instead of parsing the XMLs')
+parser.add_argument('--bucket_batches', default=False, type=str2bool,
+                    help='Batch WEISHI/XL training images by size bucket (BucketBatchSampler)')
+parser.add_argument('--reduced_decode', default=False, type=str2bool,
+                    help='Decode large WEISHI/XL training JPEGs at reduced resolution, down to the training size')
 parser.add_argument('--cuda', default=True, type=str2bool,
                     help='Use CUDA to train model')
 parser.add_argument('-we','--warm_epoch', default=1,
@@ -93,6 +108,10 @@ parser.add_argument('--confidence_threshold', default=0.01, type=float,
 # 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--pre_nms_top_k', default=None, type=int,
+                    help='Candidates per class kept before nms, max_per_image by default')
+parser.add_argument('--global_top_k', default=None, type=int,
+                    help='Candidates per image across all classes kept before nms, all by default')
 # for WEISHI dataset
 parser.add_argument('--jpg_xml_path', default='', #'/cephfs/share/data/weishi_xh/train_58_0713.txt'
                     help='Image XML mapping path')
@@ -132,27 +151,38 @@ if args.dataset == 'VOC':
         parser.error('Must specify dataset if specifying dataset_root')
     cfg = voc
     dataset = VOCDetection(root=args.dataset_root, \
-                           transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                           transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), use_anno_index=args.anno_index, \
+                           image_store=args.train_image_store)
     val_dataset = VOCDetection(root=voc_val_dataset_root, image_sets=[('2007', 'test')], \
-                               transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 300 originally
+                               transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                               image_cache=args.image_cache << 20, use_anno_index=args.anno_index, \
+                               image_store=args.image_store) # 300 originally
 elif args.dataset == 'XL':
     if args.dataset_root != XL_ROOT:
         parser.error('Must specify dataset_root if using XL')
     cfg = xl
     dataset = XLDetection(root=args.dataset_root, \
-                          transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                          transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), \
+                          image_meta=args.bucket_batches, decode_size=cfg['min_dim'] if args.reduced_decode else None, \
+                          use_anno_index=args.anno_index, image_store=args.train_image_store)
     val_dataset = XLDetection(root=xl_val_dataset_root, image_sets=['test'], \
-                              transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 300 originally
+                              transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                              image_cache=args.image_cache << 20, use_anno_index=args.anno_index, \
+                              image_store=args.image_store) # 300 originally
 elif args.dataset == 'WEISHI':
     if args.jpg_xml_path == '':
         parser.error('Must specify jpg_xml_path if using WEISHI')
     cfg = weishi
     dataset = WeishiDetection(root=args.dataset_root, \
                               image_xml_path=args.jpg_xml_path, label_file_path=args.label_name_path, \
-                              transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                              transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), \
+                              image_meta=args.bucket_batches, decode_size=cfg['min_dim'] if args.reduced_decode else None, \
+                              use_anno_index=args.anno_index, image_store=args.train_image_store)
     val_dataset = WeishiDetection(root = weishi_val_dataset_root, \
                                   image_xml_path=weishi_val_imgxml_path, label_file_path=args.label_name_path, \
-                                  transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 300 originally
+                                  transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                                  image_cache=args.image_cache << 20, use_anno_index=args.anno_index, \
+                                  image_store=args.image_store) # 300 originally
 elif args.dataset == 'COCO':
     if args.dataset_root == VOC_ROOT:
         if not os.path.exists(COCO_ROOT):
@@ -161,22 +191,28 @@ elif args.dataset == 'COCO':
               "--dataset_root was not specified.")
         args.dataset_root = COCO_ROOT
     cfg = coco
-    # TODO: evaluation on COCO dataset
     dataset = COCODetection(root=args.dataset_root, \
-                            transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+                            transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']), \
+                            image_store=args.train_image_store)
     val_dataset = COCODetection(root=coco_val_dataset_root, \
-                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 300 originally
+                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']), \
+                                image_cache=args.image_cache << 20, \
+                                image_store=args.image_store) # 300 originally
 
 def train():
     # network set-up
     if args.use_res:
-        ssd_net = build_ssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='resnet', max_per_image = args.max_per_image) # for resnet
+        ssd_net = build_ssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='resnet', max_per_image = args.max_per_image,
+                            pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # for resnet
     elif args.use_m1:
-        ssd_net = build_mssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='m1', max_per_image = args.max_per_image) # backbone network is m1
+        ssd_net = build_mssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='m1', max_per_image = args.max_per_image,
+                             pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # backbone network is m1
     elif args.use_m2:
-        ssd_net = build_mssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='m2', max_per_image = args.max_per_image) # backbone network is m2
+        ssd_net = build_mssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='m2', max_per_image = args.max_per_image,
+                             pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # backbone network is m2
     else:
-        ssd_net = build_ssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='vgg', max_per_image = args.max_per_image) # backbone network is vgg
+        ssd_net = build_ssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='vgg', max_per_image = args.max_per_image,
+                            pre_nms_top_k = args.pre_nms_top_k, global_top_k = args.global_top_k) # backbone network is vgg
     net = ssd_net
 
     if args.cuda:
@@ -229,10 +265,17 @@ def train():
     step_index = 0
 
     # training data loader
-    data_loader = data.DataLoader(dataset, args.batch_size,
-                                  num_workers=args.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
-                                  pin_memory=True)
+    if args.bucket_batches:
+        if getattr(dataset, 'image_meta', None) is None:
+            parser.error('bucket_batches requires the WEISHI or XL dataset')
+        data_loader = data.DataLoader(dataset, batch_sampler=BucketBatchSampler(dataset.image_meta.sizes, args.batch_size),
+                                      num_workers=args.num_workers, collate_fn=padded_detection_collate,
+                                      pin_memory=True)
+    else:
+        data_loader = data.DataLoader(dataset, args.batch_size,
+                                      num_workers=args.num_workers,
+                                      shuffle=True, collate_fn=padded_detection_collate,
+                                      pin_memory=True)
     # create batch iterator
     batch_iterator = iter(data_loader)
     for iteration in range(args.start_iter, cfg['max_epoch']*epoch_size + 10):
@@ -257,7 +300,8 @@ def train():
                 net.eval()
                 APs,mAP = test_net(args.eval_folder, net, args.cuda, val_dataset,
                          BaseTransform(net.module.size, cfg['testset_mean']),
-                         args.max_per_image, thresh=args.confidence_threshold) # 300 is for cfg['min_dim'] originally
+                         args.max_per_image, thresh=args.confidence_threshold, # 300 is for cfg['min_dim'] originally
+                         num_workers=args.num_workers, eval_workers=args.eval_workers)
                 net.train()
             epoch += 1
 
@@ -268,10 +312,9 @@ def train():
 
         if args.cuda:
             images = Variable(images.cuda())
-            targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
+            targets = tuple(t.cuda(non_blocking=True) for t in targets) # padded targets and counts, pinned by the loader
         else:
             images = Variable(images)
-            targets = [Variable(ann, volatile=True) for ann in targets]
         # forward
         t0 = time.time()
         out = net(images)
@@ -364,78 +407,6 @@ def update_vis_plot(iteration, loc, conf, window1, window2, update_type,
             update=True
         )
 
-# test function for SSD
-"""
-    Args:
-        save_folder: the eval results saving folder
-        net: test-type ssd net
-        dataset: validation dataset
-        transform: BaseTransform - not used here
-        max_per_image/top_k：The Maximum number of box preds to consider
-"""
-def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=200, thresh=0.05):
-
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-
-    num_images = len(testset)
-    num_classes = cfg['num_classes']
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
-    #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
-    #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
-    det_file = os.path.join(save_folder, 'detections.pkl')
-
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        detections = net(x=x, test=True).data # get the detection results
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1,
-                                                        num_images, detect_time)) # nms time is included in detect_time for normal SSD
-
-    #write the detection results into det_file
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
-
-    print('Evaluating detections')
-
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
-    return APs,mAP
 
 if __name__ == '__main__':
     train()
@@ -37,6 +37,26 @@ def jaccard_numpy(box_a, box_b):
     return inter / union  # [A,B]
 
 
+def jaccard_rects(boxes, rects):
+    """Compute the jaccard overlap of every rect with every box.
+    Args:
+        boxes: Multiple bounding boxes, Shape: [num_boxes,4]
+        rects: Multiple bounding boxes, Shape: [num_rects,4]
+    Return:
+        jaccard overlap: Shape: [num_rects, num_boxes]
+    """
+    max_xy = np.minimum(boxes[np.newaxis, :, 2:], rects[:, np.newaxis, 2:])
+    min_xy = np.maximum(boxes[np.newaxis, :, :2], rects[:, np.newaxis, :2])
+    inter = np.clip((max_xy - min_xy), a_min=0, a_max=np.inf)
+    inter = inter[:, :, 0] * inter[:, :, 1]
+    area_boxes = ((boxes[:, 2]-boxes[:, 0]) *
+                  (boxes[:, 3]-boxes[:, 1]))
+    area_rects = ((rects[:, 2]-rects[:, 0]) *
+                  (rects[:, 3]-rects[:, 1]))
+    union = area_boxes[np.newaxis, :] + area_rects[:, np.newaxis] - inter
+    return inter / union
+
+
 class Compose(object):
     """Composes several augmentations together.
     Args:
@@ -114,7 +134,10 @@ class Resize(object):
     def __call__(self, image, boxes=None, labels=None):
         interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_NEAREST, cv2.INTER_LANCZOS4]
         interp_method = interp_methods[random.randint(5)]
-        image = cv2.resize(image, (self.size, self.size), interpolation=interp_method)
+        if isinstance(image, CanvasImage):
+            image = image.resize(self.size, interp_method)
+        else:
+            image = cv2.resize(image, (self.size, self.size), interpolation=interp_method)
         # only change from rightmost and downmost, so won't affect coordinates since it start from top left
         return image, boxes, labels
 
@@ -238,12 +261,15 @@ class RandomSampleCrop(object):
             # randomly sample a patch
             (None, None),
         )
+        self.num_trials = 50
 
     def __call__(self, image, boxes=None, labels=None):
         height, width, _ = image.shape
+        # gt box centers, to keep the boxes whose center is in the sampled patch
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
         while True:
             # randomly choose a mode
-            mode = random.choice(self.sample_options)
+            mode = self.sample_options[random.randint(len(self.sample_options))]
             if mode is None:
                 return image, boxes, labels
 
@@ -253,90 +279,148 @@ class RandomSampleCrop(object):
             if max_iou is None:
                 max_iou = float('inf')
 
-            # max trails (50)
-            for _ in range(50):
-                current_image = image
+            # max trails (50), all candidates drawn and checked at once, the first valid one is kept
+            w = random.uniform(0.3 * width, width, size=self.num_trials)
+            h = random.uniform(0.3 * height, height, size=self.num_trials)
+            left = random.uniform(width - w)
+            top = random.uniform(height - h)
 
-                w = random.uniform(0.3 * width, width)
-                h = random.uniform(0.3 * height, height)
+            # convert to integer rects x1,y1,x2,y2, shape [num_trials, 4]
+            rects = np.stack((left, top, left + w, top + h), axis=1).astype(np.int64)
 
-                # aspect ratio constraint b/t .5 & 2
-                if h / w < 0.5 or h / w > 2:
-                    continue
+            # aspect ratio constraint b/t .5 & 2
+            valid = (h / w >= 0.5) & (h / w <= 2)
 
-                left = random.uniform(width - w)
-                top = random.uniform(height - h)
+            # calculate IoU (jaccard overlap) b/t the cropped and gt boxes, shape [num_trials, num_boxes]
+            overlap = jaccard_rects(boxes, rects)
 
-                # convert to integer rect x1,y1,x2,y2
-                rect = np.array([int(left), int(top), int(left+w), int(top+h)])
+            # is min and max overlap constraint satisfied? if not try again
+            valid &= (overlap.min(axis=1) >= min_iou) & (overlap.max(axis=1) <= max_iou)
 
-                # calculate IoU (jaccard overlap) b/t the cropped and gt boxes
-                overlap = jaccard_numpy(boxes, rect)
+            # mask in the gt boxes whose center is inside the rect, shape [num_trials, num_boxes]
+            masks = ((rects[:, np.newaxis, 0] < centers[:, 0]) & (rects[:, np.newaxis, 1] < centers[:, 1]) &
+                     (rects[:, np.newaxis, 2] > centers[:, 0]) & (rects[:, np.newaxis, 3] > centers[:, 1]))
 
-                # is min and max overlap constraint satisfied? if not try again
-                if overlap.min() < min_iou or max_iou < overlap.max():
-                    continue
+            # have any valid boxes? try again if not
+            valid &= masks.any(axis=1)
+            if not valid.any():
+                continue
+            trial = np.argmax(valid)
+            rect, mask = rects[trial], masks[trial]
 
-                # cut the crop from the image
-                current_image = current_image[rect[1]:rect[3], rect[0]:rect[2],
-                                              :]
+            # cut the crop from the image
+            if isinstance(image, CanvasImage):
+                current_image = image.crop(*rect)
+            else:
+                current_image = image[rect[1]:rect[3], rect[0]:rect[2], :]
 
-                # keep overlap with gt box IF center in sampled patch
-                centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+            # take only matching gt boxes
+            current_boxes = boxes[mask, :].copy()
 
-                # mask in all gt boxes that above and to the left of centers
-                m1 = (rect[0] < centers[:, 0]) * (rect[1] < centers[:, 1])
+            # take only matching gt labels
+            current_labels = labels[mask]
 
-                # mask in all gt boxes that under and to the right of centers
-                m2 = (rect[2] > centers[:, 0]) * (rect[3] > centers[:, 1])
+            # should we use the box left and top corner or the crop's
+            current_boxes[:, :2] = np.maximum(current_boxes[:, :2],
+                                              rect[:2])
+            # adjust to crop (by substracting crop's left,top)
+            current_boxes[:, :2] -= rect[:2]
 
-                # mask in that both m1 and m2 are true
-                mask = m1 * m2
+            current_boxes[:, 2:] = np.minimum(current_boxes[:, 2:],
+                                              rect[2:])
+            # adjust to crop (by substracting crop's left,top)
+            current_boxes[:, 2:] -= rect[:2]
 
-                # have any valid boxes? try again if not
-                if not mask.any():
-                    continue
+            return current_image, current_boxes, current_labels
 
-                # take only matching gt boxes
-                current_boxes = boxes[mask, :].copy()
 
-                # take only matching gt labels
-                current_labels = labels[mask]
-
-                # should we use the box left and top corner or the crop's
-                current_boxes[:, :2] = np.maximum(current_boxes[:, :2],
-                                                  rect[:2])
-                # adjust to crop (by substracting crop's left,top)
-                current_boxes[:, :2] -= rect[:2]
-
-                current_boxes[:, 2:] = np.minimum(current_boxes[:, 2:],
-                                                  rect[2:])
-                # adjust to crop (by substracting crop's left,top)
-                current_boxes[:, 2:] -= rect[:2]
+class CanvasImage(object):
+    """An image placed on a canvas filled with the mean, without allocating the canvas.
+    The geometric transforms of SSDAugmentation compose on it without touching the
+    pixels: Expand returns one, RandomSampleCrop crops it to a view of the image,
+    RandomMirror sets mirrored, and Resize resamples the viewed part of the image
+    once, directly into the size x size output.
+    Args:
+        image: the part of the image on the canvas
+        height, width: size of the canvas
+        left, top: position of image on the canvas
+        mean: value of the canvas pixels outside image
+        mirrored: image is shown horizontally flipped
+    """
 
-                return current_image, current_boxes, current_labels
+    def __init__(self, image, height, width, left, top, mean, mirrored=False):
+        self.image = image
+        self.height = height
+        self.width = width
+        self.left = left
+        self.top = top
+        self.mean = mean
+        self.mirrored = mirrored
+
+    @property
+    def shape(self):
+        return (self.height, self.width, self.image.shape[2])
+
+    def crop(self, x1, y1, x2, y2):
+        """The canvas region [y1:y2, x1:x2], as image[y1:y2, x1:x2] of the full canvas"""
+        x2, y2 = min(x2, self.width), min(y2, self.height)
+        img_h, img_w = self.image.shape[:2]
+        # the part of the shown image inside the region, in shown image coordinates
+        ix1, ix2 = max(x1 - self.left, 0), min(x2 - self.left, img_w)
+        iy1, iy2 = max(y1 - self.top, 0), min(y2 - self.top, img_h)
+        if ix2 <= ix1 or iy2 <= iy1: # only the mean
+            return CanvasImage(self.image[:0, :0], y2 - y1, x2 - x1, 0, 0, self.mean)
+        if self.mirrored: # columns of the stored image
+            ix1, ix2 = img_w - ix2, img_w - ix1
+        return CanvasImage(self.image[iy1:iy2, ix1:ix2], y2 - y1, x2 - x1,
+                           max(self.left - x1, 0), max(self.top - y1, 0), self.mean, self.mirrored)
+
+    def mirror(self):
+        """The horizontally flipped canvas"""
+        return CanvasImage(self.image, self.height, self.width, self.width - self.left - self.image.shape[1],
+                           self.top, self.mean, not self.mirrored)
+
+    def resize(self, size, interpolation=cv2.INTER_LINEAR):
+        """The canvas resized to size x size, only the image part is resampled"""
+        img_h, img_w = self.image.shape[:2]
+        fx, fy = float(size) / self.width, float(size) / self.height
+        x1, x2 = int(round(self.left * fx)), int(round((self.left + img_w) * fx))
+        y1, y2 = int(round(self.top * fy)), int(round((self.top + img_h) * fy))
+        if x2 <= x1 or y2 <= y1: # only the mean
+            patch = None
+        else:
+            # the view of the image is read in place, its rows need not be contiguous
+            patch = cv2.resize(self.image, (x2 - x1, y2 - y1), interpolation=interpolation)
+            if self.mirrored: # flip the resized patch rather than the image
+                patch = cv2.flip(patch, 1)
+        if (x1, y1, x2, y2) == (0, 0, size, size): # no canvas left
+            return patch
+        canvas = np.empty((size, size, self.image.shape[2]), dtype=self.image.dtype)
+        canvas[:, :, :] = self.mean
+        if patch is not None:
+            canvas[y1:y2, x1:x2] = patch
+        return canvas
 
 
 class Expand(object):
+    """Place the image at a random position of a canvas up to 4 times larger, filled with the mean
+    Returns a CanvasImage, also when not expanding, resampled by the following Resize.
+    """
     def __init__(self, mean):
         self.mean = mean
 
     def __call__(self, image, boxes, labels):
         if random.randint(2):
-            return image, boxes, labels
+            height, width, _ = image.shape
+            return CanvasImage(image, height, width, 0, 0, self.mean), boxes, labels
 
         height, width, depth = image.shape
         ratio = random.uniform(1, 4)
         left = random.uniform(0, width*ratio - width)
         top = random.uniform(0, height*ratio - height)
 
-        expand_image = np.zeros(
-            (int(height*ratio), int(width*ratio), depth),
-            dtype=image.dtype)
-        expand_image[:, :, :] = self.mean
-        expand_image[int(top):int(top + height),
-                     int(left):int(left + width)] = image
-        image = expand_image
+        image = CanvasImage(image, int(height*ratio), int(width*ratio),
+                            int(left), int(top), self.mean)
 
         boxes = boxes.copy()
         boxes[:, :2] += (int(left), int(top))
@@ -349,7 +433,10 @@ class RandomMirror(object):
     def __call__(self, image, boxes, classes):
         _, width, _ = image.shape
         if random.randint(2):
-            image = image[:, ::-1]
+            if isinstance(image, CanvasImage):
+                image = image.mirror()
+            else:
+                image = image[:, ::-1]
             boxes = boxes.copy()
             boxes[:, 0::2] = width - boxes[:, 2::-2]
         return image, boxes, classes
@@ -382,27 +469,67 @@ class SwapChannels(object):
 
 
 class PhotometricDistort(object):
-    def __init__(self):
-        self.pd = [
-            RandomContrast(),
-            ConvertColor(transform='HSV'),
-            RandomSaturation(),
-            RandomHue(),
-            ConvertColor(current='HSV', transform='BGR'),
-            RandomContrast()
-        ]
-        self.rand_brightness = RandomBrightness()
-        self.rand_light_noise = RandomLightingNoise()
+    """Random brightness, contrast, saturation, hue and channel order of a uint8 BGR image.
+    The same distortions as RandomBrightness, RandomContrast, RandomSaturation, RandomHue
+    and RandomLightingNoise, fused to stay in uint8: brightness and contrast are applied
+    with one lookup table, saturation and hue with another inside a single HSV round trip,
+    which is skipped when neither is drawn. OpenCV's uint8 HSV keeps the hue in [0, 180),
+    so the hue delta (in degrees) is halved; values saturate at 0 and 255.
+    Args:
+        brightness_delta: max absolute brightness delta
+        contrast (float pair): range of the contrast factor
+        saturation (float pair): range of the saturation factor
+        hue_delta: max absolute hue delta, in degrees
+    """
+    def __init__(self, brightness_delta=32, contrast=(0.5, 1.5), saturation=(0.5, 1.5), hue_delta=18.0):
+        assert 0.0 <= brightness_delta <= 255.0
+        assert contrast[1] >= contrast[0] >= 0, "contrast upper must be >= lower >= 0."
+        assert saturation[1] >= saturation[0] >= 0, "saturation upper must be >= lower >= 0."
+        assert 0.0 <= hue_delta <= 360.0
+        self.brightness_delta = brightness_delta
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue_delta = hue_delta
+        self.perms = RandomLightingNoise().perms
+        self.levels = np.arange(256, dtype=np.float32)
+
+    def _scale_lut(self, alpha, beta=0.0):
+        # uint8 table of x * alpha + beta
+        return np.clip(np.rint(self.levels * alpha + beta), 0, 255).astype(np.uint8)
 
     def __call__(self, image, boxes, labels):
-        im = image.copy()
-        im, boxes, labels = self.rand_brightness(im, boxes, labels)
+        assert image.dtype == np.uint8, "PhotometricDistort expects the uint8 image"
+        alpha, beta = 1.0, 0.0
         if random.randint(2):
-            distort = Compose(self.pd[:-1])
-        else:
-            distort = Compose(self.pd[1:])
-        im, boxes, labels = distort(im, boxes, labels)
-        return self.rand_light_noise(im, boxes, labels)
+            beta = random.uniform(-self.brightness_delta, self.brightness_delta)
+        # contrast before or after the hsv distortions
+        contrast_first = random.randint(2)
+        if contrast_first and random.randint(2):
+            contrast = random.uniform(*self.contrast)
+            alpha, beta = contrast, beta * contrast
+        if alpha != 1.0 or beta != 0.0: # a new image, the input is left untouched
+            image = cv2.LUT(image, self._scale_lut(alpha, beta))
+
+        saturation = hue = None
+        if random.randint(2):
+            saturation = random.uniform(*self.saturation)
+        if random.randint(2):
+            hue = random.uniform(-self.hue_delta, self.hue_delta)
+        if saturation is not None or hue is not None:
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            lut = np.empty((256, 1, 3), dtype=np.uint8)
+            lut[:, 0, 0] = (np.arange(256) + int(round((hue or 0.0) / 2.0))) % 180
+            lut[:, 0, 1] = self._scale_lut(1.0 if saturation is None else saturation)
+            lut[:, 0, 2] = np.arange(256)
+            image = cv2.cvtColor(cv2.LUT(hsv, lut), cv2.COLOR_HSV2BGR)
+
+        if not contrast_first and random.randint(2):
+            image = cv2.LUT(image, self._scale_lut(random.uniform(*self.contrast)))
+
+        if random.randint(2):
+            swap = self.perms[random.randint(len(self.perms))]
+            image = SwapChannels(swap)(image)
+        return image, boxes, labels
 
 #final one - integrate all above
 class SSDAugmentation(object):
@@ -410,8 +537,8 @@ class SSDAugmentation(object):
     def __init__(self, size=300, mean=(104, 117, 123)):
         self.mean = mean
         self.size = size
+        # the geometric transforms run on the uint8 image, converted to float once resized
         self.augment = Compose([
-            ConvertFromInts(),
             ToAbsoluteCoords(),
             PhotometricDistort(),
             Expand(self.mean),
@@ -419,6 +546,7 @@ class SSDAugmentation(object):
             RandomMirror(),
             ToPercentCoords(),
             Resize(self.size),
+            ConvertFromInts(),
             SubtractMeans(self.mean)
         ])
 
@@ -0,0 +1,246 @@
+"""Evaluation loop shared by the train, eval, prune and finetune scripts
+
+test_net() reads the test set through a DataLoader, so decoding and the test
+transform run in worker processes, and feeds the network whole batches. The
+size of every original image travels with the batch to scale the boxes back.
+The raw network outputs go through a bounded queue to post-processing threads
+(decoding, nms, max_per_image, filling all_boxes), so post-processing of one
+batch overlaps the forward pass of the next ones.
+"""
+import os
+import sys
+import pickle
+import threading
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from data import Timer
+from layers.box_utils import refine_nms
+
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+class TestItems(data.Dataset):
+    """Test set items for test_net: (image tensor, height, width)
+
+    Arguments:
+        testset: VOCDetection-like dataset
+        transform (callable, optional): applied to pull_image(), as done for RefineDet;
+            if None pull_item() is used, which applies the testset transform (and BGR -> RGB)
+    """
+
+    def __init__(self, testset, transform=None):
+        self.testset = testset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.testset)
+
+    def __getitem__(self, index):
+        if self.transform is None:
+            im, _, height, width = self.testset.pull_item(index)
+            return im, height, width
+        img = self.testset.pull_image(index)
+        height, width = img.shape[:2]
+        if getattr(self.testset, 'image_store', None) is not None:
+            # raw records may be shrunk, the detections are scaled to the original image
+            height, width, _ = self.testset.image_store.shape(index)
+        im, _a, _b = self.transform(img) # to use our incomplete BaseTransform
+        im = im.transpose((2, 0, 1))# convert rgb, as extension for our incomplete BaseTransform
+        return torch.from_numpy(im), height, width
+
+
+def ssd_detections(detections, all_boxes, i, w, h):
+    """Store the detections of image i, output by the SSD Detect layer
+        detections: numpy array of shape [num_classes, top_k, 5] (score, box)
+    """
+    # skip j = 0, because it's the background class
+    for j in range(1, detections.shape[0]): # for every class
+        dets = detections[j]
+        dets = dets[dets[:, 0] > 0.]
+        if len(dets) == 0:
+            continue
+        boxes = dets[:, 1:] * np.array([w, h, w, h], dtype=dets.dtype)
+        scores = dets[:, 0]
+        cls_dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
+        all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
+
+
+def refine_detections(boxes, scores, all_boxes, i, w, h, max_per_image, thresh):
+    """Threshold, nms and keep the max_per_image best detections of image i, output by RefineDetect
+        boxes: numpy array of shape [num_priors, 4], normalized
+        scores: numpy array of shape [num_priors, num_classes]
+    """
+    # scale each detection back up to the image
+    boxes = boxes * np.array([w, h, w, h], dtype=boxes.dtype)
+    num_classes = scores.shape[1]
+    # skip j = 0, because it's the background class
+    for j in range(1, num_classes): # for every class
+        # for particular class, keep those boxes with score greater than threshold
+        inds = np.where(scores[:, j] > thresh)[0]
+        if len(inds) == 0:
+            all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
+            continue
+        c_bboxes = boxes[inds] #filter by inds
+        c_scores = scores[inds, j] #filter by inds
+        c_dets = np.hstack((c_bboxes, c_scores[:, np.newaxis])).astype(
+            np.float32, copy=False)
+        # nms
+        keep = refine_nms(c_dets, 0.45, top_k=50) #0.45 is nms threshold, stop once 50 boxes are kept
+        c_dets = c_dets[keep, :]
+        all_boxes[j][i] = c_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
+
+    if max_per_image > 0:
+        image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1, num_classes)])
+        # to keep only max_per_image results
+        if len(image_scores) > max_per_image:
+            # get the smallest score for each class for each image if want to keep only max_per_image results
+            image_thresh = np.sort(image_scores)[-max_per_image] # only keep top_k results
+            for j in range(1, num_classes):
+                keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
+                all_boxes[j][i] = all_boxes[j][i][keep, :]
+
+
+def post_process(out, all_boxes, i, heights, widths, max_per_image, thresh, detector=None, priors=None,
+                 detect_lock=None):
+    """Decode, nms and store the detections of the batch of images starting at image i
+        out: SSD detections, or RefineDet (arm_loc, arm_conf, odm_loc, odm_conf)
+        detect_lock: serializes detector.forward, which keeps per-call state
+    """
+    if detector is None:
+        detections = out.cpu().numpy()
+        for b in range(detections.shape[0]):
+            ssd_detections(detections[b], all_boxes, i + b, int(widths[b]), int(heights[b]))
+        return
+    arm_loc, arm_conf, odm_loc, odm_conf = out
+    if detect_lock is not None:
+        detect_lock.acquire()
+    try:
+        boxes, scores = detector.forward((odm_loc,odm_conf), priors, (arm_loc,arm_conf))
+        boxes = boxes.cpu().numpy()
+        scores = scores.cpu().numpy()
+    finally:
+        if detect_lock is not None:
+            detect_lock.release()
+    for b in range(boxes.shape[0]):
+        refine_detections(boxes[b], scores[b], all_boxes, i + b, int(widths[b]), int(heights[b]),
+                          max_per_image, thresh)
+
+
+def test_net(save_folder, net, cuda, testset, transform, max_per_image=200, thresh=0.05,
+             detector=None, priors=None, batch_size=16, num_workers=4, post_workers=2, queue_size=4,
+             write_results=False, eval_workers=0):
+    """Detect every image of testset, save the detections and evaluate them
+    Args:
+        save_folder: the eval results saving folder
+        net: test-type ssd net (or RefineDet net with detector and priors)
+        cuda: run the net on gpu
+        testset: validation dataset
+        transform: BaseTransform -- required for refineDet testing,
+                   because it pull_image instead of pull_item (this will transform for you);
+                   not used for SSD, testset applies its own transform in pull_item
+        max_per_image/top_k: The Maximum number of box preds to keep per image for RefineDet,
+                   SSD applies it inside its Detect layer
+        thresh: RefineDet score threshold
+        detector: RefineDetect, for RefineDet nets
+        priors: priors of the RefineDet net
+        batch_size: images per forward pass
+        num_workers: DataLoader workers decoding and transforming the test images
+        post_workers: post-processing threads, 0 to post-process right after each forward pass
+        queue_size: batches waiting for post-processing before the forward passes block
+        write_results: also write the per-class results files, the APs are computed from all_boxes
+        eval_workers: processes computing the per-class APs, 0 to compute them in this process
+    Return:
+        APs, mAP of testset.evaluate_detections
+    """
+    if not os.path.exists(save_folder):
+        os.mkdir(save_folder)
+
+    num_images = len(testset)
+    # all detections are collected into:
+    #    all_boxes[cls][image] = N x 5 array of detections in
+    #    (x1, y1, x2, y2, score)
+    all_boxes = None
+
+    # timers
+    _t = {'im_detect': Timer(), 'total': Timer()}
+    #file storing output result under output_dir
+    det_file = os.path.join(save_folder, 'detections.pkl')
+
+    jobs = queue.Queue(maxsize=queue_size)
+    detect_lock = threading.Lock()
+    errors = []
+    def consume():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if errors: # drain the queue so that the producer never blocks
+                continue
+            try:
+                post_process(*job, max_per_image=max_per_image, thresh=thresh,
+                             detector=detector, priors=priors, detect_lock=detect_lock)
+            except Exception:
+                errors.append(sys.exc_info())
+    consumers = [threading.Thread(target=consume) for _ in range(post_workers)]
+    for consumer in consumers:
+        consumer.daemon = True
+        consumer.start()
+
+    items = TestItems(testset, transform if detector is not None else None)
+    test_loader = data.DataLoader(items, batch_size, num_workers=num_workers,
+                                  shuffle=False, pin_memory=cuda)
+    _t['total'].tic()
+    i = 0
+    try:
+        for images, heights, widths in test_loader:
+            if errors:
+                break
+            x = images.cuda(non_blocking=True) if cuda else images
+
+            _t['im_detect'].tic()
+            with torch.no_grad(): # no autograd graph keeping the activations of the batch alive
+                out = net(x=x, test=True)  # forward pass
+                if detector is None:
+                    out = out.data # SSD detections, max_per_image takes effect inside
+                    num_classes = out.size(1)
+                else:
+                    out = tuple(o.data for o in out) # arm_loc, arm_conf, odm_loc, odm_conf
+                    num_classes = out[3].size(-1)
+            detect_time = _t['im_detect'].toc(average=False)
+            if all_boxes is None:
+                all_boxes = [[[] for _ in range(num_images)]
+                             for _ in range(num_classes)]
+
+            job = (out, all_boxes, i, heights, widths)
+            if consumers:
+                jobs.put(job) # blocks while queue_size batches wait for post-processing
+            else:
+                post_process(*job, max_per_image=max_per_image, thresh=thresh,
+                             detector=detector, priors=priors)
+
+            if (i + images.size(0)) // 100 > i // 100:
+                print('im_detect: {:d}/{:d} {:.3f}s'.format(i + images.size(0), num_images, detect_time))
+            i += images.size(0)
+    finally:
+        for _ in consumers:
+            jobs.put(None)
+        for consumer in consumers:
+            consumer.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_value
+    print('detect and post-process: {:.3f}s'.format(_t['total'].toc(average=False)))
+
+    #write the detection results into det_file
+    with open(det_file, 'wb') as f:
+        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
+
+    print('Evaluating detections')
+    APs, mAP = testset.evaluate_detections(all_boxes, save_folder, write_results=write_results,
+                                         num_workers=eval_workers)
+    return APs, mAP